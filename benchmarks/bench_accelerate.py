@@ -0,0 +1,55 @@
+"""Run time of many small file and lineinfile tasks, with and without the module server."""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import quiet  # noqa: E402
+from common import report  # noqa: E402
+from common import sandbox  # noqa: E402
+from common import timed  # noqa: E402
+
+from extensions import ansible_playbook  # noqa: E402
+
+
+def write_playbook(path, target_dir, tasks):
+    with open(path, 'w') as f:
+        f.write('- hosts: localhost\n  connection: local\n  gather_facts: false\n  tasks:\n')
+        for i in range(tasks // 2):
+            f.write(f'    - name: File {i}\n      ansible.builtin.file:\n        path: {target_dir}/file_{i}\n')
+            f.write('        state: touch\n        modification_time: preserve\n        access_time: preserve\n')
+            f.write(f'    - name: Line {i}\n      ansible.builtin.lineinfile:\n        path: {target_dir}/file_{i}\n')
+            f.write(f'        line: "line {i}"\n')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=200)
+    args = parser.parse_args()
+
+    with sandbox() as (manager, tmpdir), quiet():
+        # Modules are only pipelined to the server with pipelining on
+        manager.configure(pipelining=True)
+        manager._export_config()
+        target_dir = os.path.join(tmpdir, 'files')
+        os.makedirs(target_dir)
+        playbook = write_playbook(os.path.join(tmpdir, 'playbook.yaml'), target_dir, args.tasks)
+        request = manager._plan_run(playbook, tags=[], force=True, become=False)['request']
+        request['options']['task_timing'] = False
+        # Interleave the variants, so both see the same system noise
+        samples = {False: [], True: []}
+        for _ in range(args.runs):
+            for accelerate in (False, True):
+                request['options']['accelerate'] = accelerate
+                with timed(samples[accelerate]):
+                    ansible_playbook.run_request(request)
+        report('stock', samples[False])
+        report('accelerate', samples[True])
+
+
+if __name__ == '__main__':
+    main()
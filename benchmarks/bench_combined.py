@@ -0,0 +1,45 @@
+"""Install and storage playbooks run one after another or in one executor pass."""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import quiet  # noqa: E402
+from common import report  # noqa: E402
+from common import sandbox  # noqa: E402
+from common import timed  # noqa: E402
+from common import write_playbook  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=20)
+    args = parser.parse_args()
+
+    with sandbox() as (manager, tmpdir), quiet():
+        runs = [
+            dict(playbook=write_playbook(os.path.join(tmpdir, name), tasks=args.tasks, tags=tags), tags=tags)
+            for name, tags in (('playbook.yaml', ['install']), ('storage.yaml', ['mount']))
+        ]
+        # Import Ansible before measuring, both variants then start warm
+        manager.apply_playbooks(runs, force=True)
+
+        samples = []
+        for _ in range(args.runs):
+            with timed(samples), manager.session():
+                for run in runs:
+                    manager.apply_playbook(force=True, **run)
+        report('separate runs', samples)
+
+        samples = []
+        for _ in range(args.runs):
+            with timed(samples), manager.session():
+                manager.apply_playbooks(runs, force=True)
+        report('one pass', samples)
+
+
+if __name__ == '__main__':
+    main()
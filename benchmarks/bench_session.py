@@ -0,0 +1,37 @@
+"""Sequential playbook runs in one hook, with and without a shared AnsibleSession."""
+
+import argparse
+import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import quiet  # noqa: E402
+from common import report  # noqa: E402
+from common import sandbox  # noqa: E402
+from common import timed  # noqa: E402
+from common import write_playbook  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=50)
+    args = parser.parse_args()
+
+    with sandbox() as (manager, tmpdir), quiet():
+        playbook = write_playbook(os.path.join(tmpdir, 'playbook.yaml'), tasks=args.tasks)
+        # Import Ansible before measuring, both variants then start warm
+        manager.apply_playbook(playbook, tags=['config'], force=True)
+        for name, session in (('separate runs', nullcontext), ('shared session', manager.session)):
+            samples = []
+            with session():
+                for _ in range(args.runs):
+                    with timed(samples):
+                        manager.apply_playbook(playbook, tags=['config'], force=True)
+            report(name, samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Run time of a playbook with many short tasks under each execution setting."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import quiet  # noqa: E402
+from common import report  # noqa: E402
+from common import sandbox  # noqa: E402
+from common import timed  # noqa: E402
+from common import write_playbook  # noqa: E402
+
+from extensions import ansible_playbook  # noqa: E402
+
+BASELINE = dict(forks=10, strategy='linear', pipelining=False, internal_poll_interval=0.001, task_timeout=0)
+VARIANTS = (
+    ('baseline', {}),
+    ('forks=1', dict(forks=1)),
+    ('forks=50', dict(forks=50)),
+    ('strategy=free', dict(strategy='free')),
+    ('strategy=host_pinned', dict(strategy='host_pinned')),
+    ('pipelining', dict(pipelining=True)),
+    ('internal_poll_interval=0.01', dict(internal_poll_interval=0.01)),
+    ('internal_poll_interval=0.0001', dict(internal_poll_interval=0.0001)),
+    ('task_timeout=60', dict(task_timeout=60)),
+    ('pipelining, poll=0.01', dict(pipelining=True, internal_poll_interval=0.01)),
+)
+
+
+def child(args):
+    """Run the playbook with the config in ANSIBLE_CONFIG, print samples as JSON."""
+    samples = []
+    with sandbox() as (manager, tmpdir), quiet():
+        request = manager._plan_run(args.playbook, tags=['config'], force=True)['request']
+        request['options']['task_timing'] = False
+        for _ in range(args.runs):
+            with timed(samples):
+                ansible_playbook.run_request(request)
+    print(json.dumps(samples), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--playbook', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.playbook:
+        return child(args)
+
+    with sandbox() as (manager, tmpdir):
+        playbook = write_playbook(os.path.join(tmpdir, 'playbook.yaml'), tasks=args.tasks, module=True)
+        for name, settings in VARIANTS:
+            # Ansible reads its config on import, every variant runs in a new process
+            manager.configure(**dict(BASELINE, **settings))
+            env = dict(os.environ, ANSIBLE_CONFIG=manager.config_path)
+            command = [sys.executable, __file__, '--playbook', playbook, '--runs', str(args.runs)]
+            output = subprocess.run(command, env=env, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+            report(name, json.loads(output.stderr.decode().strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
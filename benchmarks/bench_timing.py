@@ -0,0 +1,40 @@
+"""Overhead of the task timing callback on a playbook with many cheap tasks."""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import quiet  # noqa: E402
+from common import report  # noqa: E402
+from common import sandbox  # noqa: E402
+from common import timed  # noqa: E402
+from common import write_playbook  # noqa: E402
+
+from extensions import ansible_playbook  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=200)
+    args = parser.parse_args()
+
+    with sandbox() as (manager, tmpdir), quiet():
+        playbook = write_playbook(os.path.join(tmpdir, 'playbook.yaml'), tasks=args.tasks)
+        request = manager._plan_run(playbook, tags=['config'], force=True)['request']
+        ansible_playbook.run_request(request)
+        # Interleave the variants, so both see the same system noise
+        samples = {False: [], True: []}
+        for _ in range(args.runs):
+            for task_timing in (False, True):
+                request['options']['task_timing'] = task_timing
+                with timed(samples[task_timing]):
+                    ansible_playbook.run_request(request)
+        report('without timing', samples[False])
+        report('with timing', samples[True])
+
+
+if __name__ == '__main__':
+    main()
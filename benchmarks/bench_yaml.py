@@ -0,0 +1,67 @@
+"""Load and dump time of large host vars, pure Python PyYAML against the charm YAML layer."""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import report  # noqa: E402
+from common import timed  # noqa: E402
+from common import write_playbook  # noqa: E402
+
+from extensions import yaml_io  # noqa: E402
+
+
+def python_round_trip(path):
+    """Host vars update as juju_state_to_yaml did it before the YAML layer."""
+    yaml.add_representer(str, lambda dumper, value: dumper.represent_scalar('tag:yaml.org,2002:str', value))
+    with open(path, 'r') as f:
+        data = yaml.safe_load(f.read())
+    with open(path, 'w') as f:
+        f.write(yaml.dump(data, default_flow_style=False))
+
+
+def charm_round_trip(path):
+    with open(path, 'r') as f:
+        data = yaml_io.safe_load(f)
+    with open(path, 'w') as f:
+        yaml_io.safe_dump(data, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tasks', type=int, default=20000, help='tasks of the playbook held in the model config')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        playbook = write_playbook(os.path.join(tmpdir, 'playbook.yaml'), tasks=args.tasks)
+        with open(playbook) as f:
+            config = dict(playbook=f.read(), crontab='', apt_cache_window=300)
+        vars_path = os.path.join(tmpdir, 'localhost')
+        with open(vars_path, 'w') as f:
+            yaml_io.safe_dump(dict(config, charm_dir=tmpdir, unit_private_address='127.0.0.1'), f)
+        print(f"host vars: {os.path.getsize(vars_path) / 2 ** 20:.1f} MiB, libyaml: {yaml_io.LIBYAML}", file=sys.stderr)
+        # Interleave the variants, so both see the same system noise
+        samples = {'pure python': [], 'charm (libyaml)': [], 'playbook python': [], 'playbook libyaml': []}
+        for _ in range(args.runs):
+            with timed(samples['pure python']):
+                python_round_trip(vars_path)
+            with timed(samples['charm (libyaml)']):
+                charm_round_trip(vars_path)
+            with timed(samples['playbook python']):
+                with open(playbook) as f:
+                    yaml.safe_load(f)
+            with timed(samples['playbook libyaml']):
+                with open(playbook) as f:
+                    yaml_io.safe_load(f)
+        for name, values in samples.items():
+            report(name, values)
+
+
+if __name__ == '__main__':
+    main()
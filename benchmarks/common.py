@@ -0,0 +1,75 @@
+"""Helpers shared by the benchmark scripts."""
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from extensions import ansible_playbook
+
+
+def write_playbook(path, tasks=10, tags=('config',), module=False):
+    """Write a localhost playbook with a number of cheap tasks.
+
+    With module=True tasks execute a module on the host (command) instead of
+    only setting a fact in the controller.
+    """
+    with open(path, 'w') as f:
+        f.write('- hosts: localhost\n  connection: local\n  gather_facts: false\n  tasks:\n')
+        for i in range(tasks):
+            if module:
+                f.write(f'    - name: Task {i}\n      ansible.builtin.command: "true"\n      changed_when: false\n')
+            else:
+                f.write(f'    - name: Task {i}\n      ansible.builtin.set_fact:\n        fact_{i}: {i}\n')
+            f.write(f'      tags: [{", ".join(tags)}]\n')
+    return path
+
+
+@contextmanager
+def sandbox():
+    """Yield an Ansible manager writing its inventory and state to a temporary directory."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hosts_path = os.path.join(tmpdir, 'hosts')
+        vars_path = os.path.join(tmpdir, 'host_vars', 'localhost')
+        os.environ.setdefault('JUJU_UNIT_NAME', 'ansible/0')
+        with patch.object(ansible_playbook, 'ANSIBLE_HOSTS_PATH', hosts_path), \
+                patch.object(ansible_playbook, 'ANSIBLE_VARS_PATH', vars_path), \
+                patch.object(ansible_playbook, 'unit_get', return_value='127.0.0.1'):
+            manager = ansible_playbook.Ansible()
+            manager.app_name = 'ansible'
+            manager.state_dir = os.path.join(tmpdir, 'state')
+            with open(hosts_path, 'w') as f:
+                f.write('[all]\nlocalhost ansible_connection=local\n')
+            yield manager, tmpdir
+
+
+@contextmanager
+def quiet():
+    """Send Ansible output (stdout) to /dev/null, reports go to stderr."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(devnull)
+        os.close(saved)
+
+
+@contextmanager
+def timed(samples):
+    start = time.perf_counter()
+    yield
+    samples.append(time.perf_counter() - start)
+
+
+def report(name, samples):
+    later = samples[1:] or samples
+    print('{:<28} first={:.3f}s later(mean)={:.3f}s later(min)={:.3f}s runs={}'.format(
+        name, samples[0], sum(later) / len(later), min(later), len(samples),
+    ), file=sys.stderr)
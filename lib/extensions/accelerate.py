@@ -0,0 +1,217 @@
+"""
+Accelerated local execution
+===========================
+
+Run pipelined modules of local connections in the module server (see
+``module_server.py``) instead of a new Python interpreter per task. This
+module imports Ansible, import it only where Ansible is already loaded.
+
+.. code-block:: python
+
+    from .accelerate import Accelerator
+
+    accelerator = Accelerator()
+    accelerator.start()
+    try:
+        executor.run()
+    finally:
+        accelerator.stop()
+
+While started, local connections created by the plugin loader run modules in
+the server when the module is executed by the same interpreter as the server,
+becomes no other user than the one running the charm and is not listed in
+``FALLBACK_MODULES``. Everything else, and every module while the server is
+not up yet, runs the usual way. Modules are only pipelined with pipelining
+enabled in the Ansible config.
+
+"""
+
+import logging
+import os
+import pwd
+import re
+import shlex
+import shutil
+import signal
+import sys
+import tempfile
+
+from ansible import constants as C
+from ansible.plugins.connection.local import Connection as LocalConnection
+from ansible.plugins.loader import connection_loader
+from ansible.utils.display import Display
+
+from . import module_server
+from .runner import RunnerError
+
+log = logging.getLogger(__name__)
+display = Display()
+
+# Modules which start a new interpreter themselves or depend on a fresh process
+FALLBACK_MODULES = {
+    'apt', 'apt_repository', 'dnf', 'dnf5', 'yum', 'yum_repository', 'package', 'package_facts', 'pip',
+    'async_status', 'async_wrapper', 'reboot', 'wait_for_connection',
+}
+# Shells wrapping the module command
+SHELLS = ('sh', 'bash')
+# Environment sudo keeps with env_reset (Ubuntu defaults)
+SUDO_ENV_KEEP = ('TERM', 'LANG', 'LANGUAGE', 'LINGUAS', 'DISPLAY', 'XAUTHORITY', 'COLORS', 'LS_COLORS', 'MAIL')
+SUDO_SECURE_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/snap/bin'
+WRAPPER_MARKER = b'_ANSIBALLZ_WRAPPER = True'
+MODULE_NAME = re.compile(rb"runpy\.run_module\(mod_name='([\w.]+)'")
+
+
+def parse_module_command(cmd):
+    """Return (env, interpreter, sudo) of a pipelined module command, None if not recognized.
+
+    Commands look like ``/bin/sh -c '[sudo ... /bin/sh -c '"'"'echo BECOME-SUCCESS-x ;']
+    LANG=C.UTF-8 /usr/bin/python3[' && sleep 0]'``.
+    """
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        return None
+    sudo = False
+    while True:
+        if tokens[-3:] == ['&&', 'sleep', '0']:
+            tokens = tokens[:-3]
+        if len(tokens) >= 3 and tokens[-2] == '-c' and os.path.basename(tokens[-3]) in SHELLS:
+            prefix = tokens[:-3]
+            if prefix:
+                if prefix[0] != 'sudo' or sudo:
+                    return None
+                sudo = True
+            try:
+                tokens = shlex.split(tokens[-1])
+            except ValueError:
+                return None
+            continue
+        break
+    if len(tokens) >= 3 and tokens[0] == 'echo' and tokens[1].startswith('BECOME-SUCCESS-') and tokens[2] == ';':
+        tokens = tokens[3:]
+    env = {}
+    while len(tokens) > 1 and re.match(r'^[A-Za-z_][A-Za-z0-9_]*=', tokens[0]):
+        key, value = tokens.pop(0).split('=', 1)
+        env[key] = value
+    if len(tokens) != 1:
+        return None
+    return env, tokens[0], sudo
+
+
+def sudo_environment(env):
+    """Return env as sudo with env_reset passes it to a root command."""
+    root = pwd.getpwuid(0)
+    user = pwd.getpwuid(os.getuid())
+    result = {key: value for key, value in env.items() if key in SUDO_ENV_KEEP or key.startswith('LC_')}
+    result.update(
+        HOME=root.pw_dir, LOGNAME=root.pw_name, USER=root.pw_name, SHELL=root.pw_shell, PATH=SUDO_SECURE_PATH,
+        SUDO_USER=user.pw_name, SUDO_UID=str(user.pw_uid), SUDO_GID=str(user.pw_gid),
+    )
+    return result
+
+
+def module_request(cmd, in_data, become=None, cwd=None, interpreter=sys.executable):
+    """Return the module server request for a command, None if it must run the usual way."""
+    if not in_data or WRAPPER_MARKER not in in_data[:512]:
+        return None
+    match = MODULE_NAME.search(in_data)
+    if not match or match.group(1).decode().rsplit('.', 1)[-1] in FALLBACK_MODULES:
+        return None
+    parsed = parse_module_command(cmd)
+    if parsed is None:
+        return None
+    env, command_interpreter, sudo = parsed
+    if os.path.realpath(command_interpreter) != os.path.realpath(interpreter):
+        return None
+    if sudo:
+        # Only becoming root as root keeps the module in the same user
+        if os.geteuid() != 0 or become is None or become.name != 'sudo':
+            return None
+        if (become.get_option('become_user') or 'root') != 'root':
+            return None
+        base = sudo_environment(os.environ)
+    else:
+        base = dict(os.environ)
+    base.update(env)
+    return dict(
+        module=match.group(1).decode(),
+        payload=in_data.decode('utf-8', 'surrogateescape'),
+        env=base,
+        cwd=cwd.decode() if isinstance(cwd, bytes) else cwd,
+    )
+
+
+class AcceleratedLocalConnection(LocalConnection):
+    """Local connection running pipelined modules in the module server."""
+
+    module_server = None
+
+    @property
+    def plugin_type(self):
+        # Options of the connection are looked up by the plugin type, derived from the class name
+        return 'connection'
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        request = None
+        if self.module_server and in_data:
+            request = module_request(cmd, in_data, become=self.become if sudoable else None, cwd=self.cwd)
+        if request is None:
+            return super().exec_command(cmd, in_data=in_data, sudoable=sudoable)
+        try:
+            rc, stdout, stderr = module_server.run_module(self.module_server, request)
+        except module_server.ModuleServerUnavailable as e:
+            display.vvv(f"Module server not available, running {request['module']} the usual way: {e}")
+            return super().exec_command(cmd, in_data=in_data, sudoable=sudoable)
+        except RunnerError as e:
+            # The module may have done part of its work, it must not run again
+            return 1, b'', f"Module server lost {request['module']}: {e}".encode()
+        display.vvv(f"Module {request['module']} ran in the module server (rc={rc})")
+        return rc, stdout, stderr
+
+
+class Accelerator:
+    """Module server of one run, with local connections redirected to it."""
+
+    def __init__(self, cwd=None, log_path=None):
+        self.cwd = cwd
+        self.log_path = log_path
+        self.socket_path = None
+        self.pid = None
+        self.stats = None
+        self._original = None
+
+    def start(self):
+        if not C.ANSIBLE_PIPELINING:
+            log.warning('Accelerated execution needs pipelining, modules run the usual way')
+            return False
+        self.socket_path = os.path.join(tempfile.mkdtemp(prefix='charm-ansible-modules-'), 'modules.sock')
+        # Modules run the usual way until the server listens
+        self.pid = module_server.start(self.socket_path, cwd=self.cwd, log_path=self.log_path)
+        socket_path = self.socket_path
+        self._original = original = connection_loader.get_with_context
+
+        def get_with_context(name, *args, **kwargs):
+            result = original(name, *args, **kwargs)
+            if type(result.object) is LocalConnection:
+                result.object.__class__ = AcceleratedLocalConnection
+                result.object.module_server = socket_path
+            return result
+
+        connection_loader.get_with_context = get_with_context
+        return True
+
+    def stop(self):
+        if self._original is not None:
+            del connection_loader.get_with_context
+            self._original = None
+        if self.socket_path:
+            self.stats = module_server.stop(self.socket_path)
+            if self.stats:
+                log.info(f"Ran {self.stats['modules']} modules in the module server")
+            else:
+                try:
+                    os.kill(self.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            shutil.rmtree(os.path.dirname(self.socket_path), ignore_errors=True)
+            self.socket_path = None
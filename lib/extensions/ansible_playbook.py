@@ -12,18 +12,66 @@ Ansible Playbook runner
 
     ansible.apply_playbook('playbook.yaml', tags=['install'], extra_vars={})
 
+Runs go through the runner daemon (see ``runner.py``) when it was started
+with ``ansible.start_runner()``, otherwise they are executed in-process.
+
+Runs are skipped when the playbook, files it references, extra vars, model
+config and environment did not change since the last successful run with the
+same tags. Use ``force=True`` to run regardless.
+
+``ansible.apply_playbooks([...])`` runs several playbooks, each with its own
+tags and options, in one executor pass and reports each of them separately.
+
+Runs with tags matching no task of the playbook (see ``tag_index.py``) are
+skipped without loading Ansible, once the playbook was indexed with
+``ansible.index_tags('playbook.yaml')``.
+
+Runs of all units on the machine are ordered by a shared FIFO run queue (see
+``run_queue.py``), ``ansible.queue_ticket`` reports the wait of the last run.
+``ansible.refresh_apt_cache()`` refreshes apt lists at most once per window
+for all units of the machine (see ``apt_cache.py``).
+
 """
 
+import configparser
+import io
 import logging
 import os
+import shutil
 import subprocess
 import sys
-import yaml
 import stat
 import json
-from functools import wraps
+import time
+from contextlib import contextmanager
 from copy import deepcopy
 
+from . import runner
+from .memoize import memoize
+from . import yaml_io
+from .apt_cache import AptCache
+from .drift import DriftState
+from .history import DEFAULT_MAX_RUNS
+from .history import RunHistory
+from .history import current_hook
+from .jobs import JobStore
+from .metrics import RunMetrics
+from .metrics import prom_file_name
+from .planner import TaskPlanner
+from .planner import playbook_uses
+from .fingerprint import FingerprintCache
+from .fingerprint import context_fingerprint
+from .fingerprint import file_digest
+from .fingerprint import fingerprint
+from .fingerprint import fingerprint_env
+from .fingerprint import fingerprint_extra_vars
+from .playbook_cache import ParsedPlaybookCache
+from .rollout import config_revision
+from .run_queue import RunQueue
+from .schedule import Schedule
+from .schedule import unit_jitter
+from .tag_index import TagIndex
+
 log = logging.getLogger(__name__)
 CHARM_DIR = os.getenv('CHARM_DIR', None)
 # UNIT_NAME = os.getenv('JUJU_UNIT_NAME', None)
@@ -34,6 +82,35 @@ ANSIBLE_VARS_PATH = '/etc/ansible/host_vars/localhost'
 
 ANSIBLE_REMOTE_TMP = '/root/.ansible/tmp'
 
+# Persistent per-unit state of the charm (caches, fingerprints)
+CHARM_STATE_DIR = os.path.join(CHARM_DIR, '.charm-ansible') if CHARM_DIR else None
+# Options configuring only the charm itself, changing them does not rerun playbooks
+FINGERPRINT_IGNORED_CONFIG = {
+    'crontab', 'runner_daemon', 'fact_cache_timeout', 'run_queue_max_hold', 'apt_cache_window',
+    'forks', 'strategy', 'pipelining', 'internal_poll_interval', 'task_timeout', 'accelerate',
+    'drift_check', 'drift_check_tags', 'drift_check_tasks', 'drift_check_seconds',
+    'schedule', 'schedule_jitter', 'history_runs', 'metrics_textfile_dir',
+    'rollout_tags', 'rollout_batch_size', 'rollout_canary',
+}
+# Seconds between progress messages of a run
+PROGRESS_INTERVAL = 3
+# Strategies the charm config may select
+ANSIBLE_STRATEGIES = ('linear', 'free', 'host_pinned')
+# Configs merged into the generated config, in the order Ansible searches them
+ANSIBLE_CONFIG_SEARCH = ('ansible.cfg', '~/.ansible.cfg', '/etc/ansible/ansible.cfg')
+# Distributions reported by Ansible.package_versions()
+ANSIBLE_PACKAGES = {'ansible_core': 'ansible-core', 'ansible': 'ansible'}
+
+
+def timing_path(playbook_path):
+    """Return path of the task timing table written next to a playbook."""
+    return '{}.timing.json'.format(os.path.splitext(playbook_path)[0])
+
+
+def tag_index_path(playbook_path):
+    """Return path of the tag index written next to a playbook."""
+    return '{}.tags.json'.format(os.path.splitext(playbook_path)[0])
+
 
 class AnsiblePlaybookError(Exception):
     """Exception - Ansible Playbook Error."""
@@ -47,10 +124,196 @@ class Ansible():
         self.charm = None
         self.model = None
         self.app_name = None
+        self.unit_name = None
+        self.state_dir = CHARM_STATE_DIR
+        self._in_session = False
+        self._session = None
+        self.run_queue = RunQueue()
+        self.queue_ticket = None
+        self.apt_cache = AptCache()
+        self.accelerate = False
+        # Unit name and addresses of the charm, looked up by every run when None
+        self.unit_state = None
+        # Runs kept in the run history, 0 records none
+        self.history_runs = DEFAULT_MAX_RUNS
+        # Textfile collector directory of node_exporter, no metrics are written when None
+        self.metrics_dir = None
+
+    @contextmanager
+    def session(self):
+        """Share one AnsibleSession by all in-process runs inside the block.
+
+        .. code-block:: python
+
+            with ansible.session():
+                ansible.apply_playbook('playbook.yaml', tags=['install'])
+                ansible.apply_playbook('playbooks/storage.yaml', tags=['mount'])
+
+        The session is created on the first run, so skipped runs never import Ansible.
+        """
+        if self._in_session:
+            yield
+            return
+        self._in_session = True
+        try:
+            yield
+        finally:
+            self._in_session = False
+            self._session = None
+
+    @property
+    def fingerprints(self):
+        """Fingerprint cache of the last successful runs, None without state dir."""
+        if not self.state_dir:
+            return None
+        return FingerprintCache(os.path.join(self.state_dir, 'fingerprints.json'))
+
+    def flush_fingerprints(self):
+        """Forget all fingerprints so the next runs are not skipped."""
+        if self.fingerprints:
+            self.fingerprints.clear()
+        # Incremental runs would skip unchanged tasks as well
+        if self.planner:
+            self.planner.clear()
+
+    @property
+    def planner(self):
+        """Records of applied playbooks for incremental runs, None without state dir."""
+        if not self.state_dir:
+            return None
+        return TaskPlanner(os.path.join(self.state_dir, 'applied'))
+
+    @property
+    def history(self):
+        """Run history of the unit, None without state dir or with history disabled."""
+        if not self.state_dir or not self.history_runs:
+            return None
+        return RunHistory(os.path.join(self.state_dir, 'history.sqlite'), max_runs=self.history_runs)
+
+    @property
+    def payload_cache_dir(self):
+        return os.path.join(self.state_dir, 'payloads') if self.state_dir else None
+
+    def flush_payload_cache(self):
+        """Remove all cached AnsiballZ payloads."""
+        if self.payload_cache_dir:
+            from .payload_cache import PayloadCache
+            PayloadCache(self.payload_cache_dir).clear()
+
+    @property
+    def config_path(self):
+        """Ansible config generated by the charm, None without state dir."""
+        return os.path.join(self.state_dir, 'ansible.cfg') if self.state_dir else None
+
+    @property
+    def fact_cache_dir(self):
+        return os.path.join(self.state_dir, 'facts') if self.state_dir else None
+
+    def configure(
+        self, fact_cache_timeout=0, forks=None, strategy=None, pipelining=None, internal_poll_interval=None,
+        task_timeout=None,
+    ):
+        """Write the Ansible config of the charm, return True if it changed.
+
+        Gathered facts are kept in a JSON fact cache for fact_cache_timeout
+        seconds, plays with gather_facts then gather only hosts missing in the
+        cache (gathering=smart). Other settings left as None keep the value of
+        Ansible. The config found by Ansible otherwise is kept as the base.
+        Ansible reads its config once on import, so a running runner daemon
+        must be restarted when this returns True.
+        """
+        if not self.config_path:
+            log.warning('Could not write Ansible config: charm state directory is not known')
+            return False
+        if strategy is not None and strategy not in ANSIBLE_STRATEGIES:
+            raise AnsiblePlaybookError(f"Unknown strategy {strategy}, use one of: {', '.join(ANSIBLE_STRATEGIES)}")
+        defaults = {}
+        if fact_cache_timeout and int(fact_cache_timeout) > 0:
+            defaults.update({
+                'gathering': 'smart',
+                'fact_caching': 'jsonfile',
+                'fact_caching_connection': self.fact_cache_dir,
+                'fact_caching_timeout': str(int(fact_cache_timeout)),
+            })
+        if forks is not None:
+            defaults['forks'] = str(max(1, int(forks)))
+        if strategy is not None:
+            defaults['strategy'] = strategy
+        if internal_poll_interval is not None:
+            defaults['internal_poll_interval'] = str(float(internal_poll_interval))
+        if task_timeout is not None:
+            defaults['task_timeout'] = str(max(0, int(task_timeout)))
+        settings = {'defaults': defaults} if defaults else {}
+        if pipelining is not None:
+            settings['connection'] = {'pipelining': str(bool(pipelining))}
+
+        content = None
+        if settings:
+            config = configparser.ConfigParser(interpolation=None)
+            for path in ANSIBLE_CONFIG_SEARCH:
+                path = os.path.join(CHARM_DIR or os.getcwd(), os.path.expanduser(path))
+                if os.path.exists(path):
+                    config.read(path)
+                    break
+            for section, options in settings.items():
+                if not config.has_section(section):
+                    config.add_section(section)
+                for key, value in options.items():
+                    config.set(section, key, value)
+            output = io.StringIO()
+            config.write(output)
+            content = output.getvalue()
+
+        try:
+            with open(self.config_path, 'r') as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if content == current:
+            return False
+        if content is None:
+            os.remove(self.config_path)
+            os.environ.pop('ANSIBLE_CONFIG', None)
+            log.info(f"Removed Ansible config: {self.config_path}")
+        else:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+            tmp_path = f"{self.config_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, self.config_path)
+            log.info(f"Updated Ansible config: {self.config_path}")
+        # Cached facts may have been gathered with other settings
+        self.flush_fact_cache()
+        return True
+
+    def _export_config(self):
+        """Point Ansible to the generated config, before Ansible is imported."""
+        if self.config_path and os.path.exists(self.config_path):
+            os.environ['ANSIBLE_CONFIG'] = self.config_path
+
+    def flush_fact_cache(self):
+        """Remove all cached facts, return True if there were any."""
+        if not self.fact_cache_dir or not os.path.isdir(self.fact_cache_dir):
+            return False
+        shutil.rmtree(self.fact_cache_dir)
+        log.info(f"Flushed Ansible fact cache: {self.fact_cache_dir}")
+        return True
+
+    def _model_config(self):
+        if self.model and hasattr(self.model, 'config'):
+            model_config = {key: value for key, value in self.model.config.items()}
+            model_config['app_name'] = self.app_name
+        else:
+            model_config = {}
+        return model_config
 
     def init_charm(self, charm):
         self.charm = charm
         self.model = charm.model
+        try:
+            self.unit_name = self.model.unit.name
+        except Exception:
+            self.unit_name = os.getenv('JUJU_UNIT_NAME', None)
         try:
             self.app_name = self.model.app.name
         except Exception:
@@ -59,6 +322,89 @@ class Ansible():
                 self.app_name = CHARM_DIR.split('/')[0]
             if not self.app_name:
                 log.error('Could not set app_name')
+        try:
+            self.run_queue.max_hold = int(self.model.config['run_queue_max_hold'])
+        except Exception:
+            log.debug('Using default max hold time of the run queue')
+        try:
+            self.apt_cache.window = int(self.model.config['apt_cache_window'])
+        except Exception:
+            log.debug('Using default apt cache window')
+        self.accelerate = bool(self.model.config.get('accelerate', False))
+        try:
+            self.history_runs = int(self.model.config['history_runs'])
+        except Exception:
+            log.debug('Using default size of the run history')
+        self.metrics_dir = self.model.config.get('metrics_textfile_dir') or None
+        try:
+            self.unit_state = charm.unit_state
+        except Exception as e:
+            log.warning(f"Unit addresses not known, runs look them up: {e}")
+            self.unit_state = None
+
+    @property
+    def runner_socket(self):
+        """Socket of the runner daemon of this unit, None if unknown."""
+        return runner.socket_path(self.unit_name) if self.unit_name else None
+
+    def start_runner(self):
+        """Start the runner daemon keeping Ansible preloaded for this unit."""
+        if not self.runner_socket:
+            log.warning('Could not start Ansible runner: unit name is not known')
+            return False
+        log_path = os.path.join(self.state_dir, 'runner.log') if self.state_dir else None
+        if log_path:
+            os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        self._export_config()
+        return runner.start(self.runner_socket, cwd=CHARM_DIR, log_path=log_path)
+
+    def stop_runner(self):
+        if not self.runner_socket:
+            return False
+        return runner.stop(self.runner_socket)
+
+    def refresh_apt_cache(self):
+        """Refresh apt lists of the machine if they are older than the apt cache window.
+
+        Runs in the machine run queue, return True if apt-get update ran.
+        """
+        if not self.apt_cache.window or self.apt_cache.is_fresh():
+            return False
+        with self.run_queue.slot(self.unit_name or self.app_name):
+            return self.apt_cache.refresh()
+
+    def _run(self, request, progress=None):
+        self._export_config()
+        with self.run_queue.slot(self.unit_name or self.app_name, progress=progress) as ticket:
+            self.queue_ticket = ticket
+            if self.runner_socket:
+                try:
+                    return runner.request_run(self.runner_socket, request, progress=progress)
+                except runner.RunnerUnavailable as e:
+                    log.debug(f"Ansible runner not available, running in-process: {e}")
+                except runner.RunnerLost as e:
+                    # Tasks may have run already, the run is failed instead of repeated in-process
+                    log.error(f"Ansible runner lost the run: {e}")
+                    outcome = (runner.RUN_LOST_RETURNCODE, {})
+                    if request.get('runs'):
+                        return runner.RUN_LOST_RETURNCODE, [outcome] * len(request['runs'])
+                    return outcome
+            if self._in_session and self._session is None:
+                self._session = AnsibleSession(inventory_path=ANSIBLE_HOSTS_PATH)
+            return run_request(request, charm=self.charm, model=self.model, session=self._session, progress=progress)
+
+    def package_versions(self):
+        """Return versions of installed Ansible packages without importing them."""
+        from importlib.metadata import PackageNotFoundError
+        from importlib.metadata import version
+
+        versions = {}
+        for key, distribution in ANSIBLE_PACKAGES.items():
+            try:
+                versions[key] = version(distribution)
+            except PackageNotFoundError:
+                log.warning(f"Package is not installed: {distribution}")
+        return versions
 
     def install_ansible_support(self):
         """Create ansible configs."""
@@ -80,34 +426,77 @@ class Ansible():
 
     def apply_playbook(
         self, playbook, tags=None, extra_vars={}, env={}, diff=False, check=False, become=True, throw=False,
-        verbosity=None,
+        verbosity=None, force=False, progress=None, incremental=False,
     ):
         """
         Run ansible playbook.
 
-        Execute playbook file.
+        Execute playbook file. Unless force is set, the run is skipped if its
+        inputs match the last successful run with the same tags. If progress
+        is set, it is called with batches of task progress lines while the
+        playbook runs (at most one call per PROGRESS_INTERVAL seconds). If
+        incremental is set and only the playbook changed since the last
+        successful run, only its changed tasks run (see planner.py).
         """
-        kwargs = {}
-        if tags:
-            kwargs['tags'] = tags.split(',') if isinstance(tags, str) else tags
-        if verbosity:
-            try:
-                kwargs['verbosity'] = int(verbosity)
-            except Exception as e:
-                log.error(f"Failed to set verbosity parameter [verbosity={verbosity}]: {e}")
-        pb = AnsiblePlaybook(
-            self.charm,
-            self.model,
-            self.app_name,
-            inventory_path=ANSIBLE_HOSTS_PATH,
-            connection="local",
-            basedir=CHARM_DIR,
-            become=become,
-            diff=diff,
-            check=check,
-            **kwargs
+        run = self._plan_run(
+            playbook, tags=tags, extra_vars=extra_vars, env=env, diff=diff, check=check, become=become,
+            verbosity=verbosity, force=force, incremental=incremental,
         )
+        if run['outcome'] is None:
+            run['outcome'] = self._run(run['request'], progress=progress)
+        return self._finish_run(run, throw=throw)
 
+    def apply_playbooks(self, runs, force=False, progress=None):
+        """
+        Run several ansible playbooks in one executor pass.
+
+        .. code-block:: python
+
+            ansible.apply_playbooks([
+                dict(playbook='playbook.yaml', tags=['install'], extra_vars=extra_vars),
+                dict(playbook='playbooks/storage.yaml', tags=['mount'], extra_vars=extra_vars, diff=True),
+            ])
+
+        Each run takes the keyword arguments of apply_playbook and is skipped,
+        recorded and reported on its own. Returns (returncode, results) of
+        every run in order. Runs with differing environments are not combined.
+        """
+        planned = []
+        for kwargs in runs:
+            kwargs = dict(kwargs)
+            throw = kwargs.pop('throw', False)
+            planned.append((self._plan_run(force=force, **kwargs), throw))
+
+        pending = [run for run, _ in planned if run['outcome'] is None]
+        if len(pending) > 1 and all(run['request']['env'] == pending[0]['request']['env'] for run in pending):
+            log.info("Running playbooks in one pass: {}".format(
+                ', '.join(run['request']['playbook'] for run in pending)
+            ))
+            _, outcomes = self._run(dict(
+                runs=[run['request'] for run in pending],
+                env=pending[0]['request']['env'],
+            ), progress=progress)
+            for run, outcome in zip(pending, outcomes):
+                run['outcome'] = tuple(outcome)
+        for run in pending:
+            if run['outcome'] is None:
+                run['outcome'] = self._run(run['request'], progress=progress)
+
+        outcomes = []
+        error = None
+        for run, throw in planned:
+            try:
+                outcomes.append(self._finish_run(run, throw=throw))
+            except AnsiblePlaybookError as e:
+                # Report every run before raising for the first failed one
+                outcomes.append(run['outcome'])
+                error = error or e
+        if error:
+            raise error
+        return outcomes
+
+    def playbook_path(self, playbook):
+        """Resolve a playbook relative to the charm directory."""
         if CHARM_DIR and os.path.exists(os.path.join(CHARM_DIR, playbook)):
             pb_path = os.path.join(CHARM_DIR, playbook)
         elif os.path.exists(os.path.abspath(playbook)):
@@ -116,43 +505,488 @@ class Ansible():
             pb_path = playbook
         if "/./" in pb_path:
             pb_path = pb_path.replace("/./", "/")
+        return pb_path
+
+    @property
+    def jobs(self):
+        """Store of asynchronous playbook jobs, None without state dir."""
+        if not self.state_dir:
+            return None
+        return JobStore(os.path.join(self.state_dir, 'jobs'))
+
+    def start_job(
+        self, playbook, tags=None, extra_vars={}, env={}, diff=False, check=False, become=True, verbosity=None,
+    ):
+        """
+        Run ansible playbook in a worker detached from the hook.
+
+        Returns the job id immediately, the run is never skipped. Unit state
+        only available in a hook is resolved before the worker starts.
+        """
+        if not self.jobs:
+            raise AnsiblePlaybookError('Could not start playbook job: charm state directory is not known')
+        run = self._plan_detached_run(
+            playbook, tags=tags, extra_vars=extra_vars, env=env, diff=diff, check=check, become=become,
+            verbosity=verbosity,
+        )
+        job_id = self.jobs.create(run)
+        self._export_config()
+        self.jobs.start(job_id, cwd=CHARM_DIR)
+        return job_id
+
+    def _plan_detached_run(self, playbook, **kwargs):
+        """Plan a run executed outside of the hook, the run is never skipped."""
+        run = self._plan_run(playbook, force=True, **kwargs)
+        run['request']['unit_state'] = self.unit_state or unit_state_from_hook()
+        run['state_dir'] = self.state_dir
+        run['owner'] = self.unit_name or self.app_name
+        run['max_hold'] = self.run_queue.max_hold
+        run['history_runs'] = self.history_runs
+        run['metrics_dir'] = self.metrics_dir
+        return run
 
-        # log.info(f'Run playbook: {pb_path}')
-        returncode, results = pb.run(
-            pb_path,
-            subset="localhost",
+    def schedule_playbook(self, playbook, schedule, extra_vars={}, env={}, jitter=0):
+        """
+        Store runs of playbook tags scheduled by cron, return lines of the cron file.
+
+        Schedule maps comma separated tags to cron expressions (see
+        schedule.py), runs of this unit wait a delay below jitter seconds.
+        """
+        if not self.state_dir:
+            raise AnsiblePlaybookError('Could not schedule playbook runs: charm state directory is not known')
+        store = Schedule(os.path.join(self.state_dir, 'schedule'))
+        delay = unit_jitter(self.unit_name or self.app_name, jitter)
+        # Ansible reads its config on import, before the run applies its env
+        cron_env = {'ANSIBLE_CONFIG': self.config_path} if self.config_path else {}
+        names = []
+        lines = []
+        for tags, expression in schedule.items():
+            run = self._plan_detached_run(playbook, tags=tags, extra_vars=extra_vars, env=env)
+            run['hook'] = f"schedule:{tags}"
+            names.append(store.store(tags, run))
+            lines.append(store.cron_line(names[-1], expression, delay=delay, cwd=CHARM_DIR, env=cron_env))
+        store.prune(names)
+        return lines
+
+    @property
+    def drift_state(self):
+        """Position and findings of drift checks, None without state dir."""
+        if not self.state_dir:
+            return None
+        return DriftState(os.path.join(self.state_dir, 'drift.json'))
+
+    @staticmethod
+    def _playbook_uses(pb_path):
+        """Sorted names of variables the tasks of a playbook use, None if not known."""
+        try:
+            uses = playbook_uses(pb_path)
+        except Exception as e:
+            log.warning(f"Failed to find variables used by {pb_path}: {e}")
+            return None
+        return None if uses is None else sorted(uses)
+
+    def check_drift(self, playbook, tags=None, extra_vars={}, env={}, max_tasks=20, seconds=30):
+        """Run the next slice of the drift check pass of a playbook, return the drift state.
+
+        Returns None without running when the machine runs other playbooks,
+        a slice must not wait for them.
+        """
+        if not self.drift_state:
+            raise AnsiblePlaybookError('Could not check drift: charm state directory is not known')
+        if self.run_queue.status():
+            log.info("Machine run queue is busy, skipping drift check slice")
+            return None
+        run = self._plan_run(playbook, tags=tags, extra_vars=extra_vars, env=env, check=True)
+        if run['outcome'] is not None:
+            return self.drift_state.load()
+        options = run['request']['options']
+        options.update(
+            step=True,
+            # Slices must not replace the task timings of the last real run
+            task_timing=False,
+            drift=dict(
+                state_path=self.drift_state.path,
+                digest=self._fingerprint(
+                    run['request']['playbook'], tags=options.get('tags', []), extra_vars=extra_vars, env=env,
+                ),
+                max_tasks=max_tasks,
+                seconds=seconds,
+                uses=self._playbook_uses(run['request']['playbook']),
+            ),
+        )
+        if seconds:
+            # A single task must not outlast the budget either
+            task_timeout = self._model_config().get('task_timeout') or 0
+            options['task_timeout'] = min(task_timeout, seconds) if task_timeout else seconds
+        self._run(run['request'])
+        return self.drift_state.load()
+
+    def index_tags(self, playbook):
+        """Index tasks of a playbook by tags, return the index (None if it can not be indexed)."""
+        pb_path = self.playbook_path(playbook)
+        return TagIndex(tag_index_path(pb_path)).build(pb_path)
+
+    def tag_index(self, playbook):
+        """Return the tag index of a playbook, None if it is missing or out of date."""
+        pb_path = self.playbook_path(playbook)
+        return TagIndex(tag_index_path(pb_path)).load(pb_path)
+
+    def count_tasks(self, playbook, tags=None):
+        """Return the number of tasks of a playbook the tags select, None if it is not known."""
+        pb_path = self.playbook_path(playbook)
+        return TagIndex(tag_index_path(pb_path)).count(pb_path, tags)
+
+    def task_timings(self, playbook, top=None):
+        """Return tasks of the last run of a playbook, slowest first.
+
+        Timings are recorded by every run and kept in a JSON table next to the
+        playbook, an empty list is returned if there is none.
+        """
+        path = timing_path(self.playbook_path(playbook))
+        try:
+            with open(path, 'r') as f:
+                tasks = json.load(f).get('tasks', [])
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            log.warning(f"Failed to read task timing table {path}: {e}")
+            return []
+        tasks = sorted(tasks, key=lambda task: task.get('duration', 0), reverse=True)
+        return tasks[:top] if top else tasks
+
+    def _plan_run(
+        self, playbook, tags=None, extra_vars={}, env={}, diff=False, check=False, become=True,
+        verbosity=None, force=False, incremental=False,
+    ):
+        """Build the run request, the outcome is set when the run is skipped."""
+        kwargs = {}
+        if tags:
+            kwargs['tags'] = tags.split(',') if isinstance(tags, str) else tags
+        if verbosity:
+            try:
+                kwargs['verbosity'] = int(verbosity)
+            except Exception as e:
+                log.error(f"Failed to set verbosity parameter [verbosity={verbosity}]: {e}")
+
+        pb_path = self.playbook_path(playbook)
+        model_config = self._model_config()
+        run = dict(
+            tags=tags,
+            cache_key=f"{playbook}:{','.join(kwargs.get('tags', []))}",
+            digest=None,
+            outcome=None,
+            hook=current_hook(),
+            started=time.time(),
+        )
+        if kwargs.get('tags') and TagIndex(tag_index_path(pb_path)).count(pb_path, kwargs['tags']) == 0:
+            log.info(f"No tasks match the tags, skipping run: {pb_path} (tags={tags})")
+            run['outcome'] = (0, {})
+        # Check mode runs change nothing, so they are neither skipped nor recorded
+        if self.fingerprints and not check and run['outcome'] is None:
+            try:
+                run['digest'] = self._fingerprint(
+                    pb_path, tags=kwargs.get('tags', []), extra_vars=extra_vars, env=env, diff=diff, become=become,
+                )
+                if not force and self.fingerprints.is_fresh(run['cache_key'], run['digest']):
+                    log.info(f"Playbook cache hit, skipping run: {pb_path} (tags={tags})")
+                    run['outcome'] = (0, self.fingerprints.get(run['cache_key']).get('results', {}))
+            except Exception as e:
+                log.warning(f"Failed to fingerprint playbook run: {e}")
+                run['digest'] = None
+        if incremental and self.planner and not check and run['outcome'] is None:
+            try:
+                run['context'] = self._fingerprint(
+                    pb_path, tags=kwargs.get('tags', []), extra_vars=extra_vars, env=env, diff=diff, become=become,
+                    context=True,
+                )
+                paths = None if force else self.planner.plan(run['cache_key'], pb_path, run['context'])
+            except Exception as e:
+                log.warning(f"Failed to plan incremental playbook run: {e}")
+                paths = None
+            if paths == []:
+                log.info(f"No task changed, skipping run: {pb_path} (tags={tags})")
+                run['outcome'] = (0, {})
+            elif paths:
+                kwargs.update(step=True, only_tasks=paths)
+
+        run['request'] = dict(
+            playbook=pb_path,
+            app_name=self.app_name,
+            options=dict(
+                become=become,
+                diff=diff,
+                check=check,
+                cache_dir=os.path.join(self.state_dir, 'playbooks') if self.state_dir else None,
+                payload_cache_dir=self.payload_cache_dir,
+                accelerate=self.accelerate,
+                **kwargs
+            ),
             extra_vars=extra_vars,
             env=env,
+            model_config=model_config,
+            unit_state=self.unit_state,
         )
+        run['skipped'] = run['outcome'] is not None
+        return run
+
+    def rollout_revision(self):
+        """Revision of the application config rolled out to the units, the same on every unit."""
+        return config_revision({
+            key: value for key, value in self._model_config().items() if key not in FINGERPRINT_IGNORED_CONFIG
+        })
+
+    def _fingerprint(self, pb_path, tags=[], extra_vars={}, env={}, diff=False, become=True, context=False):
+        """Digest of the inputs of a playbook run, without the playbook itself if context is set."""
+        fingerprint_config = {
+            key: value for key, value in self._model_config().items() if key not in FINGERPRINT_IGNORED_CONFIG
+        }
+        if context:
+            # The config option holding the playbook is the playbook
+            fingerprint_config.pop('playbook', None)
+        return (context_fingerprint if context else fingerprint)(
+            pb_path, extra_files=[ANSIBLE_HOSTS_PATH], tags=tags,
+            extra_vars=fingerprint_extra_vars(extra_vars), env=fingerprint_env(env),
+            model_config=fingerprint_config,
+            diff=diff, become=become,
+        )
+
+    def _finish_run(self, run, throw=False):
+        """Record the fingerprint of an executed run and report its failure."""
+        request = run['request']
+        returncode, results = run['outcome']
+        if run['digest']:
+            try:
+                self.fingerprints.store(run['cache_key'], run['digest'], returncode, results)
+            except Exception as e:
+                log.warning(f"Failed to store playbook fingerprint: {e}")
+        if run.get('context'):
+            try:
+                if returncode == 0:
+                    self.planner.record(run['cache_key'], request['playbook'], run['context'])
+                else:
+                    self.planner.forget(run['cache_key'])
+            except Exception as e:
+                log.warning(f"Failed to record applied playbook: {e}")
+        self._record_history(run)
+        self._export_metrics(run)
         if returncode != 0:
-            log.error(f"Failed to run ansible playbook: {pb_path} (tags={tags})")
-            log.error(f"extra_vars:\n{extra_vars!r}")
-            log.error(f"env:\n{env!r}")
+            log.error(f"Failed to run ansible playbook: {request['playbook']} (tags={run['tags']})")
+            log.error(f"extra_vars:\n{request['extra_vars']!r}")
+            log.error(f"env:\n{request['env']!r}")
             if throw:
-                raise AnsiblePlaybookError(f"Ansible Playbook '{pb_path}' returned non-zero exit code.")
+                raise AnsiblePlaybookError(f"Ansible Playbook '{request['playbook']}' returned non-zero exit code.")
         return returncode, results
 
+    def _record_history(self, run):
+        """Add a finished run to the run history, failures are only logged."""
+        if not self.history:
+            return
+        request = run['request']
+        returncode, results = run['outcome']
+        try:
+            self.history.record(
+                hook=run.get('hook'),
+                playbook=os.path.relpath(request['playbook'], CHARM_DIR) if CHARM_DIR else request['playbook'],
+                tags=request['options'].get('tags', []),
+                started=run.get('started') or time.time(),
+                finished=time.time(),
+                returncode=returncode,
+                results=results,
+                skipped=run.get('skipped', False),
+                digest=file_digest(request['playbook']),
+            )
+        except Exception as e:
+            log.warning(f"Failed to record playbook run in the run history: {e}")
 
-class AnsiblePlaybook:
-    def __init__(
-        self, charm, model, app_name, inventory_path=ANSIBLE_HOSTS_PATH, basedir=CHARM_DIR,
-        local_tmp='/tmp', remote_tmp=ANSIBLE_REMOTE_TMP, **kw
-    ):
+    def _export_metrics(self, run):
+        """Write metrics of the unit for the node_exporter textfile collector, failures are only logged."""
+        if not self.metrics_dir or not self.state_dir:
+            return
+        returncode, results = run['outcome']
+        skipped = run.get('skipped', False)
+        queue_wait = self.queue_ticket['wait'] if self.queue_ticket and not skipped else None
+        try:
+            metrics = RunMetrics(os.path.join(self.state_dir, 'metrics.json'))
+            if not metrics.observe(
+                run['request']['options'].get('tags', []),
+                duration=time.time() - (run.get('started') or time.time()),
+                returncode=returncode,
+                results=results,
+                skipped=skipped,
+                queue_wait=queue_wait,
+            ):
+                return
+            caches = {}
+            if self.payload_cache_dir:
+                from .payload_cache import PayloadCache
+                caches['payload'] = PayloadCache(self.payload_cache_dir).totals()
+            metrics.write(
+                os.path.join(self.metrics_dir, prom_file_name(self.unit_name or self.app_name or 'unknown')),
+                labels={'unit': self.unit_name or self.app_name or 'unknown'},
+                caches=caches,
+            )
+        except Exception as e:
+            log.warning(f"Failed to write playbook run metrics: {e}")
+
+    def remove_metrics(self):
+        """Remove the metrics file of the unit, so the collector exports no stale metrics."""
+        if not self.metrics_dir:
+            return
+        try:
+            os.remove(os.path.join(self.metrics_dir, prom_file_name(self.unit_name or self.app_name or 'unknown')))
+        except FileNotFoundError:
+            pass
+
+    def run_history(self, limit=20, **filters):
+        """Return runs of the run history and their durations per tag, see history.py for filters."""
+        if not self.history:
+            return [], {}
+        return self.history.query(limit=limit, **filters), self.history.durations(**filters)
+
+
+def run_request(request, charm=None, model=None, session=None, progress=None):
+    """Execute a playbook run request built by Ansible.apply_playbook."""
+    if request.get('runs'):
+        return run_combined_request(request, charm=charm, model=model, session=session, progress=progress)
+    pb = AnsiblePlaybook(
+        charm,
+        model,
+        request['app_name'],
+        inventory_path=ANSIBLE_HOSTS_PATH,
+        connection="local",
+        basedir=CHARM_DIR,
+        session=session,
+        progress=progress,
+        **request['options']
+    )
+    return pb.run(
+        request['playbook'],
+        subset="localhost",
+        extra_vars=request['extra_vars'],
+        env=request['env'],
+        model_config=request['model_config'],
+        unit_state=request.get('unit_state'),
+    )
+
+
+def run_combined_request(request, charm=None, model=None, session=None, progress=None):
+    """Execute run requests in one PlaybookExecutor pass.
+
+    Returns (returncode, outcomes) with one (returncode, results) per run.
+    Runs not started because an earlier playbook of the pass failed are
+    executed separately afterwards, like they would be without combining.
+    """
+    from ansible import context
+    from .callbacks import PlaybookSwitchCallback
+
+    if session is None:
+        session = AnsibleSession(inventory_path=ANSIBLE_HOSTS_PATH)
+    outcomes = [(255, {})] * len(request['runs'])
+    playbooks = []
+    prepared = []
+    for index, sub in enumerate(request['runs']):
+        pb = AnsiblePlaybook(
+            charm, model, sub['app_name'], inventory_path=ANSIBLE_HOSTS_PATH, connection="local",
+            basedir=CHARM_DIR, session=session, progress=progress, **sub['options']
+        )
+        playbooks.append(pb)
+        target = pb.prepare(
+            sub['playbook'], subset="localhost", extra_vars=sub['extra_vars'],
+            model_config=sub['model_config'], unit_state=sub.get('unit_state'),
+        )
+        if target is None:
+            continue
+        hosts, extra = target
+        prepared.append((index, dict(cli_args=context.CLIARGS, extra_vars=extra, hosts=hosts)))
+    if not prepared:
+        return 255, outcomes
+
+    pb = playbooks[prepared[0][0]]
+    variable_manager = pb.variable_manager
+    scoped_extra_vars = dict(variable_manager.extra_vars)
+    switch = PlaybookSwitchCallback(variable_manager, [run for _, run in prepared])
+    try:
+        returncode, _, _ = pb._execute(
+            [request['runs'][index]['playbook'] for index, _ in prepared],
+            sorted({host for _, run in prepared for host in run['hosts']}),
+            env=request.get('env', {}),
+            callbacks=[switch],
+        )
+    finally:
+        variable_manager._extra_vars = scoped_extra_vars
+        variable_manager._nonpersistent_fact_cache.clear()
+
+    last_finished = None
+    for position, (index, _) in enumerate(prepared):
+        if position in switch.outcomes:
+            outcomes[index] = switch.outcomes[position]
+            last_finished = index
+        elif position < switch.started:
+            # Started but interrupted by an error of the executor
+            outcomes[index] = (returncode or 255, {})
+    if returncode != 0 and last_finished is not None and outcomes[last_finished][0] == 0:
+        # Failure not visible in host stats (e.g. a play error) ends the pass after this playbook
+        outcomes[last_finished] = (returncode, outcomes[last_finished][1])
+
+    for index, _ in prepared[switch.started:]:
+        sub = request['runs'][index]
+        log.info(f"Running playbook left over by the combined run: {sub['playbook']}")
+        outcomes[index] = playbooks[index].run(
+            sub['playbook'], subset="localhost", extra_vars=sub['extra_vars'], env=sub['env'],
+            model_config=sub['model_config'], unit_state=sub.get('unit_state'),
+        )
+
+    return next((returncode for returncode, _ in outcomes if returncode), 0), outcomes
+
+
+class AnsibleSession:
+    """DataLoader, inventory and variable manager shared by sequential runs.
+
+    Parsed files, inventory and plugin caches are reused by every playbook
+    run with the session, extra vars and CLI args stay scoped to one run.
+    """
+
+    def __init__(self, inventory_path=ANSIBLE_HOSTS_PATH):
         from ansible.parsing.dataloader import DataLoader
         from ansible.inventory.manager import InventoryManager
         from ansible.vars.manager import VariableManager
 
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(loader=self.loader, sources=inventory_path)
+        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
+
+
+class AnsiblePlaybook:
+    def __init__(
+        self, charm, model, app_name, inventory_path=ANSIBLE_HOSTS_PATH, basedir=CHARM_DIR,
+        local_tmp='/tmp', remote_tmp=ANSIBLE_REMOTE_TMP, cache_dir=None, session=None, progress=None, **kw
+    ):
         self.charm = charm
         self.model = model
         self.app_name = app_name
+        # Directory of the parsed playbook cache, disabled if None
+        self.cache_dir = cache_dir
+        # Directory of built AnsiballZ payloads kept across runs, disabled if None
+        self.payload_cache_dir = kw.get('payload_cache_dir')
+        # Write task timing tables next to the playbooks
+        self.task_timing = kw.get('task_timing', True)
+        # Called with batches of task progress lines during runs
+        self.progress = progress
+        # Run modules of local connections in a persistent module server
+        self.accelerate = kw.get('accelerate', False)
+        # Arguments of the DriftSlice checking this run, None for a full run
+        self.drift = kw.get('drift')
+        # Paths (file:line) of the only tasks to run, None for all
+        self.only_tasks = kw.get('only_tasks')
 
         self.whichpython = sys.executable
-        self.loader = DataLoader()
+        if session is None:
+            session = AnsibleSession(inventory_path=inventory_path)
+        self.loader = session.loader
         if basedir and os.path.exists(basedir):
             self.loader.set_basedir(basedir)
-
-        self.inventory = InventoryManager(loader=self.loader, sources=inventory_path)
-        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
+        self.inventory = session.inventory
+        self.variable_manager = session.variable_manager
 
         try:
             self.verbosity = int(kw.get('verbosity', 0))
@@ -160,6 +994,9 @@ class AnsiblePlaybook:
             log.error(e)
             self.verbosity = 0
 
+        # Defaults of forks and task timeout come from the config the charm generates
+        from ansible import constants as C
+
         self._cli_args = dict(
             listtags=kw.get('listtags', False),
             listtasks=kw.get('listtasks', False),
@@ -167,7 +1004,7 @@ class AnsiblePlaybook:
             connection=kw.get('connection', 'ssh'),
             connection_password_file=kw.get('connection_password_file', None),
             module_path=kw.get('module_path', None),
-            forks=kw.get('forks', 10),
+            forks=kw.get('forks', C.DEFAULT_FORKS),
             remote_user=kw.get('remote_user', None),
             private_key_file=kw.get('private_key_file', None),
             host_key_checking=kw.get('host_key_checking', True),
@@ -183,13 +1020,14 @@ class AnsiblePlaybook:
             tags=kw.get('tags', []),
             skip_tags=kw.get('skip_tags', []),
             timeout=kw.get('timeout', 30),
-            task_timeout=kw.get('task_timeout', 0),
+            task_timeout=kw.get('task_timeout', C.TASK_TIMEOUT),
             force_handlers=kw.get('force_handlers', False),
             flush_cache=kw.get('flush_cache', False),
             check=kw.get('check', False),
             diff=kw.get('diff', False),
             syntax=kw.get('syntax', False),
             start_at_task=kw.get('start_at_task', None),
+            step=kw.get('step', False),
             verbosity=self.verbosity,
             # Added tmp
             local_tmp=local_tmp,
@@ -205,17 +1043,51 @@ class AnsiblePlaybook:
 
     def run(
         self, playbook_path, subset=None, extra_vars={}, passwords={}, env={},
-        verbosity=0, debug=False, debug_executor=False, **kw
+        verbosity=0, debug=False, debug_executor=False, model_config=None, unit_state=None, **kw
     ):
+        target = self.prepare(
+            playbook_path, subset=subset, extra_vars=extra_vars, verbosity=verbosity,
+            debug=debug, model_config=model_config, unit_state=unit_state, **kw
+        )
+        if target is None:
+            return 255, {}
+        hosts, extra = target
+
+        scoped_extra_vars = dict(self.variable_manager.extra_vars)
+        try:
+            self.variable_manager.extra_vars.update(extra)
+            returncode, results, executor = self._execute(
+                [playbook_path], hosts, passwords=passwords, env=env, debug=debug,
+            )
+        finally:
+            # Extra vars and registered facts must not leak into the next run of a session
+            self.variable_manager._extra_vars = scoped_extra_vars
+            self.variable_manager._nonpersistent_fact_cache.clear()
+
+        if debug_executor:
+            return returncode, results, executor
+
+        return returncode, results
+
+    def prepare(
+        self, playbook_path, subset=None, extra_vars={}, verbosity=0, debug=False, model_config=None,
+        unit_state=None, **kw
+    ):
+        """Write host vars, set CLI args and resolve target hosts of a playbook.
+
+        Returns (hosts, extra_vars) or None if the playbook can not run.
+        """
         from ansible import context
         try:
             from ansible.utils.display import initialize_locale
         except Exception:
             from ansible.cli import initialize_locale
-        from ansible.executor.playbook_executor import PlaybookExecutor, display
+        from ansible.executor.playbook_executor import display
         from ansible.playbook import Playbook
 
-        if self.model and hasattr(self.model, 'config'):
+        if model_config is not None:
+            model_config = dict(deepcopy(model_config))
+        elif self.model and hasattr(self.model, 'config'):
             model_config = dict(deepcopy(self.model.config))
             model_config['app_name'] = self.app_name
         else:
@@ -223,9 +1095,11 @@ class AnsiblePlaybook:
 
         extra = juju_state_to_yaml(
             ANSIBLE_VARS_PATH, model_config=model_config, namespace_separator='__',
-            allow_hyphens_in_keys=False, mode=(stat.S_IRUSR | stat.S_IWUSR)
+            allow_hyphens_in_keys=False, mode=(stat.S_IRUSR | stat.S_IWUSR), unit_state=unit_state,
         )
         extra.update(extra_vars)
+        # Host vars were rewritten, a shared loader must read them again
+        self.loader._FILE_CACHE.pop(ANSIBLE_VARS_PATH, None)
 
         try:
             display.verbosity = int(verbosity) if verbosity > self.verbosity else int(self.verbosity)
@@ -236,14 +1110,43 @@ class AnsiblePlaybook:
         initialize_locale()
         if not os.path.exists(playbook_path):
             log.error(f"Ansible Playbook does not exist: {playbook_path}")
-            return 255, {}
+            return None
 
-        try:
-            p = Playbook.load(playbook_path, variable_manager=self.variable_manager, loader=self.loader)
-        except Exception as e:
-            log.error(e)
-            log.error("File is not a valid Ansible Playbook")
-            return 255, {}
+        load_start = time.monotonic()
+        parsed_cache = None
+        cached = None
+        if self.cache_dir:
+            from ansible.release import __version__ as ansible_version
+            parsed_cache = ParsedPlaybookCache(self.cache_dir, ansible_version)
+            cached = parsed_cache.load(playbook_path)
+
+        if cached:
+            # Executor loads the playbook from these instead of parsing the files again
+            self.loader._FILE_CACHE.update(cached['files'])
+            patterns = set(cached['patterns'])
+        else:
+            loaded_before = set(self.loader._FILE_CACHE)
+            try:
+                p = Playbook.load(playbook_path, variable_manager=self.variable_manager, loader=self.loader)
+            except Exception as e:
+                log.error(e)
+                log.error("File is not a valid Ansible Playbook")
+                return None
+            try:
+                patterns = {play.hosts for play in p.get_plays()}
+            except Exception as e:
+                log.warning(e, exc_info=True)
+                patterns = set()
+            if parsed_cache and patterns:
+                try:
+                    parsed_cache.store(playbook_path, {
+                        path: data for path, data in self.loader._FILE_CACHE.items() if path not in loaded_before
+                    }, patterns)
+                except Exception as e:
+                    log.warning(f"Failed to cache parsed playbook: {e}")
+        log.debug("Parsed playbook cache {}: {} loaded in {:.3f}s".format(
+            'hit' if cached else 'miss', playbook_path, time.monotonic() - load_start,
+        ))
 
         if subset:
             self.inventory.subset(subset)
@@ -251,7 +1154,6 @@ class AnsiblePlaybook:
             self.inventory.subset(None)
 
         try:
-            patterns = {play.hosts for play in p.get_plays()}
             # Create deduplicated list of hosts
             hosts = list({host.name for pattern in patterns for host in self.inventory.get_hosts(pattern=pattern)})
         except Exception as e:
@@ -260,15 +1162,33 @@ class AnsiblePlaybook:
 
         if not hosts:
             log.error(f"No hosts found: subset={subset} patterns={','.join(patterns)}")
-            return 255, {}
+            return None
 
         if debug:
             log.info(f"Target hosts: {hosts}")
 
-        for key, value in extra.items():
-            self.variable_manager.extra_vars[key] = value
-        self.variable_manager.extra_vars['ansible_check_mode'] = True if context.CLIARGS['check'] else False
+        extra['ansible_check_mode'] = True if context.CLIARGS['check'] else False
+        return hosts, extra
 
+    def _execute(self, playbook_paths, hosts, passwords={}, env={}, debug=False, callbacks=()):
+        """Run playbooks with one PlaybookExecutor, return (returncode, results, executor)."""
+        from ansible.executor.playbook_executor import PlaybookExecutor
+        from .callbacks import ProgressCallback
+        from .callbacks import TaskTimingCallback
+
+        if self.task_timing:
+            callbacks = [TaskTimingCallback(path=timing_path)] + list(callbacks)
+        progress = None
+        if self.progress:
+            progress = ProgressCallback(self.progress, interval=PROGRESS_INTERVAL)
+            callbacks = list(callbacks) + [progress]
+
+        returncode = 255
+        executor = None
+        accelerator = None
+        payload_cache = None
+        drift_slice = None
+        task_filter = None
         whichpython_original = os.getenv("WHICHPYTHON")
 
         try:
@@ -280,11 +1200,34 @@ class AnsiblePlaybook:
 
             for key, value in env.items():
                 os.environ[key] = value if isinstance(value, str) else str(value)
+            if self.payload_cache_dir:
+                from .payload_cache import PayloadCache
+
+                payload_cache = PayloadCache(self.payload_cache_dir, interpreter=self.whichpython)
+                payload_cache.install()
+            if self.accelerate:
+                from .accelerate import Accelerator
+
+                accelerator = Accelerator(cwd=CHARM_DIR)
+                accelerator.start()
+            if self.drift:
+                from .drift import DriftSlice
+
+                drift_slice = DriftSlice(**self.drift)
+                drift_slice.install()
+                callbacks = list(callbacks) + [drift_slice.callback]
+            if self.only_tasks is not None:
+                from .planner import TaskFilter
+
+                task_filter = TaskFilter(self.only_tasks)
+                task_filter.install()
             executor = PlaybookExecutor(
-                playbooks=[playbook_path], inventory=self.inventory,
+                playbooks=playbook_paths, inventory=self.inventory,
                 variable_manager=self.variable_manager, loader=self.loader,
                 passwords=passwords
             )
+            if executor._tqm:
+                executor._tqm._callback_plugins.extend(callbacks)
             returncode = executor.run()
             if debug:
                 log.info(f"Task status: returncode={returncode} success={(returncode == 0)}")
@@ -296,20 +1239,51 @@ class AnsiblePlaybook:
             else:
                 os.environ.pop('WHICHPYTHON', None)
             os.environ.pop('ANSIBLE_PYTHON_INTERPRETER', None)
+            if accelerator:
+                accelerator.stop()
+            if payload_cache:
+                payload_cache.uninstall()
+            if task_filter:
+                task_filter.uninstall()
+                log.info(f"Skipped {task_filter.skipped} unchanged tasks")
+            if drift_slice:
+                drift_slice.uninstall()
+                try:
+                    drift_slice.finish(failed=(returncode != 0))
+                except Exception as e:
+                    log.error(f"Failed to record drift check slice: {e}")
+            if progress:
+                # Lines of an interrupted run must not be sent after it returned
+                progress.flush()
+            if payload_cache:
+                self._report_payload_cache(payload_cache.stats())
+                try:
+                    # Exported as cache hit rate by the metrics of the unit
+                    payload_cache.add_totals(payload_cache.stats())
+                except Exception as e:
+                    log.warning(f"Failed to update AnsiballZ payload cache totals: {e}")
 
         try:
             results = {}
-            if executor._tqm and hosts:
+            if executor and executor._tqm and hosts:
                 for host in hosts:
                     results[host] = executor._tqm._stats.summarize(host)
                 executor._tqm.cleanup()
         except Exception as e:
             log.error(e)
 
-        if debug_executor:
-            return returncode, results, executor
+        return returncode, results, executor
 
-        return returncode, results
+    def _report_payload_cache(self, stats):
+        built = stats['hits'] + stats['misses']
+        if not built:
+            return
+        message = "AnsiballZ payload cache: {} of {} payloads reused ({:.0%}), {} KiB not rebuilt".format(
+            stats['hits'], built, stats['hits'] / built, stats['bytes_saved'] // 1024,
+        )
+        log.info(message)
+        if self.progress:
+            self.progress(message)
 
 
 def dict_keys_without_hyphens(a_dict):
@@ -318,34 +1292,7 @@ def dict_keys_without_hyphens(a_dict):
         (key.replace('-', '_'), val) for key, val in a_dict.items())
 
 
-cache = {}
-
-
-def cached(func):
-    """Cache return values for multiple executions of func + args
-    For example::
-        @cached
-        def unit_get(attribute):
-            pass
-        unit_get('test')
-    will cache the result of unit_get + 'test' for future calls.
-    """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
-        try:
-            return cache[key]
-        except KeyError:
-            pass  # Drop out of the exception handler scope.
-        res = func(*args, **kwargs)
-        cache[key] = res
-        return res
-    wrapper._wrapped = func
-    return wrapper
-
-
-@cached
+@memoize(maxsize=8)
 def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
@@ -355,9 +1302,18 @@ def unit_get(attribute):
         return None
 
 
+def unit_state_from_hook():
+    """Return unit name and addresses, only available in a hook context."""
+    return {
+        'local_unit': os.environ['JUJU_UNIT_NAME'],
+        'unit_private_address': unit_get('private-address'),
+        'unit_public_address': unit_get('public-address'),
+    }
+
+
 def juju_state_to_yaml(
     yaml_path, model_config={}, namespace_separator=':',
-    allow_hyphens_in_keys=True, mode=None
+    allow_hyphens_in_keys=True, mode=None, unit_state=None
 ):
     """Update the juju config and state in a yaml file.
     This includes any current relation-get data, and the charm
@@ -370,21 +1326,15 @@ def juju_state_to_yaml(
     By default, hyphens are allowed in keys as this is supported
     by yaml, but for tools like ansible, hyphens are not valid [1].
     [1] http://www.ansibleworks.com/docs/playbooks_variables.html#what-makes-a-valid-variable-name
+
+    Outside of a hook, pass unit_state from unit_state_from_hook() of the hook.
     """
     config = model_config
 
     # Add the CHARM_DIR which we will need to refer to charm
     # file resources etc.
     config['charm_dir'] = CHARM_DIR
-    config['local_unit'] = os.environ['JUJU_UNIT_NAME']
-    config['unit_private_address'] = unit_get('private-address')
-    config['unit_public_address'] = unit_get('public-address')
-
-    # Don't use non-standard tags for unicode which will not
-    # work when salt uses yaml.safe_load.
-    yaml.add_representer(
-        str, lambda dumper, value: dumper.represent_scalar('tag:yaml.org,2002:str', value)
-    )
+    config.update(unit_state or unit_state_from_hook())
 
     yaml_dir = os.path.dirname(yaml_path)
     if not os.path.exists(yaml_dir):
@@ -392,7 +1342,7 @@ def juju_state_to_yaml(
 
     if os.path.exists(yaml_path):
         with open(yaml_path, "r") as existing_vars_file:
-            existing_vars = yaml.safe_load(existing_vars_file.read())
+            existing_vars = yaml_io.safe_load(existing_vars_file) or {}
     else:
         with open(yaml_path, "w+"):
             pass
@@ -408,6 +1358,6 @@ def juju_state_to_yaml(
     # update_relations(existing_vars, namespace_separator)
 
     with open(yaml_path, "w+") as fp:
-        fp.write(yaml.dump(existing_vars, default_flow_style=False))
+        yaml_io.safe_dump(existing_vars, fp)
 
     return existing_vars
@@ -0,0 +1,112 @@
+"""
+Shared apt metadata freshness
+=============================
+
+Track when apt package lists were last refreshed on the machine, so
+co-located units do not each download and parse the indexes.
+
+.. code-block:: python
+
+    from .apt_cache import AptCache
+
+    apt_cache = AptCache(window=3600)
+    apt_cache.refresh()      # apt-get update only if lists are older than window
+    apt_cache.is_fresh()     # True within window of the last refresh
+
+The last refresh is the newest of the apt lists directory, the stamp of
+periodic apt updates and the stamp written by this module after a
+successful ``apt-get update``. Refreshes are serialized by an ``flock`` and
+freshness is checked again once the lock is held, so units waiting for the
+same refresh do not repeat it.
+
+"""
+
+import fcntl
+import logging
+import os
+import subprocess
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds apt lists are considered fresh after a refresh
+APT_CACHE_WINDOW = 3600
+# Seconds an apt-get update may take
+APT_UPDATE_TIMEOUT = 600
+APT_LISTS_DIR = '/var/lib/apt/lists'
+APT_PERIODIC_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+# Kept across reboots, apt lists are too
+APT_STATE_DIR = '/var/lib/charm-ansible'
+APT_UPDATE_COMMAND = ('apt-get', 'update', '-q')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class AptCache:
+    """Machine-wide freshness of apt package lists."""
+
+    def __init__(self, window=APT_CACHE_WINDOW, state_dir=APT_STATE_DIR, lists_dir=APT_LISTS_DIR):
+        self.window = window
+        self.state_dir = state_dir
+        self.lists_dir = lists_dir
+
+    @property
+    def stamp_path(self):
+        return os.path.join(self.state_dir, 'apt-update.stamp')
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.state_dir, 'apt-update.lock')
+
+    def last_refresh(self):
+        """Return time of the last refresh of apt lists, None if unknown."""
+        times = [_mtime(path) for path in (self.lists_dir, APT_PERIODIC_STAMP, self.stamp_path)]
+        times = [value for value in times if value is not None]
+        return max(times) if times else None
+
+    def age(self):
+        last = self.last_refresh()
+        return None if last is None else max(0.0, time.time() - last)
+
+    def is_fresh(self):
+        if not self.window:
+            return False
+        age = self.age()
+        return age is not None and age < self.window
+
+    def refresh(self, force=False):
+        """Run apt-get update unless lists are fresh, return True if it ran.
+
+        Raises subprocess.CalledProcessError or TimeoutExpired if the update fails.
+        """
+        if not force and (not self.window or self.is_fresh()):
+            return False
+        os.makedirs(self.state_dir, mode=0o755, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            started = time.monotonic()
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            waited = time.monotonic() - started
+            # Another unit may have refreshed the lists while this one waited
+            if not force and self.is_fresh():
+                log.info(f"Apt lists were refreshed by another unit while waiting {waited:.1f}s")
+                return False
+            log.info("Refreshing apt lists")
+            try:
+                subprocess.run(
+                    APT_UPDATE_COMMAND, check=True, timeout=APT_UPDATE_TIMEOUT,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    env=dict(os.environ, DEBIAN_FRONTEND='noninteractive'),
+                )
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                stderr = (e.stderr or b'').decode('utf-8', 'replace').strip()
+                log.error(f"Failed to refresh apt lists: {e}: {stderr}")
+                raise
+            with open(self.stamp_path, 'w') as f:
+                f.write(str(time.time()))
+            log.info(f"Refreshed apt lists in {time.monotonic() - started - waited:.1f}s")
+        return True
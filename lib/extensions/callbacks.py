@@ -0,0 +1,361 @@
+"""
+Ansible callbacks
+=================
+
+Callback objects attached to the task queue manager of a run. This module
+imports Ansible, import it only where Ansible is already loaded.
+
+.. code-block:: python
+
+    from .callbacks import PlaybookSwitchCallback, TaskTimingCallback
+
+    timing = TaskTimingCallback(path=lambda playbook: playbook + '.timing.json')
+    executor._tqm._callback_plugins.append(timing)
+    executor.run()
+    timing.tables  # [{'playbook': path, 'duration': 3.2, 'tasks': [...]}]
+
+    switch = PlaybookSwitchCallback(variable_manager, [
+        dict(cli_args=cli_args, extra_vars=extra, hosts=hosts),
+        ...
+    ])
+    executor._tqm._callback_plugins.append(switch)
+    executor.run()
+    switch.outcomes  # {index: (returncode, results)}
+
+    progress = ProgressCallback(event.log, interval=3)
+    executor._tqm._callback_plugins.append(progress)
+
+    drift = DriftCallback()
+    executor._tqm._callback_plugins.append(drift)
+    executor.run()   # check mode
+    drift.changed, drift.failed  # [{'name': ..., 'path': ..., 'host': ...}]
+
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from ansible import context
+from ansible.plugins.callback import CallbackBase
+
+log = logging.getLogger(__name__)
+
+# Lines of one progress message, the rest is summarized
+PROGRESS_MAX_LINES = 20
+
+# Return codes of TaskQueueManager
+RUN_OK = 0
+RUN_FAILED_HOSTS = 2
+RUN_UNREACHABLE_HOSTS = 4
+
+
+class PlaybookSwitchCallback(CallbackBase):
+    """Apply per-playbook CLI args and extra vars in a multi-playbook executor pass.
+
+    PlaybookExecutor loads and runs playbooks one after another with the same
+    CLI args and variables. Before each playbook starts, its own CLI args (tags,
+    diff, check, become) and extra vars are set. After it ends, stats of its
+    hosts are recorded as the difference to the totals of the previous playbook.
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'charm_playbook_switch'
+
+    def __init__(self, variable_manager, runs):
+        super().__init__()
+        self.variable_manager = variable_manager
+        self.runs = runs
+        self.base_extra_vars = dict(variable_manager.extra_vars)
+        self.started = 0
+        self.outcomes = {}
+        self._totals = {}
+
+    def v2_playbook_on_start(self, playbook):
+        index = self.started
+        self.started += 1
+        if index >= len(self.runs):
+            log.warning(f"Unexpected playbook in combined run: {playbook._file_name}")
+            return
+        run = self.runs[index]
+        context.CLIARGS = run['cli_args']
+        # Plays read tags of the CLI args when they are loaded, before this callback
+        for play in playbook.get_plays():
+            play.only_tags = set(run['cli_args'].get('tags', [])) or frozenset(('all',))
+            play.skip_tags = set(run['cli_args'].get('skip_tags', []))
+        extra_vars = dict(self.base_extra_vars)
+        extra_vars.update(run['extra_vars'])
+        self.variable_manager._extra_vars = extra_vars
+        # Registered facts of the previous playbook are not visible in a separate run
+        self.variable_manager._nonpersistent_fact_cache.clear()
+
+    def v2_playbook_on_stats(self, stats):
+        index = self.started - 1
+        if index < 0 or index >= len(self.runs) or index in self.outcomes:
+            return
+        results = {}
+        for host in self.runs[index]['hosts']:
+            summary = stats.summarize(host)
+            previous = self._totals.get(host, {})
+            results[host] = {key: value - previous.get(key, 0) for key, value in summary.items()}
+            self._totals[host] = summary
+        returncode = RUN_OK
+        if any(result.get('failures') for result in results.values()):
+            returncode = RUN_FAILED_HOSTS
+        elif any(result.get('unreachable') for result in results.values()):
+            returncode = RUN_UNREACHABLE_HOSTS
+        self.outcomes[index] = (returncode, results)
+
+
+class TaskTimingCallback(CallbackBase):
+    """Record wall time, result counts and loop items of every task and handler.
+
+    A table per playbook is kept in tables and written as JSON to the file
+    path(playbook_path) returns when the playbook ends, if path is set. With the linear strategy a task
+    ends with its last host result, or when the next task starts.
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'charm_task_timing'
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        self.tables = []
+        self._table = None
+        self._tasks = {}
+        self._current = None
+
+    def v2_playbook_on_start(self, playbook):
+        self._table = dict(
+            playbook=os.path.abspath(playbook._file_name),
+            started=time.time(),
+            _start=time.monotonic(),
+            tasks=[],
+        )
+        self._tasks = {}
+        self._current = None
+
+    def _start_task(self, task, handler=False):
+        if self._table is None:
+            return
+        now = time.monotonic()
+        self._end_current(now)
+        entry = dict(
+            name=task.get_name(),
+            path=task.get_path(),
+            action=task.action,
+            handler=handler,
+            duration=0.0,
+            ok=0, changed=0, failed=0, skipped=0, unreachable=0, ignored=0, items=0,
+            _start=now, _end=None,
+        )
+        self._tasks[task._uuid] = entry
+        self._table['tasks'].append(entry)
+        self._current = entry
+
+    def _end_current(self, now):
+        if self._current and self._current['_end'] is None:
+            self._current['_end'] = now
+            self._current['duration'] = round(now - self._current['_start'], 4)
+
+    def _task_result(self, result, status):
+        entry = self._tasks.get(result._task._uuid)
+        if entry is None:
+            return
+        entry[status] += 1
+        if status == 'ok' and result._result.get('changed', False):
+            entry['changed'] += 1
+        now = time.monotonic()
+        entry['_end'] = now
+        entry['duration'] = round(now - entry['_start'], 4)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start_task(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start_task(task, handler=True)
+
+    def v2_runner_on_ok(self, result):
+        self._task_result(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._task_result(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._task_result(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._task_result(result, 'unreachable')
+
+    def _item_result(self, result):
+        entry = self._tasks.get(result._task._uuid)
+        if entry is not None:
+            entry['items'] += 1
+
+    def v2_runner_item_on_ok(self, result):
+        self._item_result(result)
+
+    def v2_runner_item_on_failed(self, result):
+        self._item_result(result)
+
+    def v2_runner_item_on_skipped(self, result):
+        self._item_result(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if self._table is None:
+            return
+        now = time.monotonic()
+        self._end_current(now)
+        table = {key: value for key, value in self._table.items() if not key.startswith('_')}
+        table['duration'] = round(now - self._table['_start'], 4)
+        table['tasks'] = [
+            {key: value for key, value in entry.items() if not key.startswith('_')}
+            for entry in self._table['tasks']
+        ]
+        self.tables.append(table)
+        self._table = None
+        if self.path:
+            self._write(table)
+
+    def _write(self, table):
+        path = self.path(table['playbook'])
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(table, f, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            log.warning(f"Failed to write task timing table {path}: {e}")
+
+
+class ProgressCallback(CallbackBase):
+    """Forward task progress to sink(message) in rate limited batches.
+
+    Lines of task starts and results are buffered and sent as one message at
+    most once per interval seconds. The first event after a quiet period is
+    sent right away and pending lines are sent by a timer, so a long running
+    task is reported when it starts, not when the next one does. A batch
+    longer than max_lines keeps its last lines and the number of left out ones.
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'charm_progress'
+
+    def __init__(self, sink, interval=3.0, max_lines=PROGRESS_MAX_LINES):
+        super().__init__()
+        self.sink = sink
+        self.interval = interval
+        self.max_lines = max_lines
+        self._lines = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._last_flush = 0.0
+        self._starts = {}
+
+    def _add(self, line):
+        with self._lock:
+            self._lines.append(line)
+            wait = self._last_flush + self.interval - time.monotonic()
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            lines, self._lines = self._lines, []
+            if not lines:
+                return
+            self._last_flush = time.monotonic()
+            if len(lines) > self.max_lines:
+                left_out = len(lines) - self.max_lines + 1
+                lines = [f"... {left_out} earlier lines"] + lines[-(self.max_lines - 1):]
+            try:
+                self.sink('\n'.join(lines))
+            except Exception as e:
+                log.warning(f"Failed to send playbook progress: {e}")
+
+    def _start(self, task, kind='TASK'):
+        self._starts[task._uuid] = time.monotonic()
+        self._add(f"{kind} [{task.get_name()}]")
+
+    def _result(self, result, status):
+        started = self._starts.get(result._task._uuid)
+        elapsed = f" ({time.monotonic() - started:.1f}s)" if started else ''
+        if status == 'ok' and result._result.get('changed', False):
+            status = 'changed'
+        line = f"{status}: [{result._host.get_name()}] {result._task.get_name()}{elapsed}"
+        if status in ('failed', 'unreachable') and result._result.get('msg'):
+            line = f"{line}: {result._result['msg']}"
+        self._add(line)
+
+    def v2_playbook_on_play_start(self, play):
+        self._add(f"PLAY [{play.get_name()}]")
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start(task, kind='HANDLER')
+
+    def v2_runner_on_ok(self, result):
+        self._result(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._result(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._result(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        with self._lock:
+            for host in sorted(stats.processed):
+                summary = ' '.join(f"{key}={value}" for key, value in stats.summarize(host).items())
+                self._lines.append(f"RECAP [{host}] {summary}")
+        self.flush()
+
+
+class DriftCallback(CallbackBase):
+    """Collect tasks a check mode run would change (drift) and tasks which failed."""
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'charm_drift'
+
+    def __init__(self):
+        super().__init__()
+        self.changed = []
+        self.failed = []
+
+    def _entry(self, result, msg=False):
+        task = result._task
+        entry = dict(name=task.get_name(), path=task.get_path() or '', host=result._host.get_name())
+        if msg and result._result.get('msg'):
+            entry['msg'] = str(result._result['msg'])
+        return entry
+
+    def v2_runner_on_ok(self, result):
+        if result._result.get('changed', False):
+            self.changed.append(self._entry(result))
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        if not ignore_errors:
+            self.failed.append(self._entry(result, msg=True))
+
+    def v2_runner_on_unreachable(self, result):
+        self.failed.append(self._entry(result, msg=True))
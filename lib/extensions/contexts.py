@@ -2,9 +2,7 @@
 
 import os
 
-import six
-import yaml
-
+from . import yaml_io
 from .core import hookenv
 
 charm_dir = os.environ.get('CHARM_DIR', '')
@@ -41,19 +39,13 @@ def juju_state_to_yaml(
     config['unit_private_address'] = hookenv.unit_private_ip()
     config['unit_public_address'] = hookenv.unit_private_ip()
 
-    # Don't use non-standard tags for unicode which will not
-    # work when salt uses yaml.safe_load.
-    yaml.add_representer(six.text_type,
-                         lambda dumper, value: dumper.represent_scalar(
-                             six.u('tag:yaml.org,2002:str'), value))
-
     yaml_dir = os.path.dirname(yaml_path)
     if not os.path.exists(yaml_dir):
         os.makedirs(yaml_dir)
 
     if os.path.exists(yaml_path):
         with open(yaml_path, "r") as existing_vars_file:
-            existing_vars = yaml.safe_load(existing_vars_file.read())
+            existing_vars = yaml_io.safe_load(existing_vars_file) or {}
     else:
         with open(yaml_path, "w+"):
             pass
@@ -69,4 +61,4 @@ def juju_state_to_yaml(
     # update_relations(existing_vars, namespace_separator)
 
     with open(yaml_path, "w+") as fp:
-        fp.write(yaml.dump(existing_vars, default_flow_style=False))
+        yaml_io.safe_dump(existing_vars, fp)
@@ -23,46 +23,17 @@ from __future__ import print_function
 import json
 import os
 import subprocess
-from functools import wraps
 
-from yaml import safe_load
+from .. import memoize
+from ..yaml_io import safe_load
 
-cache = {}
-
-
-def cached(func):
-    """Cache return values for multiple executions of func + args
-    For example::
-        @cached
-        def unit_get(attribute):
-            pass
-        unit_get('test')
-    will cache the result of unit_get + 'test' for future calls.
-    """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
-        try:
-            return cache[key]
-        except KeyError:
-            pass  # Drop out of the exception handler scope.
-        res = func(*args, **kwargs)
-        cache[key] = res
-        return res
-    wrapper._wrapped = func
-    return wrapper
+# Cache return values for multiple executions of func + args, see memoize.py
+cached = memoize.memoize
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes cached values of the function named key"""
+    memoize.flush(key)
 
 
 def local_unit():
@@ -120,7 +91,7 @@ def opened_ports():
     return json.loads(subprocess.check_output(_args).decode('UTF-8'))
 
 
-@cached
+@cached(maxsize=8)
 def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
@@ -138,14 +109,14 @@ def charm_dir():
     return os.environ.get('CHARM_DIR')
 
 
-@cached
+@cached(persist=True)
 def metadata():
     """Get the current charm metadata.yaml contents as a python object"""
     with open(os.path.join(charm_dir(), 'metadata.yaml')) as md:
         return safe_load(md)
 
 
-@cached
+@cached(persist=True)
 def charm_name():
     """Get the name of the current charm as is specified on metadata.yaml"""
     return metadata().get('name')
@@ -0,0 +1,192 @@
+"""
+Sliced drift detection
+======================
+
+Check a playbook for drift in check mode a slice at a time, so a frequent
+hook like ``update-status`` stays inside a fixed budget however large the
+playbook is. Each slice resumes at the task the previous one stopped at.
+
+.. code-block:: python
+
+    from .drift import DriftSlice
+    from .drift import DriftState
+
+    drift_slice = DriftSlice('/path/to/drift.json', digest, max_tasks=20, seconds=30, uses=['result'])
+    drift_slice.install()
+    try:
+        executor.run()   # check mode, step mode
+    finally:
+        drift_slice.uninstall()
+        drift_slice.finish()
+    DriftState('/path/to/drift.json').load()['last']  # last complete pass
+
+Tasks are numbered in the order the strategy asks to run them in step mode.
+Tasks before the position of the slice are skipped without running, except
+includes and tasks setting facts or variables, which shape the tasks and
+variables that follow, and tasks registering a result later tasks use
+(``uses``, all registering tasks when it is not known). The slice stops once
+it ran ``max_tasks`` tasks or after ``seconds``, replayed tasks included.
+When the time is up before the position, the remaining tasks before it are
+not replayed, and the slice runs a single task. Tasks using what they would
+have set may then fail and are reported as errors. A pass is complete when
+a slice reaches the end of the playbook, changed tasks of the pass are its
+drift.
+
+"""
+
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# Drift and errors kept per pass
+DRIFT_MAX_TASKS = 100
+
+
+def _new_pass(digest, now):
+    return dict(digest=digest, started=now, slices=0, checked=0, drift=[], errors=[])
+
+
+class DriftState:
+    """Position and findings of drift checks, stored as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except ValueError:
+            log.warning(f"Drift state is corrupted, starting a new pass: {self.path}")
+            state = {}
+        state.setdefault('position', 0)
+        state.setdefault('current', None)
+        state.setdefault('last', None)
+        return state
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DriftSlice:
+    """One time-budgeted slice of a check mode pass over a playbook."""
+
+    def __init__(self, state_path, digest=None, max_tasks=20, seconds=30, uses=None):
+        self.state = DriftState(state_path)
+        self.digest = digest
+        self.max_tasks = max_tasks
+        self.seconds = seconds
+        # Variables the tasks of the playbook use, None if not known
+        self.uses = None if uses is None else set(uses)
+        # Tasks the strategies asked to run, the next one is at this position
+        self.taken = 0
+        self.ran = 0
+        # Tasks before the position which ran again, until the time was up
+        self.replayed = 0
+        self.replay_stopped = False
+        self.stopped = False
+        self.started = None
+        self.callback = None
+        self._state = None
+        self._original = None
+
+    def _take_step(self, strategy, task, host=None):
+        from ansible import constants as C
+
+        if self.stopped:
+            return False
+        position = self.taken
+        self.taken += 1
+        if position < self._state['position']:
+            # Includes, variables and registered results shape the tasks and conditions that follow
+            replay = task.action in C._ACTION_ALL_INCLUDES + C._ACTION_INCLUDE_VARS + C._ACTION_SET_FACT + \
+                C._ACTION_FACT_GATHERING or bool(task.register and (self.uses is None or task.register in self.uses))
+            if not replay or self.replay_stopped:
+                return False
+            if self.seconds and time.monotonic() - self.started >= self.seconds:
+                log.warning(f"Drift check slice ran out of time after replaying {self.replayed} tasks")
+                self.replay_stopped = True
+                return False
+            self.replayed += 1
+            return True
+        # Every slice runs a task at least, so passes always end
+        elapsed = time.monotonic() - self.started
+        if self.ran and (self.ran >= self.max_tasks or (self.seconds and elapsed >= self.seconds)):
+            self.stopped = True
+            self.taken -= 1
+            strategy._tqm.terminate()
+            return False
+        self.ran += 1
+        return True
+
+    def install(self):
+        """Load the state and skip or stop tasks of strategies created from now on."""
+        from ansible.plugins.strategy import StrategyBase
+        from .callbacks import DriftCallback
+
+        now = time.time()
+        self._state = self.state.load()
+        current = self._state['current']
+        if current is None or current.get('digest') != self.digest:
+            if current is not None:
+                log.info("Playbook changed during a drift check pass, starting a new pass")
+            self._state['position'] = 0
+            self._state['current'] = _new_pass(self.digest, now)
+        self.started = time.monotonic()
+        self.callback = DriftCallback()
+        drift_slice = self
+
+        def take_step(strategy, task, host=None):
+            return drift_slice._take_step(strategy, task, host)
+
+        self._original = StrategyBase._take_step
+        StrategyBase._take_step = take_step
+
+    def uninstall(self):
+        from ansible.plugins.strategy import StrategyBase
+
+        if self._original is not None:
+            StrategyBase._take_step = self._original
+            self._original = None
+
+    def finish(self, failed=False):
+        """Record the slice, return the state."""
+        state = self._state
+        current = state['current']
+        current['slices'] += 1
+        current['checked'] += self.ran
+        for key, found in (('drift', self.callback.changed), ('errors', self.callback.failed)):
+            known = {(entry['path'], entry['host']) for entry in current[key]}
+            for entry in found:
+                if (entry['path'], entry['host']) not in known and len(current[key]) < DRIFT_MAX_TASKS:
+                    current[key].append(entry)
+        if self.stopped:
+            state['position'] = self.taken
+            log.info(f"Drift check slice stopped after {self.ran} tasks, next slice starts at task {state['position']}")
+        else:
+            current['finished'] = time.time()
+            current['failed'] = failed
+            current['tasks'] = self.taken
+            state['last'] = current
+            state['position'] = 0
+            state['current'] = None
+            log.info("Drift check pass finished: {} tasks would change, {} failed".format(
+                len(current['drift']), len(current['errors']),
+            ))
+        self.state.save(state)
+        return state
@@ -0,0 +1,226 @@
+"""
+Playbook input fingerprints
+===========================
+
+Skip playbook runs when none of their inputs changed since the last
+successful run.
+
+.. code-block:: python
+
+    from .fingerprint import FingerprintCache, fingerprint
+
+    cache = FingerprintCache('/path/to/fingerprints.json')
+    digest = fingerprint('playbook.yaml', tags=['config'], extra_vars={})
+    if not cache.is_fresh('playbook.yaml:config', digest):
+        ...  # run the playbook
+        cache.store('playbook.yaml:config', digest, returncode, results)
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from . import yaml_io
+
+log = logging.getLogger(__name__)
+
+# Keys whose values point to files loaded by the playbook
+REFERENCE_KEYS = {
+    'import_playbook', 'include', 'include_tasks', 'import_tasks', 'include_vars',
+    'vars_files', 'src', 'file',
+}
+ROLE_KEYS = {'include_role', 'import_role'}
+# Directories searched for relative references (next to the playbook first)
+REFERENCE_DIRS = ('', 'tasks', 'templates', 'files', 'vars', 'handlers')
+# Environment variables that change in every hook and never affect a playbook,
+# ANSIBLE_CONFIG is set by the charm itself once it generated its config
+VOLATILE_ENV_PREFIXES = ('JUJU_', 'OPERATOR_')
+VOLATILE_ENV_KEYS = {'PWD', 'OLDPWD', '_', 'SHLVL', 'SUDO_COMMAND', 'ANSIBLE_CONFIG'}
+# Extra vars describing the machine at the time of a run, not what the playbook converges to
+VOLATILE_EXTRA_VARS = {'apt_cache_fresh'}
+
+
+def file_digest(path):
+    """Return sha256 of a file or a directory tree, None when missing."""
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                sha.update(os.path.relpath(file_path, path).encode('utf-8'))
+                sha.update((file_digest(file_path) or '').encode('utf-8'))
+        return sha.hexdigest()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha.update(chunk)
+    except OSError:
+        return None
+    return sha.hexdigest()
+
+
+def _strip_fqcn(key):
+    for prefix in ('ansible.builtin.', 'ansible.legacy.'):
+        if isinstance(key, str) and key.startswith(prefix):
+            return key[len(prefix):]
+    return key
+
+
+def _candidates(value):
+    if isinstance(value, str):
+        # Templated paths can not be resolved without variables
+        if '{{' not in value and '{%' not in value:
+            yield value.split()[0] if value.strip() else value
+    elif isinstance(value, list):
+        for item in value:
+            yield from _candidates(item)
+
+
+def _resolve(reference, basedir):
+    if os.path.isabs(reference):
+        # Never walk host directories such as 'src: /'
+        return reference if os.path.isfile(reference) else None
+    for subdir in REFERENCE_DIRS:
+        path = os.path.normpath(os.path.join(basedir, subdir, reference))
+        if os.path.isfile(path) or (os.path.isdir(path) and path.startswith(basedir + os.sep)):
+            return path
+    role_path = os.path.normpath(os.path.join(basedir, 'roles', reference))
+    if os.path.isdir(role_path):
+        return role_path
+    return None
+
+
+def _walk(data, basedir, found):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            key = _strip_fqcn(key)
+            if key in REFERENCE_KEYS:
+                for reference in _candidates(value):
+                    path = _resolve(reference, basedir)
+                    if path and path not in found:
+                        found.add(path)
+                        if path.endswith(('.yaml', '.yml')) and os.path.isfile(path):
+                            _walk(load_references(path), os.path.dirname(path), found)
+            roles = []
+            if key == 'roles' and isinstance(value, list):
+                roles = value
+            elif key in ROLE_KEYS:
+                roles = [value]
+            for role in roles:
+                role_name = role.get('role', role.get('name')) if isinstance(role, dict) else role
+                for reference in _candidates(role_name):
+                    path = _resolve(os.path.join('roles', reference), basedir)
+                    if path:
+                        found.add(path)
+            _walk(value, basedir, found)
+    elif isinstance(data, list):
+        for item in data:
+            _walk(item, basedir, found)
+
+
+def load_references(path):
+    """Parse a yaml file for reference scanning, None if not parseable."""
+    try:
+        with open(path, 'r') as f:
+            return yaml_io.safe_load(f)
+    except Exception as e:
+        log.debug(f"Skipping references of {path}: {e}")
+        return None
+
+
+def referenced_files(playbook_path):
+    """Return sorted paths of files and role directories used by a playbook.
+
+    This is a best effort static scan, templated paths are not followed.
+    """
+    found = set()
+    _walk(load_references(playbook_path), os.path.dirname(os.path.abspath(playbook_path)), found)
+    found.discard(os.path.abspath(playbook_path))
+    return sorted(found)
+
+
+def fingerprint_env(env):
+    """Return the subset of environment which may affect a playbook run."""
+    return {
+        key: value for key, value in env.items()
+        if key not in VOLATILE_ENV_KEYS and not key.startswith(VOLATILE_ENV_PREFIXES)
+    }
+
+
+def fingerprint_extra_vars(extra_vars):
+    """Return the subset of extra vars which may affect a playbook run."""
+    return {key: value for key, value in extra_vars.items() if key not in VOLATILE_EXTRA_VARS}
+
+
+def fingerprint(playbook_path, extra_files=(), **inputs):
+    """Return sha256 over a playbook, files it references and run inputs."""
+    sha = hashlib.sha256()
+    sha.update((file_digest(playbook_path) or '').encode('utf-8'))
+    sha.update(context_fingerprint(playbook_path, extra_files=extra_files, **inputs).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def context_fingerprint(playbook_path, extra_files=(), **inputs):
+    """Return sha256 over files a playbook references and run inputs, but not the playbook itself."""
+    sha = hashlib.sha256()
+    for path in list(referenced_files(playbook_path)) + list(extra_files):
+        sha.update(path.encode('utf-8'))
+        sha.update((file_digest(path) or '').encode('utf-8'))
+    sha.update(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class FingerprintCache:
+    """Persistent map of run key to the fingerprint of its last run."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning(f"Ignoring unreadable fingerprint cache {self.path}: {e}")
+            return {}
+
+    def _save(self, entries):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        return self._load().get(key)
+
+    def is_fresh(self, key, digest):
+        """True if the last run of key succeeded with the same fingerprint."""
+        entry = self.get(key)
+        return bool(entry) and entry.get('fingerprint') == digest and entry.get('returncode') == 0
+
+    def store(self, key, digest, returncode, results):
+        entries = self._load()
+        if returncode == 0:
+            entries[key] = {
+                'fingerprint': digest,
+                'returncode': returncode,
+                'results': results,
+                'timestamp': time.time(),
+            }
+        else:
+            # Failed runs are always retried
+            entries.pop(key, None)
+        self._save(entries)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,209 @@
+"""
+Run history
+===========
+
+Keep the outcome of playbook runs in a SQLite database in the charm state
+directory, to find slow hooks and the last runs which changed something.
+
+.. code-block:: python
+
+    from .history import RunHistory
+
+    history = RunHistory('/path/to/history.sqlite', max_runs=10000)
+    history.record(
+        hook='config-changed', playbook='playbook.yaml', tags=['config'], started=started, finished=time.time(),
+        returncode=0, results={'localhost': {'ok': 4, 'changed': 1, ...}}, digest=file_digest('playbook.yaml'),
+    )
+    history.query(tag='config', since=time.time() - 86400, limit=20)  # newest first
+    history.durations(since=time.time() - 86400)  # {'config': {'runs': 12, 'p50': 3.1, 'p95': 8.2, ...}}
+
+Runs are indexed by start time and by each of their tags (untagged runs by
+``all``). Only the newest ``max_runs`` runs are kept. Runs skipped by the
+charm are recorded, but left out of durations.
+
+"""
+
+import json
+import logging
+import math
+import os
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_RUNS = 10000
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hook TEXT,
+        playbook TEXT NOT NULL,
+        tags TEXT NOT NULL,
+        started REAL NOT NULL,
+        finished REAL NOT NULL,
+        returncode INTEGER,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        changed INTEGER NOT NULL DEFAULT 0,
+        stats TEXT NOT NULL,
+        digest TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+    """CREATE TABLE IF NOT EXISTS run_tags (
+        tag TEXT NOT NULL,
+        started REAL NOT NULL,
+        run_id INTEGER NOT NULL,
+        PRIMARY KEY (tag, started, run_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS run_tags_run_id ON run_tags (run_id)",
+)
+COLUMNS = (
+    'id', 'hook', 'playbook', 'tags', 'started', 'finished', 'returncode', 'skipped', 'changed', 'stats', 'digest',
+)
+
+
+def current_hook():
+    """Name of the hook or action the charm runs, None outside of Juju."""
+    dispatch = os.environ.get('JUJU_DISPATCH_PATH')
+    if dispatch:
+        kind, _, name = dispatch.partition('/')
+        return f"action:{name}" if kind == 'actions' else name
+    return os.environ.get('JUJU_HOOK_NAME') or None
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class RunHistory:
+    """SQLite table of playbook runs."""
+
+    def __init__(self, path, max_runs=DEFAULT_MAX_RUNS):
+        self.path = path
+        self.max_runs = max_runs
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=10)
+        # Jobs and hooks write runs at the same time
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        return db
+
+    def record(
+        self, playbook, tags, started, finished, returncode, results, hook=None, skipped=False, digest=None,
+    ):
+        """Store a run, return its id."""
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        tags = sorted({tag.strip() for tag in tags or () if tag.strip()}) or ['all']
+        results = results or {}
+        changed = sum(int(stats.get('changed', 0)) for stats in results.values() if isinstance(stats, dict))
+        db = self._connect()
+        try:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO runs (hook, playbook, tags, started, finished, returncode, skipped, changed, stats,'
+                    ' digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (hook, playbook, ','.join(tags), started, finished, returncode, int(bool(skipped)), changed,
+                     json.dumps(results, sort_keys=True, default=str), digest),
+                )
+                run_id = cursor.lastrowid
+                db.executemany(
+                    'INSERT INTO run_tags (tag, started, run_id) VALUES (?, ?, ?)',
+                    [(tag, started, run_id) for tag in tags],
+                )
+                if self.max_runs:
+                    db.execute('DELETE FROM runs WHERE id <= ?', (run_id - self.max_runs,))
+                    db.execute('DELETE FROM run_tags WHERE run_id <= ?', (run_id - self.max_runs,))
+        finally:
+            db.close()
+        return run_id
+
+    def _select(self, columns, by_tag=False, tag=None, hook=None, since=None, until=None, failed=None,
+                skipped=None):
+        """Build the query of runs matching the filters, with a row per tag of a run if by_tag is set."""
+        if by_tag or tag:
+            query = f"SELECT {columns} FROM run_tags JOIN runs ON runs.id = run_tags.run_id WHERE 1"
+            started = 'run_tags.started'
+        else:
+            query = f"SELECT {columns} FROM runs WHERE 1"
+            started = 'runs.started'
+        args = []
+        if tag:
+            query += " AND run_tags.tag = ?"
+            args.append(tag)
+        if since is not None:
+            query += f" AND {started} >= ?"
+            args.append(since)
+        if until is not None:
+            query += f" AND {started} < ?"
+            args.append(until)
+        if hook:
+            query += " AND runs.hook = ?"
+            args.append(hook)
+        if failed is not None:
+            query += " AND runs.returncode != 0" if failed else " AND runs.returncode = 0"
+        if skipped is not None:
+            query += " AND runs.skipped = ?"
+            args.append(int(bool(skipped)))
+        return query + f" ORDER BY {started} DESC, runs.id DESC", args
+
+    def _fetch(self, query, args):
+        if not os.path.exists(self.path):
+            return []
+        db = self._connect()
+        try:
+            return db.execute(query, args).fetchall()
+        finally:
+            db.close()
+
+    def query(self, limit=20, **filters):
+        """Return runs matching the filters (tag, hook, since, until, failed, skipped), newest first."""
+        query, args = self._select(', '.join(f"runs.{column}" for column in COLUMNS), **filters)
+        if limit:
+            query += " LIMIT ?"
+            args.append(int(limit))
+        runs = []
+        for row in self._fetch(query, args):
+            run = dict(zip(COLUMNS, row))
+            run['tags'] = run['tags'].split(',')
+            run['stats'] = json.loads(run['stats'])
+            run['skipped'] = bool(run['skipped'])
+            run['duration'] = run['finished'] - run['started']
+            runs.append(run)
+        return runs
+
+    def durations(self, **filters):
+        """Return runs, failures, changed tasks and p50/p95/max duration per tag of executed runs."""
+        query, args = self._select(
+            'run_tags.tag, runs.finished - runs.started, runs.returncode, runs.changed',
+            by_tag=True, **dict(filters, skipped=False),
+        )
+        by_tag = {}
+        for tag, duration, returncode, changed in self._fetch(query, args):
+            tag_runs = by_tag.setdefault(tag, {'durations': [], 'failed': 0, 'changed': 0})
+            tag_runs['durations'].append(duration)
+            tag_runs['failed'] += int(returncode != 0)
+            tag_runs['changed'] += changed
+        summary = {}
+        for tag, tag_runs in sorted(by_tag.items()):
+            values = sorted(tag_runs['durations'])
+            summary[tag] = {
+                'runs': len(values),
+                'failed': tag_runs['failed'],
+                'changed': tag_runs['changed'],
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1],
+            }
+        return summary
+
+    def clear(self):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,214 @@
+"""
+Asynchronous playbook jobs
+==========================
+
+Playbook runs executed by a worker detached from the hook, so a long run
+does not hold the action slot of the unit.
+
+.. code-block:: python
+
+    from .jobs import JobStore
+
+    jobs = JobStore('/path/to/jobs')
+    job_id = jobs.create(run)
+    jobs.start(job_id, cwd=charm_dir)
+    ...
+    jobs.get(job_id)  # {'status': 'running', ...}
+    jobs.tail(job_id, 'progress.log', lines=20)
+
+Every job is a directory with the run (``run.json``), its state
+(``job.json``), progress messages (``progress.log``) and the output of the
+worker (``output.log``). Finished jobs are removed when there are more than
+``retention`` of them or when they are older than ``max_age`` seconds.
+Jobs wait for their turn in the machine run queue like hooks do.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from . import runner
+from .runner import _pid_alive
+
+log = logging.getLogger(__name__)
+
+# Finished jobs kept in the store
+JOB_RETENTION = 20
+# Seconds finished jobs are kept in the store
+JOB_MAX_AGE = 7 * 24 * 3600
+# Job states, the first two are not finished
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+# Worker died without recording the end of the job
+JOB_LOST = 'lost'
+# Scheduled run not started while the previous one still ran
+JOB_SKIPPED = 'skipped'
+
+
+class JobNotFound(Exception):
+    """Exception - Job does not exist in the store."""
+
+    pass
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+class JobStore:
+    """Directory of asynchronous playbook jobs."""
+
+    def __init__(self, path, retention=JOB_RETENTION, max_age=JOB_MAX_AGE):
+        self.path = path
+        self.retention = retention
+        self.max_age = max_age
+
+    def _dir(self, job_id):
+        # Job ids are used in paths, never follow anything else
+        if not job_id or os.sep in job_id or job_id.startswith('.'):
+            raise JobNotFound(f"Invalid job id: {job_id}")
+        return os.path.join(self.path, job_id)
+
+    def create(self, run):
+        """Store a planned run as a new pending job, return its id."""
+        job_id = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S', time.gmtime()), uuid.uuid4().hex[:6])
+        job_dir = self._dir(job_id)
+        os.makedirs(job_dir, mode=0o700)
+        _write_json(os.path.join(job_dir, 'run.json'), run)
+        request = run['request']
+        _write_json(os.path.join(job_dir, 'job.json'), dict(
+            id=job_id,
+            status=JOB_PENDING,
+            playbook=request['playbook'],
+            tags=request['options'].get('tags', []),
+            created=time.time(),
+        ))
+        self.prune()
+        return job_id
+
+    def start(self, job_id, cwd=None):
+        """Spawn the worker running the job."""
+        job_dir = self._dir(job_id)
+        pid = runner.spawn('jobs', ['--job', job_dir], cwd=cwd, log_path=os.path.join(job_dir, 'output.log'))
+        self.update(job_id, pid=pid)
+        log.info(f"Started playbook job {job_id} (pid={pid})")
+        return pid
+
+    def load_run(self, job_id):
+        with open(os.path.join(self._dir(job_id), 'run.json'), 'r') as f:
+            return json.load(f)
+
+    def get(self, job_id):
+        """Return the state of a job, a job with a dead worker is reported lost."""
+        try:
+            with open(os.path.join(self._dir(job_id), 'job.json'), 'r') as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            raise JobNotFound(f"Job does not exist: {job_id}")
+        if job['status'] in (JOB_PENDING, JOB_RUNNING) and job.get('pid') and not _pid_alive(job['pid']):
+            job['status'] = JOB_LOST
+        return job
+
+    def update(self, job_id, **fields):
+        job_path = os.path.join(self._dir(job_id), 'job.json')
+        with open(job_path, 'r') as f:
+            job = json.load(f)
+        job.update(fields)
+        _write_json(job_path, job)
+        return job
+
+    def list(self):
+        """Return states of all jobs, newest first."""
+        jobs = []
+        try:
+            names = sorted(os.listdir(self.path), reverse=True)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            try:
+                jobs.append(self.get(name))
+            except (JobNotFound, ValueError, OSError):
+                continue
+        # Ids of jobs created in the same second do not sort by time
+        return sorted(jobs, key=lambda job: job.get('created', 0), reverse=True)
+
+    def append_progress(self, job_id, message):
+        with open(os.path.join(self._dir(job_id), 'progress.log'), 'a') as f:
+            f.write(message.rstrip('\n') + '\n')
+
+    def tail(self, job_id, name, lines=20):
+        """Return the last lines of a log file of the job."""
+        try:
+            with open(os.path.join(self._dir(job_id), name), 'r', errors='replace') as f:
+                content = f.read().splitlines()
+        except FileNotFoundError:
+            return ''
+        return '\n'.join(content[-lines:]) if lines else ''
+
+    def prune(self):
+        """Remove finished jobs beyond retention and older than max_age."""
+        now = time.time()
+        finished = [job for job in self.list() if job['status'] not in (JOB_PENDING, JOB_RUNNING)]
+        for index, job in enumerate(finished):
+            if index >= self.retention or now - job.get('created', now) > self.max_age:
+                shutil.rmtree(self._dir(job['id']), ignore_errors=True)
+                log.debug(f"Removed playbook job {job['id']}")
+
+
+def run_job(job_dir):
+    """Execute the job stored in job_dir, called by the worker."""
+    from .ansible_playbook import Ansible
+    from .ansible_playbook import run_request
+
+    store = JobStore(os.path.dirname(job_dir))
+    job_id = os.path.basename(job_dir)
+    run = store.load_run(job_id)
+    store.update(job_id, status=JOB_RUNNING, pid=os.getpid(), started=time.time())
+
+    manager = Ansible()
+    manager.state_dir = run.get('state_dir', manager.state_dir)
+    manager.run_queue.max_hold = run.get('max_hold', manager.run_queue.max_hold)
+    manager.history_runs = run.get('history_runs', manager.history_runs)
+    manager.metrics_dir = run.get('metrics_dir')
+    manager.unit_name = run.get('owner')
+    status = JOB_FAILED
+    fields = {}
+
+    def progress(message):
+        store.append_progress(job_id, message)
+
+    try:
+        with manager.run_queue.slot(run.get('owner') or job_id, progress=progress) as ticket:
+            manager.queue_ticket = ticket
+            if ticket:
+                fields.update(queue_wait=ticket['wait'], queue_depth=ticket['depth'])
+            run['started'] = time.time()
+            run['outcome'] = tuple(run_request(run['request'], progress=progress))
+        returncode, results = manager._finish_run(run)
+        status = JOB_SUCCEEDED if returncode == 0 else JOB_FAILED
+        fields.update(returncode=returncode, results=results)
+        fields['slowest_tasks'] = manager.task_timings(run['request']['playbook'], top=10)
+    except Exception as e:
+        log.error(e, exc_info=True)
+        fields['error'] = str(e)
+    finally:
+        store.update(job_id, status=status, finished=time.time(), **fields)
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--job', required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    run_job(args.job)
@@ -0,0 +1,235 @@
+"""
+Memoization
+===========
+
+Cache return values of functions per arguments, with a size limit per
+function, optional expiry and an optional store keeping values of later
+hooks.
+
+.. code-block:: python
+
+    from . import memoize
+
+    @memoize.memoize(maxsize=8, ttl=60)
+    def unit_get(attribute):
+        ...
+
+    @memoize.memoize(persist=True)
+    def metadata():
+        ...
+
+    unit_get.flush()           # forget values of one function
+    memoize.flush('unit_get')  # the same by name
+    memoize.stats()            # {'extensions.core.hookenv.unit_get': {'hits': 3, 'misses': 1, 'size': 1}}
+
+The least recently used value is dropped once a function holds ``maxsize``
+values. Values with ``persist=True`` are written to a JSON store (next to the
+charm state by default, see ``set_store``) and must be JSON values which stay
+valid until the store is cleared, for example on charm upgrade.
+
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAXSIZE = 128
+CHARM_DIR = os.getenv('CHARM_DIR', None)
+STORE_PATH = os.path.join(CHARM_DIR, '.charm-ansible', 'memoize.json') if CHARM_DIR else None
+
+# Caches by full and short function name
+_caches = {}
+_store = None
+
+
+class _Store:
+    """Values of persisted functions, stored as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+            except Exception as e:
+                log.warning(f"Ignoring unreadable memoize store {self.path}: {e}")
+                self._data = {}
+        return self._data
+
+    def get(self, name, key):
+        with self._lock:
+            return self._load().get(name, {}).get(key)
+
+    def _write(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.warning(f"Failed to write memoize store {self.path}: {e}")
+
+    def put(self, name, key, entry):
+        try:
+            json.dumps(entry)
+        except (TypeError, ValueError) as e:
+            log.warning(f"Not persisting a value of {name}: {e}")
+            return
+        with self._lock:
+            self._load().setdefault(name, {})[key] = entry
+            self._write()
+
+    def flush(self, name):
+        with self._lock:
+            if self._load().pop(name, None) is not None:
+                self._write()
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class _Cache:
+    """LRU cache of the values of one function."""
+
+    def __init__(self, name, maxsize, ttl, persist):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, args, kwargs):
+        if self.persist:
+            return json.dumps((args, kwargs), sort_keys=True, default=str)
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = json.dumps((args, kwargs), sort_keys=True, default=str)
+        return key
+
+    def get(self, key):
+        """Return (True, value) of a live entry or (False, None)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+        if self.persist and _get_store():
+            entry = _get_store().get(self.name, key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                with self._lock:
+                    self._put(key, entry)
+                    self.hits += 1
+                return True, entry[0]
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while self.maxsize and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        entry = [value, time.time() + self.ttl if self.ttl else None]
+        with self._lock:
+            self._put(key, entry)
+        if self.persist and _get_store():
+            _get_store().put(self.name, key, entry)
+
+    def flush(self):
+        with self._lock:
+            self._entries.clear()
+        if self.persist and _get_store():
+            _get_store().flush(self.name)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+def _get_store():
+    global _store
+    if _store is None and STORE_PATH:
+        _store = _Store(STORE_PATH)
+    return _store
+
+
+def set_store(path):
+    """Keep values of persisted functions in the JSON file at path, None to keep them in memory only."""
+    global _store, STORE_PATH
+    STORE_PATH = path
+    _store = _Store(path) if path else None
+
+
+def clear_store():
+    """Remove all persisted values, of this and later hooks."""
+    if _get_store():
+        _get_store().clear()
+    for caches in list(_caches.values()):
+        for cache in caches:
+            if cache.persist:
+                with cache._lock:
+                    cache._entries.clear()
+
+
+def memoize(func=None, maxsize=DEFAULT_MAXSIZE, ttl=None, persist=False):
+    """Cache return values of func per arguments, use as ``@memoize`` or ``@memoize(maxsize=8)``."""
+    if func is None:
+        return lambda func: memoize(func, maxsize=maxsize, ttl=ttl, persist=persist)
+
+    name = f"{func.__module__}.{func.__qualname__}"
+    cache = _Cache(name, maxsize, ttl, persist)
+    for index in {name, func.__name__}:
+        _caches.setdefault(index, []).append(cache)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = cache.key(args, kwargs)
+        found, value = cache.get(key)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        cache.put(key, value)
+        return value
+    wrapper._wrapped = func
+    wrapper.flush = cache.flush
+    wrapper.stats = cache.stats
+    return wrapper
+
+
+def flush(name):
+    """Forget values of the functions with the full or short name."""
+    for cache in _caches.get(name, ()):
+        cache.flush()
+
+
+def stats():
+    """Return hits, misses and number of values of every memoized function."""
+    return {
+        cache.name: cache.stats() for caches in _caches.values() for cache in caches
+    }
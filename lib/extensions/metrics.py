@@ -0,0 +1,183 @@
+"""
+Prometheus metrics
+==================
+
+Write metrics of playbook runs to a file read by the textfile collector of
+node_exporter.
+
+.. code-block:: python
+
+    from .metrics import RunMetrics
+
+    metrics = RunMetrics('/path/to/metrics.json')
+    metrics.observe(['config'], duration=12.5, returncode=0, results={'localhost': {...}}, queue_wait=0.2)
+    metrics.write('/var/lib/prometheus/node-exporter/charm_ansible_0.prom', labels={'unit': 'ansible/0'})
+
+Counters and histograms add up the runs of the unit in a JSON state file,
+every run rewrites the whole metrics file. Runs are labelled by their
+comma separated tags (``all`` without tags), runs skipped by the charm count
+as run cache hits and only in ``charm_ansible_runs_total``.
+
+Metrics never fail a run: while another process updates the state, the
+update waits for up to ``LOCK_TIMEOUT`` seconds and is dropped after that,
+errors are left to the caller to log.
+
+"""
+
+import fcntl
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'charm_ansible'
+# Upper bounds of the run duration histogram, in seconds
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Keys of Ansible host stats (AggregateStats.summarize) by status label
+TASK_STATUSES = {'ok': 'ok', 'changed': 'changed', 'failed': 'failures', 'unreachable': 'unreachable'}
+# Seconds a run waits for another process updating the state
+LOCK_TIMEOUT = 2
+LOCK_POLL = 0.05
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_label_value(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prom_file_name(unit_name):
+    return '{}_{}.prom'.format(PREFIX, unit_name.replace('/', '_').replace('-', '_'))
+
+
+class RunMetrics:
+    """Metrics of the playbook runs of a unit."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'runs': {}, 'queue': {'last': 0, 'sum': 0, 'count': 0}, 'run_cache': {'hits': 0, 'misses': 0}}
+
+    def observe(
+        self, tags, duration, returncode, results, skipped=False, queue_wait=None, finished=None,
+    ):
+        """Add a finished run to the metrics, return False if another run held the state too long."""
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        label = ','.join(sorted({tag.strip() for tag in tags or () if tag.strip()})) or 'all'
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock:
+            deadline = time.monotonic() + LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        log.warning(f"Metrics are locked by another run, dropping run of {label}")
+                        return False
+                    time.sleep(LOCK_POLL)
+            state = self.load()
+            runs = state['runs'].setdefault(label, {
+                'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0, 'count': 0,
+                'results': {'succeeded': 0, 'failed': 0, 'skipped': 0},
+                'tasks': {status: 0 for status in TASK_STATUSES}, 'last_success': 0,
+            })
+            state['run_cache']['hits' if skipped else 'misses'] += 1
+            if skipped:
+                runs['results']['skipped'] += 1
+            else:
+                runs['results']['succeeded' if returncode == 0 else 'failed'] += 1
+                for index, bound in enumerate(DURATION_BUCKETS):
+                    if duration <= bound:
+                        runs['buckets'][index] += 1
+                runs['sum'] += duration
+                runs['count'] += 1
+                for host_stats in (results or {}).values():
+                    for status, key in TASK_STATUSES.items():
+                        runs['tasks'][status] += int(host_stats.get(key, 0))
+            if returncode == 0:
+                runs['last_success'] = finished or time.time()
+            if queue_wait is not None:
+                state['queue'] = {
+                    'last': queue_wait,
+                    'sum': state['queue']['sum'] + queue_wait,
+                    'count': state['queue']['count'] + 1,
+                }
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        return True
+
+    def render(self, labels={}, caches={}):
+        """Return the metrics in the Prometheus text format, caches maps cache names to hits and misses."""
+        state = self.load()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for suffix, sample_labels, value in samples:
+                lines.append(f"{PREFIX}_{name}{suffix}{_labels(**labels, **sample_labels)} {_number(value)}")
+
+        runs = sorted(state['runs'].items())
+        duration_samples = []
+        for tags, tag_runs in runs:
+            for bound, count in zip(DURATION_BUCKETS, tag_runs['buckets']):
+                duration_samples.append(('_bucket', {'tags': tags, 'le': str(bound)}, count))
+            duration_samples.append(('_bucket', {'tags': tags, 'le': '+Inf'}, tag_runs['count']))
+            duration_samples.append(('_sum', {'tags': tags}, tag_runs['sum']))
+            duration_samples.append(('_count', {'tags': tags}, tag_runs['count']))
+        metric('run_duration_seconds', 'histogram', 'Duration of executed playbook runs.', duration_samples)
+        metric('runs_total', 'counter', 'Playbook runs by result.', [
+            ('', {'tags': tags, 'result': result}, count)
+            for tags, tag_runs in runs for result, count in sorted(tag_runs['results'].items())
+        ])
+        metric('tasks_total', 'counter', 'Task results of executed playbook runs, summed over hosts.', [
+            ('', {'tags': tags, 'status': status}, count)
+            for tags, tag_runs in runs for status, count in tag_runs['tasks'].items()
+        ])
+        metric('last_success_timestamp_seconds', 'gauge', 'Time of the last successful playbook run.', [
+            ('', {'tags': tags}, tag_runs['last_success']) for tags, tag_runs in runs
+        ])
+        metric('queue_wait_seconds', 'summary', 'Wait of executed runs for the machine run queue.', [
+            ('_sum', {}, state['queue']['sum']),
+            ('_count', {}, state['queue']['count']),
+        ])
+        metric('last_queue_wait_seconds', 'gauge', 'Wait of the last executed run for the machine run queue.', [
+            ('', {}, state['queue']['last']),
+        ])
+        caches = dict(caches, run=state['run_cache'])
+        metric('cache_requests_total', 'counter', 'Cache lookups by result.', [
+            ('', {'cache': cache, 'result': result}, caches[cache].get(key, 0))
+            for cache in sorted(caches) for result, key in (('hit', 'hits'), ('miss', 'misses'))
+        ])
+        ratios = []
+        for cache in sorted(caches):
+            lookups = caches[cache].get('hits', 0) + caches[cache].get('misses', 0)
+            ratios.append(('', {'cache': cache}, caches[cache].get('hits', 0) / lookups if lookups else 0.0))
+        metric('cache_hit_ratio', 'gauge', 'Share of cache lookups which hit.', ratios)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prom_path, labels={}, caches={}):
+        """Replace the metrics file at once, so the collector never reads a partial file."""
+        # Written next to the target, the collector only reads *.prom files
+        tmp_path = f"{prom_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render(labels=labels, caches=caches))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, prom_path)
@@ -0,0 +1,256 @@
+"""
+Ansible module server
+=====================
+
+Persistent Python process running pipelined Ansible modules of local
+connections, so a task does not start a new interpreter and import the
+module_utils again.
+
+.. code-block:: python
+
+    from . import module_server
+
+    pid = module_server.start('/tmp/charm-ansible-modules/modules.sock')
+    rc, stdout, stderr = module_server.run_module(socket_path, dict(
+        payload=ansiballz_wrapper, env=dict(os.environ), cwd='/',
+    ))
+    module_server.stop(socket_path)
+
+The server imports ``PRELOAD_MODULES`` once and forks a child for every
+module, the child executes the AnsiballZ wrapper with its own environment,
+working directory and output files. The server exits when the process that
+started it is gone.
+
+"""
+
+import argparse
+import builtins
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+from . import runner
+from .runner import RunnerError
+from .runner import RunnerUnavailable
+from .runner import _connect
+from .runner import _pid_alive
+from .runner import _recv
+from .runner import _send
+
+log = logging.getLogger(__name__)
+
+# module_utils imported by most modules, shared by all forked children
+PRELOAD_MODULES = (
+    'ansible.module_utils.basic',
+    'ansible.module_utils.common.file',
+    'ansible.module_utils.common.process',
+    'ansible.module_utils.common.text.converters',
+    'ansible.module_utils.compat.selinux',
+    'ansible.module_utils.six',
+    'ansible.module_utils.urls',
+)
+
+
+class ModuleServerUnavailable(Exception):
+    """Exception - Module server can not run the module."""
+
+    pass
+
+
+def start(path, parent=None, cwd=None, log_path=None):
+    """Spawn the server listening on path, return its pid."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    args = ['--socket', path, '--parent', str(parent or os.getpid())]
+    return runner.spawn('module_server', args, cwd=cwd, log_path=log_path)
+
+
+def stop(path, timeout=5):
+    """Stop the server, return its counters or None if it was not running."""
+    try:
+        sock = _connect(path)
+    except RunnerUnavailable:
+        return None
+    try:
+        sock.settimeout(timeout)
+        _send(sock, {'command': 'stop'})
+        response, _ = _recv(sock)
+        return response.get('stats')
+    except (OSError, RunnerError) as e:
+        log.warning(f"Module server did not answer 'stop': {e}")
+        return None
+    finally:
+        sock.close()
+
+
+def run_module(path, request):
+    """Run a module in the server, return (rc, stdout, stderr) as bytes.
+
+    Raises ModuleServerUnavailable when the server did not accept the module,
+    the caller may then run it the usual way. Raises RunnerError when the
+    module was accepted but no result came back.
+    """
+    try:
+        sock = _connect(path)
+    except RunnerUnavailable as e:
+        raise ModuleServerUnavailable(str(e))
+    try:
+        try:
+            _send(sock, dict(request, command='run'))
+        except OSError as e:
+            raise ModuleServerUnavailable(f"Failed to send module: {e}")
+        # Modules run as long as their task does
+        sock.settimeout(None)
+        response, _ = _recv(sock)
+    finally:
+        sock.close()
+    return (
+        response['rc'],
+        response['stdout'].encode('utf-8', 'surrogateescape'),
+        response['stderr'].encode('utf-8', 'surrogateescape'),
+    )
+
+
+def _exit_status(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _execute(payload):
+    """Execute an AnsiballZ wrapper as __main__, return its exit status like the interpreter would."""
+    try:
+        exec(compile(payload, 'AnsiballZ_wrapper', 'exec'), {'__name__': '__main__', '__builtins__': builtins})
+    except SystemExit as e:
+        return _exit_status(e)
+    except BaseException:
+        # Modules may install an excepthook turning their exceptions into fail_json
+        try:
+            sys.excepthook(*sys.exc_info())
+        except SystemExit as e:
+            return _exit_status(e)
+        except BaseException:
+            traceback.print_exc()
+        return 1
+    return 0
+
+
+def _handle_module(conn, request):
+    """Run one module in a forked child, never returns."""
+    status = 0
+    try:
+        os.environ.clear()
+        os.environ.update(request.get('env', {}))
+        if request.get('cwd'):
+            os.chdir(request['cwd'])
+        stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(devnull, 0)
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        rc = _execute(request['payload'])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        stdout.seek(0)
+        stderr.seek(0)
+        _send(conn, {
+            'rc': rc,
+            'stdout': stdout.read().decode('utf-8', 'surrogateescape'),
+            'stderr': stderr.read().decode('utf-8', 'surrogateescape'),
+        })
+    except Exception:
+        status = 1
+    finally:
+        conn.close()
+        os._exit(status)
+
+
+def serve(path, parent=None):
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except ImportError as e:
+            log.warning(f"Failed to preload {module}: {e}")
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.umask(0o077)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(32)
+    server.settimeout(1)
+    log.info(f"Module server listening on {path}")
+
+    stats = dict(modules=0)
+    try:
+        _accept_loop(server, parent, stats)
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+    return stats
+
+
+def _accept_loop(server, parent, stats):
+    running = True
+    while running:
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+        if parent and os.getppid() != parent and not _pid_alive(parent):
+            log.info(f"Process {parent} which started the module server is gone")
+            return
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        try:
+            conn.settimeout(None)
+            request, _ = _recv(conn)
+            command = request.get('command')
+            if command == 'run':
+                stats['modules'] += 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if os.fork() == 0:
+                    server.close()
+                    _handle_module(conn, request)
+            elif command == 'ping':
+                _send(conn, {'pong': True, 'pid': os.getpid()})
+            elif command == 'stop':
+                _send(conn, {'stopped': True, 'stats': stats})
+                running = False
+        except Exception as e:
+            log.error(f"Failed to handle module server request: {e}")
+        finally:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--parent', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_time = time.monotonic()
+    stats = {}
+    try:
+        stats = serve(args.socket, parent=args.parent)
+    finally:
+        log.info(f"Module server exited after {time.monotonic() - start_time:.0f}s: {stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+AnsiballZ payload cache
+=======================
+
+Keep the zipped module payloads Ansible builds for its python modules on
+disk, so a run reuses the payloads of previous runs instead of walking the
+module_utils imports and compressing them again.
+
+.. code-block:: python
+
+    from .payload_cache import PayloadCache
+
+    payload_cache = PayloadCache('/path/to/cache')
+    payload_cache.install()
+    try:
+        executor.run()
+    finally:
+        payload_cache.uninstall()
+    payload_cache.stats()  # {'hits': 3, 'misses': 1, 'bytes_saved': 262144}
+
+Ansible keeps built payloads only in the temporary directory of the process
+running the playbook. While installed, a payload found in this cache is put
+there before Ansible looks for it, and a payload Ansible had to build is
+stored here. Entries are named by a digest of the module source and name, of the
+module_utils it may import and of the interpreter, so changed inputs never
+match an old entry. Module_utils of installed packages are covered by the
+package versions, other module_utils directories by the files in them.
+
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from importlib import metadata
+
+log = logging.getLogger(__name__)
+
+# Stats of all runs, next to the payloads
+TOTALS_NAME = '.totals.json'
+
+# Package distributions shipping module_utils
+MODULE_UTILS_PACKAGES = ('ansible-core', 'ansible')
+
+
+def _package_versions():
+    versions = []
+    for name in MODULE_UTILS_PACKAGES:
+        try:
+            versions.append(f"{name}=={metadata.version(name)}")
+        except metadata.PackageNotFoundError:
+            pass
+    return versions
+
+
+def local_module_utils_roots():
+    """Return directories module_utils are imported from, except those of installed packages."""
+    import ansible
+    from ansible.plugins.loader import module_utils_loader
+    from ansible.utils.collection_loader import AnsibleCollectionConfig
+
+    roots = list(module_utils_loader._get_paths(subdirs=False))
+    for path in AnsibleCollectionConfig.collection_paths or []:
+        namespaces = os.path.join(path, 'ansible_collections')
+        if not os.path.isdir(namespaces):
+            continue
+        for namespace in sorted(os.listdir(namespaces)):
+            namespace_path = os.path.join(namespaces, namespace)
+            if not os.path.isdir(namespace_path):
+                continue
+            for collection in sorted(os.listdir(namespace_path)):
+                roots.append(os.path.join(namespace_path, collection, 'plugins', 'module_utils'))
+    # Directories inside the installation of Ansible change with its packages only
+    installed = os.path.dirname(os.path.dirname(os.path.abspath(ansible.__file__))) + os.sep
+    return [root for root in roots if not root.startswith(installed)]
+
+
+def module_utils_digest(local_roots):
+    """Digest of the package versions and every file in module_utils directories of local_roots."""
+    digest = hashlib.sha256('\n'.join(_package_versions()).encode('utf-8'))
+    for root in sorted(set(local_roots)):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class PayloadCache:
+    """Content addressed on-disk cache of AnsiballZ payloads."""
+
+    def __init__(self, cache_dir, interpreter=sys.executable):
+        self.cache_dir = cache_dir
+        self.interpreter = interpreter
+        self._original = None
+        self._digests = {}
+        # Shared with the forked workers building the payloads
+        self._hits = None
+        self._misses = None
+        self._bytes_saved = None
+
+    def _module_utils_digest(self):
+        local_roots = local_module_utils_roots()
+        key = tuple(local_roots)
+        if key not in self._digests:
+            self._digests[key] = module_utils_digest(local_roots)
+        return self._digests[key]
+
+    def key(self, b_module_data, remote_module_fqn, compression):
+        """Return the entry name of a payload of the module source."""
+        digest = hashlib.sha256()
+        # The payload stores the module under its fqn, same sources of two modules differ
+        for part in (
+            hashlib.sha256(b_module_data).hexdigest(), remote_module_fqn, self._module_utils_digest(),
+            self.interpreter, sys.version, compression,
+        ):
+            digest.update(part.encode('utf-8', 'surrogateescape') + b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    @staticmethod
+    def _write(path, data):
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _count(self, counter, value=1):
+        if counter is not None:
+            with counter.get_lock():
+                counter.value += value
+
+    def _find_module_utils(
+        self, module_name, b_module_data, module_path, module_args, task_vars, templar, module_compression,
+        *args, **kwargs
+    ):
+        """Wrap module_common._find_module_utils with the cache."""
+        from ansible import constants as C
+        from ansible.executor import action_write_locks
+        from ansible.executor import module_common
+
+        original = self._original
+        try:
+            try:
+                remote_module_fqn = module_common._get_ansible_module_fqn(module_path)
+            except ValueError:
+                remote_module_fqn = 'ansible.modules.%s' % module_name
+            lookup_path = os.path.join(C.DEFAULT_LOCAL_TMP, 'ansiballz_cache')
+            cached_module_filename = os.path.join(lookup_path, "%s-%s" % (remote_module_fqn, module_compression))
+            if os.path.exists(cached_module_filename):
+                # Built or loaded earlier by this process, Ansible reuses it
+                return original(
+                    module_name, b_module_data, module_path, module_args, task_vars, templar, module_compression,
+                    *args, **kwargs
+                )
+            path = self._path(self.key(b_module_data, remote_module_fqn, module_compression))
+            lock = action_write_locks.action_write_locks.get(module_name, action_write_locks.action_write_locks[None])
+        except Exception as e:
+            log.warning(f"AnsiballZ payload cache lookup of {module_name} failed: {e}")
+            return original(
+                module_name, b_module_data, module_path, module_args, task_vars, templar, module_compression,
+                *args, **kwargs
+            )
+
+        with lock:
+            if not os.path.exists(cached_module_filename) and os.path.exists(path):
+                try:
+                    with open(path, 'rb') as f:
+                        zipdata = f.read()
+                    os.makedirs(lookup_path, exist_ok=True)
+                    self._write(cached_module_filename, zipdata)
+                    self._count(self._hits)
+                    self._count(self._bytes_saved, len(zipdata))
+                except OSError as e:
+                    log.warning(f"Failed to load cached AnsiballZ payload of {module_name}: {e}")
+
+        result = original(
+            module_name, b_module_data, module_path, module_args, task_vars, templar, module_compression,
+            *args, **kwargs
+        )
+
+        # Old style and binary modules have no payload, Ansible never writes one for them
+        with lock:
+            if os.path.exists(cached_module_filename) and not os.path.exists(path):
+                try:
+                    os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+                    with open(cached_module_filename, 'rb') as f:
+                        self._write(path, f.read())
+                    self._count(self._misses)
+                except OSError as e:
+                    log.warning(f"Failed to cache AnsiballZ payload of {module_name}: {e}")
+        return result
+
+    def install(self):
+        """Use the cache for payloads built from now on, in this process and the workers it forks."""
+        from ansible.executor import module_common
+
+        if self._original is not None:
+            return
+        self._hits = multiprocessing.Value('q', 0)
+        self._misses = multiprocessing.Value('q', 0)
+        self._bytes_saved = multiprocessing.Value('q', 0)
+        self._original = module_common._find_module_utils
+        module_common._find_module_utils = self._find_module_utils
+
+    def uninstall(self):
+        from ansible.executor import module_common
+
+        if self._original is None:
+            return
+        module_common._find_module_utils = self._original
+        self._original = None
+
+    def stats(self):
+        """Return hits, misses and bytes of payloads not built again since install."""
+        values = [counter.value if counter is not None else 0 for counter in (
+            self._hits, self._misses, self._bytes_saved,
+        )]
+        return dict(zip(('hits', 'misses', 'bytes_saved'), values))
+
+    @property
+    def totals_path(self):
+        return os.path.join(self.cache_dir, TOTALS_NAME)
+
+    def totals(self):
+        """Return hits, misses and bytes saved of all runs since the cache was cleared."""
+        try:
+            with open(self.totals_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict(hits=0, misses=0, bytes_saved=0)
+
+    def add_totals(self, stats):
+        """Add stats of a run to the totals kept in the cache directory."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Hooks, detached jobs and scheduled runs of the unit may finish at the same time
+        with open(f"{self.totals_path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = self.totals()
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+            self._write(self.totals_path, json.dumps(totals).encode('utf-8'))
+        return totals
+
+    def clear(self):
+        try:
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
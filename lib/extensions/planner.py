@@ -0,0 +1,383 @@
+"""
+Incremental playbook runs
+=========================
+
+Run only the tasks of a playbook which changed since its last successful
+run with the same tags, when nothing but the playbook itself changed.
+
+.. code-block:: python
+
+    from .planner import TaskPlanner
+
+    planner = TaskPlanner('/path/to/applied')
+    paths = planner.plan('playbook.yaml:config', 'playbook.yaml', context)
+    if paths is not None:
+        options.update(step=True, only_tasks=paths)  # ['/path/playbook.yaml:12', ...]
+    ...  # run the playbook, with a TaskFilter(paths) installed
+    planner.record('playbook.yaml:config', 'playbook.yaml', context)
+
+Tasks are compared by a digest of their definition and of the blocks and
+section they are in, and aligned like lines of a diff. Added or changed
+tasks run, together with tasks using variables defined or registered by
+them or changed in the play vars, tasks registering variables they use,
+``include_vars`` tasks and their handlers (only notified handlers run).
+Every task of a block with ``rescue`` or ``always`` runs when one of them
+does.
+
+``plan`` returns None for a full run whenever the diff is ambiguous: no
+record of the last run, other inputs (``context``) changed, plays, play
+keywords or handlers changed, a changed task includes or imports tasks, or
+play vars changed while roles, includes or imports may use them.
+
+"""
+
+import difflib
+import hashlib
+import json
+import logging
+import os
+
+import yaml
+
+from . import yaml_io
+from .fingerprint import _strip_fqcn
+
+log = logging.getLogger(__name__)
+
+PLAY_TASK_SECTIONS = ('pre_tasks', 'tasks', 'post_tasks')
+BLOCK_SECTIONS = ('block', 'rescue', 'always')
+# Actions adding tasks, roles or variables the planner can not see
+STRUCTURAL_ACTIONS = {
+    'include', 'include_tasks', 'import_tasks', 'include_role', 'import_role', 'import_playbook',
+    'include_vars', 'meta',
+}
+CONDITIONAL_KEYS = ('when', 'changed_when', 'failed_when', 'until')
+
+
+class AmbiguousPlan(Exception):
+    """Exception - Changes of a playbook can not be mapped to tasks."""
+
+    pass
+
+
+class _Mapping(dict):
+    line = None
+
+
+class _LineLoader(yaml_io.SafeLoader):
+    pass
+
+
+def _construct_mapping(loader, node):
+    mapping = _Mapping(loader.construct_mapping(node, deep=True))
+    mapping.line = node.start_mark.line + 1
+    return mapping
+
+
+_LineLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, _construct_mapping)
+
+
+def _digest(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _template_variables(value, env):
+    from jinja2 import meta
+
+    names = set()
+    if isinstance(value, dict):
+        for item in value.values():
+            names |= _template_variables(item, env)
+    elif isinstance(value, list):
+        for item in value:
+            names |= _template_variables(item, env)
+    elif isinstance(value, str) and ('{{' in value or '{%' in value):
+        names |= meta.find_undeclared_variables(env.parse(value))
+    return names
+
+
+def task_variables(task):
+    """Return names of variables a task definition uses."""
+    from jinja2 import Environment
+    from jinja2 import TemplateSyntaxError
+
+    env = Environment()
+    try:
+        names = _template_variables({key: value for key, value in task.items() if key not in CONDITIONAL_KEYS}, env)
+        for key in CONDITIONAL_KEYS:
+            conditions = task.get(key)
+            for condition in conditions if isinstance(conditions, list) else [conditions]:
+                if isinstance(condition, str):
+                    template = condition if '{{' in condition else '{{ (%s) }}' % condition
+                    names |= _template_variables(template, env)
+    except TemplateSyntaxError as e:
+        raise AmbiguousPlan(f"task at line {getattr(task, 'line', '?')} is not a valid template: {e}")
+    return names
+
+
+def _action(task):
+    """Return the action of a task definition without collection prefix, None if not known."""
+    for key in ('action', 'local_action'):
+        value = task.get(key)
+        if isinstance(value, str) and value.split():
+            return _strip_fqcn(value.split()[0])
+        if isinstance(value, dict) and 'module' in value:
+            return _strip_fqcn(value['module'])
+    keys = [_strip_fqcn(key) for key in task]
+    for key in keys:
+        if key in STRUCTURAL_ACTIONS or key == 'set_fact':
+            return key
+    return None
+
+
+def _provides(task, action):
+    names = set()
+    if isinstance(task.get('register'), str):
+        names.add(task['register'])
+    if action == 'set_fact':
+        args = next((value for key, value in task.items() if _strip_fqcn(key) == 'set_fact'), None)
+        if isinstance(args, dict):
+            names |= {key for key in args if key != 'cacheable'}
+        elif isinstance(args, str):
+            names |= {item.split('=', 1)[0] for item in args.split() if '=' in item}
+    return names
+
+
+def _flatten(items, parents, entries, group=None):
+    if not isinstance(items, list):
+        raise AmbiguousPlan("task list is not a list")
+    for item in items:
+        if not isinstance(item, dict):
+            raise AmbiguousPlan("task is not a mapping")
+        if 'block' in item:
+            keywords = {key: value for key, value in item.items() if key not in BLOCK_SECTIONS}
+            block_group = group
+            if block_group is None and (item.get('rescue') or item.get('always')):
+                block_group = item.line
+            for section in BLOCK_SECTIONS:
+                if item.get(section):
+                    _flatten(item[section], parents + [dict(keywords, section=section)], entries, block_group)
+            continue
+        action = _action(item)
+        entries.append(dict(
+            line=item.line,
+            digest=_digest({'task': item, 'parents': parents}),
+            action=action,
+            uses=task_variables(item),
+            provides=_provides(item, action),
+            group=group,
+        ))
+
+
+def load_plays(playbook_path):
+    """Return plays of a playbook with their normalized tasks."""
+    with open(playbook_path, 'r') as f:
+        data = yaml.load(f, Loader=_LineLoader)
+    if not isinstance(data, list):
+        raise AmbiguousPlan("playbook is not a list of plays")
+    plays = []
+    for play in data:
+        if not isinstance(play, dict):
+            raise AmbiguousPlan("play is not a mapping")
+        entries = []
+        for section in PLAY_TASK_SECTIONS:
+            if play.get(section):
+                _flatten(play[section], [{'section': section}], entries)
+        variables = play.get('vars') or {}
+        if not isinstance(variables, dict):
+            raise AmbiguousPlan("play vars are not a mapping")
+        settings = {
+            key: value for key, value in play.items() if key not in PLAY_TASK_SECTIONS + ('handlers', 'vars')
+        }
+        plays.append(dict(
+            settings=_digest(settings),
+            handlers=_digest(play.get('handlers') or []),
+            vars={name: _digest(value) for name, value in variables.items()},
+            var_uses={name: task_variables({'value': value}) for name, value in variables.items()},
+            # Roles, imports and includes may use play vars where they can not be seen
+            opaque=bool(play.get('roles') or 'import_playbook' in play or any(
+                entry['action'] in STRUCTURAL_ACTIONS for entry in entries
+            )),
+            tasks=entries,
+        ))
+    return plays
+
+
+def playbook_uses(playbook_path):
+    """Return names of variables the tasks of a playbook use, None if roles or includes hide tasks."""
+    try:
+        plays = load_plays(playbook_path)
+    except AmbiguousPlan as e:
+        log.info(f"Variables used by {playbook_path} are not known: {e}")
+        return None
+    if any(play['opaque'] for play in plays):
+        return None
+    return set().union(*(entry['uses'] for play in plays for entry in play['tasks']))
+
+
+def _select(old, new):
+    """Return indexes of tasks of a play to run."""
+    if old['settings'] != new['settings']:
+        raise AmbiguousPlan("play keywords changed")
+    if old['handlers'] != new['handlers']:
+        raise AmbiguousPlan("handlers changed")
+    changed_vars = {
+        name for name in set(old['vars']) | set(new['vars']) if old['vars'].get(name) != new['vars'].get(name)
+    }
+    # Vars defined with changed vars change too
+    while True:
+        dependent = {name for name, uses in new['var_uses'].items() if uses & changed_vars} - changed_vars
+        if not dependent:
+            break
+        changed_vars |= dependent
+    if changed_vars and new['opaque']:
+        raise AmbiguousPlan(f"play vars changed ({', '.join(sorted(changed_vars))}) and roles or includes may use them")
+    entries = new['tasks']
+    matcher = difflib.SequenceMatcher(None, old['tasks'], [entry['digest'] for entry in entries], autojunk=False)
+    selected = set()
+    for tag, _, _, j1, j2 in matcher.get_opcodes():
+        if tag in ('replace', 'insert'):
+            selected.update(range(j1, j2))
+    provided = set(changed_vars)
+    for index, entry in enumerate(entries):
+        if index in selected or entry['uses'] & provided:
+            selected.add(index)
+            provided |= entry['provides']
+    for index in selected:
+        if entries[index]['action'] in STRUCTURAL_ACTIONS:
+            raise AmbiguousPlan(f"changed task at line {entries[index]['line']} adds tasks or variables")
+    groups = {entries[index]['group'] for index in selected} - {None}
+    selected |= {index for index, entry in enumerate(entries) if entry['group'] in groups}
+    # Tasks registering or setting variables the selected tasks use
+    pending = sorted(selected)
+    while pending:
+        index = pending.pop()
+        for name in entries[index]['uses']:
+            producer = next((k for k in range(index - 1, -1, -1) if name in entries[k]['provides']), None)
+            if producer is not None and producer not in selected:
+                selected.add(producer)
+                pending.append(producer)
+    if selected:
+        # Variables they load are not known, any selected task may use them
+        selected |= {index for index, entry in enumerate(entries) if entry['action'] == 'include_vars'}
+    return selected
+
+
+class TaskPlanner:
+    """Records of applied playbooks and the tasks to run for a new version."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _record_path(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def plan(self, key, playbook_path, context):
+        """Return task paths to run, None for a full run."""
+        try:
+            with open(self._record_path(key), 'r') as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            log.info(f"Running all tasks of {playbook_path}: no record of the last run")
+            return None
+        except Exception as e:
+            log.warning(f"Running all tasks of {playbook_path}: unreadable record of the last run: {e}")
+            return None
+        try:
+            if record.get('context') != context:
+                raise AmbiguousPlan("inputs besides the playbook changed")
+            plays = load_plays(playbook_path)
+            if len(plays) != len(record.get('plays', [])):
+                raise AmbiguousPlan("plays were added or removed")
+            path = os.path.realpath(playbook_path)
+            paths = []
+            total = 0
+            for old, new in zip(record['plays'], plays):
+                total += len(new['tasks'])
+                for index in sorted(_select(old, new)):
+                    paths.append(f"{path}:{new['tasks'][index]['line']}")
+        except AmbiguousPlan as e:
+            log.info(f"Running all tasks of {playbook_path}: {e}")
+            return None
+        except Exception as e:
+            log.warning(f"Running all tasks of {playbook_path}: failed to plan incremental run: {e}")
+            return None
+        log.info(f"Running {len(paths)} of {total} tasks of {playbook_path} changed since the last run")
+        return paths
+
+    def record(self, key, playbook_path, context):
+        """Record the playbook of a successful run."""
+        try:
+            plays = load_plays(playbook_path)
+        except Exception as e:
+            log.info(f"Not recording tasks of {playbook_path} for incremental runs: {e}")
+            self.forget(key)
+            return
+        record = dict(context=context, plays=[dict(
+            settings=play['settings'],
+            handlers=play['handlers'],
+            vars=play['vars'],
+            tasks=[entry['digest'] for entry in play['tasks']],
+        ) for play in plays])
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        record_path = self._record_path(key)
+        tmp_path = f"{record_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, record_path)
+
+    def forget(self, key):
+        try:
+            os.remove(self._record_path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        try:
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+class TaskFilter:
+    """Run only tasks at the given paths (and notified handlers) in step mode."""
+
+    def __init__(self, paths):
+        self.paths = {self._normalize(path) for path in paths}
+        self.skipped = 0
+        self._original = None
+
+    @staticmethod
+    def _normalize(path):
+        file_name, _, line = (path or '').rpartition(':')
+        return f"{os.path.realpath(file_name)}:{line}" if file_name else path
+
+    def _take_step(self, strategy, task, host=None):
+        from ansible import constants as C
+        from ansible.playbook.handler import Handler
+
+        if isinstance(task, Handler) or task.action in C._ACTION_FACT_GATHERING:
+            return True
+        if self._normalize(task.get_path()) in self.paths:
+            return True
+        self.skipped += 1
+        return False
+
+    def install(self):
+        from ansible.plugins.strategy import StrategyBase
+
+        task_filter = self
+
+        def take_step(strategy, task, host=None):
+            return task_filter._take_step(strategy, task, host)
+
+        self._original = StrategyBase._take_step
+        StrategyBase._take_step = take_step
+
+    def uninstall(self):
+        from ansible.plugins.strategy import StrategyBase
+
+        if self._original is not None:
+            StrategyBase._take_step = self._original
+            self._original = None
@@ -0,0 +1,100 @@
+"""
+Parsed playbook cache
+=====================
+
+Keep the parsed YAML of a playbook and every file loaded with it on disk,
+so warm runs skip YAML parsing and the validation load of the playbook.
+
+.. code-block:: python
+
+    from .playbook_cache import ParsedPlaybookCache
+
+    cache = ParsedPlaybookCache('/path/to/cache', ansible_version='2.14.0')
+    entry = cache.load(playbook_path)
+    if entry:
+        loader._FILE_CACHE.update(entry['files'])
+    else:
+        ...  # Playbook.load(playbook_path, loader=loader, ...)
+        cache.store(playbook_path, loader._FILE_CACHE, patterns)
+
+An entry is used only if the Ansible version and the content of every
+cached file still match, so any change of the inputs invalidates it.
+
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+
+from .fingerprint import file_digest
+
+log = logging.getLogger(__name__)
+
+
+def _has_vault(data):
+    from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode
+    if isinstance(data, AnsibleVaultEncryptedUnicode):
+        return True
+    if isinstance(data, dict):
+        return any(_has_vault(value) for value in data.values())
+    if isinstance(data, list):
+        return any(_has_vault(item) for item in data)
+    return False
+
+
+class ParsedPlaybookCache:
+    """On-disk cache of DataLoader file cache entries per playbook."""
+
+    def __init__(self, cache_dir, ansible_version):
+        self.cache_dir = cache_dir
+        self.ansible_version = ansible_version
+
+    def _path(self, playbook_path):
+        name = hashlib.sha256(os.path.abspath(playbook_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.pickle")
+
+    def load(self, playbook_path):
+        """Return a valid cache entry of the playbook or None."""
+        try:
+            with open(self._path(playbook_path), 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Ignoring unreadable playbook cache of {playbook_path}: {e}")
+            return None
+        if entry.get('ansible_version') != self.ansible_version:
+            return None
+        for path, digest in entry.get('digests', {}).items():
+            if file_digest(path) != digest:
+                return None
+        return entry
+
+    def store(self, playbook_path, file_cache, patterns):
+        """Store parsed files of a playbook, files holding vault data are never stored."""
+        files = {}
+        for path, data in file_cache.items():
+            if _has_vault(data):
+                log.debug(f"Not caching playbook {playbook_path}: {path} holds vault data")
+                return
+            files[path] = data
+        entry = {
+            'ansible_version': self.ansible_version,
+            'digests': {path: file_digest(path) for path in files},
+            'files': files,
+            'patterns': sorted(patterns),
+        }
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        cache_path = self._path(playbook_path)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    def clear(self):
+        try:
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,82 @@
+"""
+Rolling playbook runs
+=====================
+
+Plan which units of an application run a new revision of the playbook
+config, a batch at a time, so heavy tags never run on all units at once.
+
+.. code-block:: python
+
+    from .rollout import plan_rollout
+
+    states = {'ansible/0': {'revision': 'a1b2', 'status': 'succeeded'}, 'ansible/1': {}}
+    plan = plan_rollout(['ansible/0', 'ansible/1', 'ansible/2'], states, 'a1b2', batch_size=2)
+    plan['batch']  # ['ansible/1', 'ansible/2']
+
+Units report the revision they ran and whether it succeeded. The first
+batch of a revision is a single canary unit unless canary is off, later
+batches hold up to ``batch_size`` units which did not run the revision yet,
+in the order of unit numbers. A unit stays in the batch until it reports,
+so the batch moves on once all of its units succeeded. A failure halts the
+rollout until the revision changes. The revision is a digest of the
+application config (see ``config_revision``), so it is the same on all units.
+
+"""
+
+import hashlib
+import json
+
+# Unit states reported through the peer relation
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def config_revision(config):
+    """Digest of the application config a rollout runs."""
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+
+def unit_number(unit_name):
+    try:
+        return int(unit_name.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def plan_rollout(units, states, revision, batch_size=1, canary=True):
+    """Return the units of the rollout of a revision by their state and the next batch."""
+    units = sorted(set(units), key=lambda unit: (unit_number(unit), unit))
+    ran = {unit: (states.get(unit) or {}) for unit in units}
+    ran = {unit: state.get('status') for unit, state in ran.items() if state.get('revision') == revision}
+    done = [unit for unit in units if ran.get(unit) == SUCCEEDED]
+    failed = [unit for unit in units if ran.get(unit) == FAILED]
+    pending = [unit for unit in units if unit not in ran]
+    if failed or not pending:
+        batch = []
+    elif canary and not done:
+        batch = pending[:1]
+    else:
+        batch = pending[:max(1, int(batch_size))]
+    return dict(
+        revision=revision,
+        batch=batch,
+        done=done,
+        failed=failed,
+        pending=pending,
+        halted=bool(failed),
+        finished=not pending and not failed,
+    )
+
+
+def rollout_message(plan):
+    """Summary of a rollout plan for the application status."""
+    revision = plan['revision'][:8]
+    total = len(plan['done']) + len(plan['failed']) + len(plan['pending'])
+    if plan['halted']:
+        return f"Rollout of {revision} halted, failed on {', '.join(plan['failed'])}"
+    if plan['finished']:
+        return f"Rollout of {revision} complete on {total} units"
+    return "Rolling out {}: {}/{} units done, running on {}".format(
+        revision, len(plan['done']), total, ', '.join(plan['batch']),
+    )
@@ -0,0 +1,160 @@
+"""
+Machine run queue
+=================
+
+FIFO queue shared by all charm-ansible units on a machine, so playbooks of
+co-located applications do not run at the same time (and fight over the
+dpkg lock).
+
+.. code-block:: python
+
+    from .run_queue import RunQueue
+
+    queue = RunQueue(max_hold=3600)
+    with queue.slot('ansible/0') as ticket:
+        run_playbook()
+    ticket['wait'], ticket['depth']  # seconds waited, runs ahead when enqueued
+
+The queue is a JSON file locked with ``fcntl.flock`` while it is read and
+written. Runs get the slot in the order they were enqueued. Entries of dead
+processes are dropped, and a run holding the slot longer than its
+``max_hold`` seconds loses it to the next run in the queue.
+
+"""
+
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from .runner import _pid_alive
+
+log = logging.getLogger(__name__)
+
+# Machine-wide, cleared on reboot together with the processes it orders
+RUN_QUEUE_DIR = '/run/charm-ansible'
+RUN_QUEUE_FILE = 'run-queue.json'
+# Seconds a run may hold the slot before the next run gets it
+RUN_MAX_HOLD = 3600
+# Seconds between checks of a waiting run
+RUN_QUEUE_POLL = 0.2
+
+
+class RunQueue:
+    """Fair FIFO slot for playbook runs of all units on the machine."""
+
+    def __init__(self, path=RUN_QUEUE_DIR, max_hold=RUN_MAX_HOLD, poll_interval=RUN_QUEUE_POLL):
+        self.path = path
+        self.max_hold = max_hold
+        self.poll_interval = poll_interval
+
+    @property
+    def queue_path(self):
+        return os.path.join(self.path, RUN_QUEUE_FILE) if self.path else None
+
+    @contextmanager
+    def _locked(self):
+        """Yield the queue state, written back when the block ends."""
+        with open(self.queue_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError:
+                log.warning(f"Run queue is corrupted, starting a new one: {self.queue_path}")
+                state = {}
+            state.setdefault('next', 0)
+            state.setdefault('entries', [])
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+
+    def _expire(self, state, now):
+        entries = []
+        for entry in state['entries']:
+            if not _pid_alive(entry['pid']):
+                log.warning(f"Dropping run of {entry['owner']} from the run queue: process {entry['pid']} is gone")
+                continue
+            if entry.get('acquired') and now - entry['acquired'] > entry['max_hold']:
+                log.warning(
+                    f"Run of {entry['owner']} held the run queue longer than {entry['max_hold']}s, "
+                    "passing it to the next run"
+                )
+                continue
+            entries.append(entry)
+        state['entries'] = entries
+
+    def _enqueue(self, state, owner):
+        entry = dict(id=state['next'], owner=owner, pid=os.getpid(), enqueued=time.time(), max_hold=self.max_hold)
+        state['next'] += 1
+        state['entries'].append(entry)
+        return entry
+
+    def acquire(self, owner, progress=None):
+        """Wait until the run of owner is first in the queue, return its ticket."""
+        with self._locked() as state:
+            self._expire(state, time.time())
+            entry = self._enqueue(state, owner)
+            depth = len(state['entries']) - 1
+        reported = False
+        while True:
+            with self._locked() as state:
+                now = time.time()
+                self._expire(state, now)
+                ids = [item['id'] for item in state['entries']]
+                if entry['id'] not in ids:
+                    # Queue file was lost or reset while waiting
+                    entry = self._enqueue(state, owner)
+                    ids.append(entry['id'])
+                if ids[0] == entry['id']:
+                    state['entries'][0]['acquired'] = now
+                    break
+                ahead = ids.index(entry['id'])
+            if not reported:
+                message = f"Waiting for {ahead} playbook runs ahead in the machine run queue"
+                log.info(message)
+                if progress:
+                    progress(message)
+                reported = True
+            time.sleep(self.poll_interval)
+        ticket = dict(id=entry['id'], owner=owner, depth=depth, wait=round(now - entry['enqueued'], 3), acquired=now)
+        if ticket['wait'] >= 1:
+            log.info(f"Got the machine run queue after {ticket['wait']:.1f}s ({depth} runs were ahead)")
+        return ticket
+
+    def release(self, ticket):
+        with self._locked() as state:
+            entries = [entry for entry in state['entries'] if entry['id'] != ticket['id']]
+            if len(entries) == len(state['entries']):
+                log.warning(f"Run of {ticket['owner']} was not in the run queue anymore when it ended")
+            state['entries'] = entries
+        ticket['hold'] = round(time.time() - ticket['acquired'], 3)
+
+    @contextmanager
+    def slot(self, owner, progress=None):
+        """Hold the machine run slot inside the block, yield the ticket (None if the queue is not usable)."""
+        ticket = None
+        if self.path:
+            try:
+                os.makedirs(self.path, mode=0o755, exist_ok=True)
+                ticket = self.acquire(owner, progress=progress)
+            except OSError as e:
+                log.warning(f"Machine run queue is not usable, running without it: {e}")
+        try:
+            yield ticket
+        finally:
+            if ticket is not None:
+                self.release(ticket)
+
+    def status(self):
+        """Return entries of the queue, the one holding the slot first."""
+        if not self.queue_path or not os.path.exists(self.queue_path):
+            return []
+        with self._locked() as state:
+            self._expire(state, time.time())
+            return [dict(entry) for entry in state['entries']]
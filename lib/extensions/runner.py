@@ -0,0 +1,361 @@
+"""
+Ansible runner daemon
+=====================
+
+Optional long-lived process per unit which keeps Ansible imported, so hooks
+do not pay its import cost on every run.
+
+.. code-block:: python
+
+    from . import runner
+
+    runner.start('/run/charm-ansible/ansible-0.sock', cwd=charm_dir)
+    try:
+        returncode, results = runner.request_run(socket_path, request)
+    except runner.RunnerUnavailable:
+        returncode, results = run_request(request)
+
+Each request is executed in a child forked from the preloaded daemon with
+the environment and working directory of the calling hook. The child writes
+to the stdout and stderr of the hook (file descriptors are passed over the
+unix socket) and log records are sent back to be emitted by the hook.
+A child which exits before it answered raises RunnerLost, the caller
+reports the run as failed instead of running it again, as tasks may have
+run already.
+
+"""
+
+import argparse
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RUNNER_DIR = '/run/charm-ansible'
+# Modules imported by the daemon before it accepts requests
+PRELOAD_MODULES = (
+    'ansible.constants',
+    'ansible.context',
+    'ansible.executor.playbook_executor',
+    'ansible.inventory.manager',
+    'ansible.parsing.dataloader',
+    'ansible.playbook',
+    'ansible.plugins.loader',
+    'ansible.vars.manager',
+)
+HEADER = struct.Struct('!I')
+# Return code of runs lost with their child, Ansible exits with it on unexpected errors
+RUN_LOST_RETURNCODE = 250
+
+
+class RunnerUnavailable(Exception):
+    """Exception - Runner daemon can not take the request."""
+
+    pass
+
+
+class RunnerError(Exception):
+    """Exception - Runner daemon failed while handling the request."""
+
+    pass
+
+
+class RunnerLost(RunnerError):
+    """Exception - Child running the request exited before it answered."""
+
+    pass
+
+
+def socket_path(unit_name):
+    return os.path.join(RUNNER_DIR, '{}.sock'.format(unit_name.replace('/', '-')))
+
+
+def _send(sock, payload, fds=()):
+    data = json.dumps(payload, default=str).encode('utf-8')
+    ancillary = []
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    sock.sendmsg([HEADER.pack(len(data))], ancillary)
+    sock.sendall(data)
+
+
+def _recv(sock, maxfds=0):
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(HEADER.size, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if len(msg) != HEADER.size:
+        raise RunnerError('Connection closed before the message header')
+    (length,) = HEADER.unpack(msg)
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            raise RunnerError('Connection closed before the end of message')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8')), list(fds)
+
+
+def _connect(path):
+    if not os.path.exists(path):
+        raise RunnerUnavailable(f"Socket does not exist: {path}")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sock.close()
+        raise RunnerUnavailable(f"Failed to connect to {path}: {e}")
+    return sock
+
+
+def request_run(path, request, progress=None):
+    """Run the request in the daemon, return (returncode, results).
+
+    Progress messages of the run are passed to progress while it runs.
+    Raises RunnerUnavailable when the daemon did not accept the request and
+    RunnerLost when its child exited during the run.
+    """
+    sock = _connect(path)
+    try:
+        try:
+            _send(sock, {
+                'command': 'run',
+                'request': request,
+                'environ': dict(os.environ),
+                'cwd': os.getcwd(),
+                'log_level': logging.getLogger().getEffectiveLevel(),
+                'progress': progress is not None,
+            }, fds=[sys.stdout.fileno(), sys.stderr.fileno()])
+        except OSError as e:
+            raise RunnerUnavailable(f"Failed to send request: {e}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            response, _ = _recv(sock)
+            while 'progress' in response:
+                try:
+                    progress(response['progress'])
+                except Exception as e:
+                    log.warning(f"Failed to forward playbook progress: {e}")
+                response, _ = _recv(sock)
+        except (OSError, RunnerError) as e:
+            raise RunnerLost(f"Runner child exited during the run: {e}")
+    finally:
+        sock.close()
+
+    for record in response.get('records', []):
+        logging.getLogger(record['name']).log(record['levelno'], record['message'])
+    if response.get('error'):
+        raise RunnerError(response['error'])
+    return response['returncode'], response['results']
+
+
+def _command(path, command, timeout=5):
+    sock = _connect(path)
+    try:
+        sock.settimeout(timeout)
+        _send(sock, {'command': command})
+        response, _ = _recv(sock)
+        return response
+    except (OSError, RunnerError) as e:
+        raise RunnerUnavailable(f"Runner did not answer '{command}': {e}")
+    finally:
+        sock.close()
+
+
+def is_running(path):
+    try:
+        return bool(_command(path, 'ping').get('pong'))
+    except RunnerUnavailable:
+        return False
+
+
+def _pid_alive(pid):
+    """Whether a process exists, also if it belongs to another user."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def spawn(module, args, cwd=None, log_path=None):
+    """Start main() of an extensions module detached from the hook, return the pid."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    # The process must not hold the hook output open, juju waits for it
+    with open(log_path or os.devnull, 'ab') as output:
+        process = subprocess.Popen(
+            [sys.executable, '-c', f'from extensions.{module} import main; main()'] + list(args),
+            cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=output, stderr=output,
+            close_fds=True, start_new_session=True,
+        )
+    return process.pid
+
+
+def start(path, cwd=None, log_path=None):
+    """Spawn the daemon unless it already answers on the socket."""
+    if is_running(path):
+        return False
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    spawn('runner', ['--socket', path], cwd=cwd, log_path=log_path)
+    log.info(f"Started Ansible runner: {path}")
+    return True
+
+
+def stop(path):
+    """Stop the daemon, True if it was running."""
+    try:
+        _command(path, 'stop')
+    except RunnerUnavailable:
+        return False
+    log.info(f"Stopped Ansible runner: {path}")
+    return True
+
+
+class _RecordCollector(logging.Handler):
+    def __init__(self, level):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message = '{}\n{}'.format(message, logging.Formatter().formatException(record.exc_info))
+        self.records.append({'name': record.name, 'levelno': record.levelno, 'message': message})
+
+
+def _handle_run(conn, payload, fds):
+    """Executed in the forked child, never returns."""
+    status = 0
+    try:
+        for fd, target in zip(fds, (1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(payload['environ'])
+        os.chdir(payload['cwd'])
+
+        collector = _RecordCollector(payload.get('log_level', logging.DEBUG))
+        root = logging.getLogger()
+        root.handlers = [collector]
+        root.setLevel(collector.level)
+
+        from .ansible_playbook import run_request
+        # Progress is sent from the timer thread of the progress callback too
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                _send(conn, message)
+
+        def progress(message):
+            send({'progress': message})
+
+        response = {'records': collector.records}
+        try:
+            response['returncode'], response['results'] = run_request(
+                payload['request'], progress=progress if payload.get('progress') else None,
+            )
+        except Exception as e:
+            log.error(e, exc_info=True)
+            response['error'] = str(e)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        send(response)
+    except Exception:
+        status = 1
+    finally:
+        conn.close()
+        os._exit(status)
+
+
+def serve(path):
+    for module in PRELOAD_MODULES:
+        __import__(module)
+    from ansible.plugins.loader import become_loader
+    from ansible.plugins.loader import connection_loader
+    from ansible.plugins.loader import shell_loader
+    list(connection_loader.all(class_only=True))
+    list(shell_loader.all(class_only=True))
+    list(become_loader.all(class_only=True))
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.umask(0o077)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    server.settimeout(1)
+    log.info(f"Ansible runner listening on {path}")
+
+    try:
+        _accept_loop(server)
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def _accept_loop(server):
+    running = True
+    while running:
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        try:
+            conn.settimeout(None)
+            payload, fds = _recv(conn, maxfds=2)
+            command = payload.get('command')
+            if command == 'run':
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if os.fork() == 0:
+                    server.close()
+                    _handle_run(conn, payload, fds)
+                for fd in fds:
+                    os.close(fd)
+            elif command == 'ping':
+                _send(conn, {'pong': True, 'pid': os.getpid()})
+            elif command == 'stop':
+                _send(conn, {'stopped': True})
+                running = False
+        except Exception as e:
+            log.error(f"Failed to handle runner request: {e}")
+        finally:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--socket', required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_time = time.monotonic()
+    try:
+        serve(args.socket)
+    finally:
+        log.info(f"Ansible runner exited after {time.monotonic() - start_time:.0f}s")
+
+
+if __name__ == '__main__':
+    main()
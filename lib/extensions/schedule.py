@@ -0,0 +1,184 @@
+"""
+Scheduled playbook runs
+=======================
+
+Run tags of the playbook periodically from cron. Every unit waits its own
+delay before it runs, so units of a large deployment do not hit mirrors and
+workloads at the same moment.
+
+.. code-block:: python
+
+    from .schedule import Schedule, parse_schedule, unit_jitter
+
+    entries = parse_schedule('config: "0 * * * *"')  # {'config': '0 * * * *'}
+    schedule = Schedule('/path/to/schedule')
+    name = schedule.store('config', run)  # run planned by Ansible._plan_run
+    schedule.cron_line(name, '0 * * * *', delay=unit_jitter('ansible/0', 600), cwd=charm_dir)
+    schedule.prune([name])
+
+Cron calls ``main()`` of this module with the name of the entry. The run
+is stored as a job (see ``jobs.py``), so job-status and job-result show
+scheduled runs too. A run is skipped, and recorded as a skipped job, while
+the previous run of the same entry still runs. Cron appends the output of
+an entry to its log, which a run moves to ``.log.1`` once it grew past
+``LOG_MAX_BYTES``.
+
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+CRON_MACROS = {'@hourly', '@daily', '@midnight', '@weekly', '@monthly', '@yearly', '@annually'}
+CRON_FIELD = re.compile(r'^[0-9A-Za-z*/,-]+$')
+# Files of an entry, longest suffixes first
+ENTRY_SUFFIXES = ('json.tmp', 'log.1', 'json', 'lock', 'log')
+LOG_MAX_BYTES = 1024 * 1024
+
+
+def parse_schedule(text):
+    """Return tags (comma separated) mapped to cron expressions, ValueError if invalid."""
+    from . import yaml_io
+
+    if not text or not text.strip():
+        return {}
+    try:
+        data = yaml_io.safe_load(text)
+    except Exception as e:
+        raise ValueError(f"schedule is not valid YAML: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("schedule must map tags to cron expressions")
+    entries = {}
+    for tags, expression in data.items():
+        tags = ','.join(tag.strip() for tag in str(tags).split(',') if tag.strip())
+        expression = ' '.join(str(expression).split())
+        fields = expression.split(' ')
+        if not tags:
+            raise ValueError(f"schedule entry without tags: {expression}")
+        if not (fields == [expression] and expression in CRON_MACROS) and not (
+            len(fields) == 5 and all(CRON_FIELD.match(field) for field in fields)
+        ):
+            raise ValueError(f"invalid cron expression of {tags}: {expression}")
+        entries[tags] = expression
+    return entries
+
+
+def unit_jitter(unit_name, window):
+    """Return the delay of a unit in seconds, spread over the window by a hash of the unit name."""
+    if not window or not unit_name:
+        return 0
+    return int(hashlib.sha256(unit_name.encode('utf-8')).hexdigest(), 16) % int(window)
+
+
+class Schedule:
+    """Directory of scheduled runs, their locks and logs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def entry_name(tags):
+        return re.sub(r'[^A-Za-z0-9_.+-]', '-', tags.replace(',', '+'))
+
+    def _file(self, name, suffix):
+        return os.path.join(self.path, f"{name}.{suffix}")
+
+    def store(self, tags, run):
+        """Store the planned run of an entry, return the name of the entry."""
+        name = self.entry_name(tags)
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        tmp_path = self._file(name, 'json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(run, f, indent=2, default=str)
+        os.replace(tmp_path, self._file(name, 'json'))
+        return name
+
+    def load(self, name):
+        with open(self._file(name, 'json'), 'r') as f:
+            return json.load(f)
+
+    def prune(self, names):
+        """Remove stored runs, locks and logs of entries not in names."""
+        try:
+            files = os.listdir(self.path)
+        except FileNotFoundError:
+            return
+        for file_name in files:
+            for suffix in ENTRY_SUFFIXES:
+                if file_name.endswith(f".{suffix}"):
+                    if file_name[:-len(suffix) - 1] not in names:
+                        os.remove(os.path.join(self.path, file_name))
+                    break
+
+    def rotate_log(self, name, max_bytes=LOG_MAX_BYTES):
+        """Move the log of an entry to .log.1 once it is larger than max_bytes."""
+        path = self._file(name, 'log')
+        try:
+            if os.path.getsize(path) <= max_bytes:
+                return False
+            shutil.copyfile(path, self._file(name, 'log.1'))
+            # Cron still appends to the open file, so it is truncated in place
+            os.truncate(path, 0)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning(f"Failed to rotate log of scheduled run {name}: {e}")
+            return False
+        return True
+
+    def cron_line(self, name, expression, delay=0, cwd=None, env={}, user='root'):
+        """Return the line of /etc/cron.d running the entry, with env set for the run."""
+        command = ' '.join(shlex.quote(arg) for arg in [
+            sys.executable, '-c', 'from extensions.schedule import main; main()',
+            '--schedule', self.path, '--name', name, '--delay', str(delay),
+        ])
+        env = dict(env, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        line = 'cd {} && {} {} >> {} 2>&1'.format(
+            shlex.quote(cwd or os.getcwd()),
+            ' '.join(f"{key}={shlex.quote(value)}" for key, value in sorted(env.items())),
+            command, shlex.quote(self._file(name, 'log')),
+        )
+        # Cron turns unescaped % into newlines
+        line = line.replace('%', '\\%')
+        return f"{expression} {user} {line}"
+
+    def run(self, name, delay=0):
+        """Run the entry after delay seconds unless its previous run still runs, return the job status."""
+        from .jobs import JOB_SKIPPED
+        from .jobs import JobStore
+        from .jobs import run_job
+
+        run = self.load(name)
+        time.sleep(delay)
+        jobs = JobStore(os.path.join(run['state_dir'], 'jobs'))
+        job_id = jobs.create(run)
+        jobs.update(job_id, scheduled=name, pid=os.getpid())
+        with open(self._file(name, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.warning(f"Previous scheduled run of {name} is still running, skipping run")
+                jobs.update(job_id, status=JOB_SKIPPED, finished=time.time(), error='previous run still running')
+                return JOB_SKIPPED
+            self.rotate_log(name)
+            return run_job(os.path.join(jobs.path, job_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--schedule', required=True)
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--delay', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    Schedule(args.schedule).run(args.name, delay=args.delay)
@@ -0,0 +1,195 @@
+"""
+Playbook tag index
+==================
+
+Count the tasks of a playbook each selection of tags would run, without
+loading the playbook in Ansible, so hooks whose tag matches no task skip
+the run entirely.
+
+.. code-block:: python
+
+    from .tag_index import TagIndex
+
+    tag_index = TagIndex('/path/to/playbook.tags.json')
+    tag_index.build('/path/to/playbook.yaml')
+    tag_index.count('/path/to/playbook.yaml', ['stop'])  # 0, None if not known
+
+Tasks inherit tags of their blocks and plays, and are selected like Ansible
+selects them: ``always`` tasks run with any tags, ``never`` tasks only when
+one of their other tags is selected. Handlers run only when notified and
+are not counted. Roles and static imports may contain tasks with any tags,
+as do tasks with templated tags, they match every selection. Tags of
+dynamic includes apply to the include task itself, which is counted like
+any other task.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from . import yaml_io
+from .fingerprint import _strip_fqcn
+
+log = logging.getLogger(__name__)
+
+PLAY_TASK_SECTIONS = ('pre_tasks', 'tasks', 'post_tasks')
+BLOCK_SECTIONS = ('block', 'rescue', 'always')
+# Statically imported tasks get tags of the import in addition to their own
+STATIC_IMPORT_KEYS = {'import_tasks', 'import_role', 'import_playbook'}
+# Tags of tasks without tags, see Taggable.untagged of Ansible
+UNTAGGED = frozenset(['untagged'])
+
+
+def _parse_tags(value):
+    """Return a set of tags, None when they are templated."""
+    if value is None:
+        return set()
+    if isinstance(value, (str, int, float)):
+        value = [tag.strip() for tag in str(value).split(',')]
+    if not isinstance(value, list):
+        return None
+    tags = set()
+    for tag in value:
+        if isinstance(tag, list):
+            nested = _parse_tags(tag)
+            if nested is None:
+                return None
+            tags |= nested
+            continue
+        tag = str(tag)
+        if '{{' in tag or '{%' in tag:
+            return None
+        if tag:
+            tags.add(tag)
+    return tags
+
+
+def should_run(tags, only_tags=('all',), skip_tags=()):
+    """Evaluate tags of a task like Taggable.evaluate_tags of Ansible."""
+    tags = set(tags) or UNTAGGED
+    run = True
+    if only_tags:
+        if 'always' in tags:
+            run = True
+        elif 'all' in only_tags and 'never' not in tags:
+            run = True
+        elif not tags.isdisjoint(only_tags):
+            run = True
+        elif 'tagged' in only_tags and tags != UNTAGGED and 'never' not in tags:
+            run = True
+        else:
+            run = False
+    if run and skip_tags:
+        if 'all' in skip_tags:
+            if 'always' not in tags or 'always' in skip_tags:
+                run = False
+        elif not tags.isdisjoint(skip_tags):
+            run = False
+        elif 'tagged' in skip_tags and tags != UNTAGGED:
+            run = False
+    return run
+
+
+def _index_tasks(items, inherited, counts):
+    """Count tasks of a task list by their tags, return the number of tasks with unknown tags."""
+    unknown = 0
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        tags = _parse_tags(item.get('tags'))
+        if tags is None:
+            unknown += 1
+            continue
+        tags |= inherited
+        if 'block' in item:
+            for section in BLOCK_SECTIONS:
+                unknown += _index_tasks(item.get(section), tags, counts)
+            continue
+        if any(_strip_fqcn(key) in STATIC_IMPORT_KEYS for key in item):
+            unknown += 1
+            continue
+        key = tuple(sorted(tags))
+        counts[key] = counts.get(key, 0) + 1
+    return unknown
+
+
+def index_playbook(playbook_path):
+    """Return tag sets of the tasks of a playbook with their number and the number of tasks with unknown tags."""
+    with open(playbook_path, 'rb') as f:
+        content = f.read()
+    plays = yaml_io.safe_load(content) or []
+    if not isinstance(plays, list):
+        raise ValueError("playbook is not a list of plays")
+    counts = {}
+    unknown = 0
+    for play in plays:
+        if not isinstance(play, dict):
+            continue
+        if any(_strip_fqcn(key) in STATIC_IMPORT_KEYS for key in play):
+            unknown += 1
+            continue
+        tags = _parse_tags(play.get('tags'))
+        if tags is None:
+            unknown += 1
+            continue
+        unknown += len(play.get('roles') or [])
+        for section in PLAY_TASK_SECTIONS:
+            unknown += _index_tasks(play.get(section), tags, counts)
+    return dict(
+        digest=hashlib.sha256(content).hexdigest(),
+        tag_sets=[dict(tags=list(tags), tasks=number) for tags, number in sorted(counts.items())],
+        unknown=unknown,
+    )
+
+
+class TagIndex:
+    """Tag index of a playbook, stored as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def build(self, playbook_path):
+        """Index the playbook and store the index, return it (None if the playbook can not be indexed)."""
+        try:
+            index = index_playbook(playbook_path)
+        except Exception as e:
+            log.warning(f"Failed to index tags of {playbook_path}: {e}")
+            self.clear()
+            return None
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.path)
+        return index
+
+    def load(self, playbook_path):
+        """Return the stored index if it indexes the playbook as it is now, None otherwise."""
+        try:
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+            with open(playbook_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Failed to read tag index {self.path}: {e}")
+            return None
+        return index if index.get('digest') == digest else None
+
+    def count(self, playbook_path, only_tags=None, skip_tags=()):
+        """Return the number of tasks the tags would run, None when it is not known."""
+        index = self.load(playbook_path)
+        if index is None:
+            return None
+        return index['unknown'] + sum(
+            tag_set['tasks'] for tag_set in index['tag_sets']
+            if should_run(tag_set['tags'], only_tags or ('all',), skip_tags)
+        )
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,63 @@
+"""
+YAML I/O
+========
+
+Load and dump YAML with libyaml when PyYAML was built with it, so large
+host vars and playbooks are not parsed and emitted by the pure Python
+implementation.
+
+.. code-block:: python
+
+    from . import yaml_io
+
+    data = yaml_io.safe_load(open('/etc/ansible/host_vars/localhost'))
+    text = yaml_io.safe_dump(data)
+
+Representers are registered once on the charm dumper, never on the global
+PyYAML dumpers. Ansible uses libyaml for its own loader under the same
+condition, ``LIBYAML`` tells whether both fell back to Python.
+
+"""
+
+import logging
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+    LIBYAML = True
+except ImportError:
+    from yaml import SafeDumper
+    from yaml import SafeLoader
+    LIBYAML = False
+    log.warning("PyYAML is built without libyaml, YAML is loaded and dumped by the Python implementation")
+
+
+class Dumper(SafeDumper):
+    """Safe dumper of the charm."""
+
+    pass
+
+
+def _represent_str(dumper, value):
+    # Don't use non-standard tags for unicode which will not
+    # work when salt uses yaml.safe_load.
+    return dumper.represent_scalar('tag:yaml.org,2002:str', value)
+
+
+Dumper.add_representer(str, _represent_str)
+Dumper.add_representer(tuple, Dumper.represent_list)
+
+
+def safe_load(stream):
+    """Parse the first YAML document of a string or file into Python objects."""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def safe_dump(data, stream=None, **kwargs):
+    """Serialize data to YAML in block style, return it as string if stream is None."""
+    kwargs.setdefault('default_flow_style', False)
+    return yaml.dump(data, stream, Dumper=Dumper, **kwargs)
@@ -16,6 +16,7 @@ import json
 import os  # noqa
 import subprocess  # noqa
 import logging
+import time
 # from yaml import safe_load
 from pathlib import Path
 
@@ -23,8 +24,9 @@ from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus
-# from ops.model import BlockedStatus
+from ops.model import BlockedStatus
 from ops.model import MaintenanceStatus
+from ops.model import WaitingStatus
 
 try:
     import setuppath  # noqa:F401
@@ -33,6 +35,10 @@ except Exception as e:
     logging.error('Failed to import setuppath: {}'.format(str(e)))
 try:
     from extensions import ansible_manager
+    from extensions.schedule import parse_schedule
+    from extensions import rollout
+    from extensions import memoize
+    from extensions.ansible_playbook import unit_get
     # from extensions.network import close_port
     # from extensions.network import open_port
     # from extensions.network import parse_port
@@ -45,6 +51,10 @@ except Exception as e:
 logger = logging.getLogger(__name__)
 
 INTERFACE = "juju-info"
+# Tags of the playbook run by hooks
+HOOK_TAGS = ("install", "start", "stop", "config")
+# Peer relation coordinating rolling playbook runs
+ROLLOUT_RELATION = "rollout"
 
 
 class AnsibleCharm(CharmBase):
@@ -54,20 +64,42 @@ class AnsibleCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
+        # Observed first, so hooks after these events look addresses up again.
+        # Juju reports changed unit addresses with config-changed.
+        for event in (self.on.config_changed, self.on.upgrade_charm, self.on.post_series_upgrade, self.on.start):
+            self.framework.observe(event, self._on_network_changed)
+        for relation in self.meta.relations:
+            if relation in self.meta.peers:
+                continue
+            self.framework.observe(self.on[relation].relation_joined, self._on_network_changed)
+            self.framework.observe(self.on[relation].relation_changed, self._on_network_changed)
+            self.framework.observe(self.on[relation].relation_departed, self._on_network_changed)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.start, self._on_start)
         self.framework.observe(self.on.stop, self._on_stop)
         self.framework.observe(self.on.remove, self._on_stop)
         self.framework.observe(self.on.upgrade_charm, self._on_install)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.post_series_upgrade, self._on_install)
+        self.framework.observe(self.on.leader_elected, self._on_rollout_changed)
+        self.framework.observe(self.on[ROLLOUT_RELATION].relation_changed, self._on_rollout_changed)
+        self.framework.observe(self.on[ROLLOUT_RELATION].relation_departed, self._on_rollout_changed)
         self.framework.observe(self.on.ansible_playbook_action, self._on_ansible_playbook_action)
+        self.framework.observe(self.on.flush_fact_cache_action, self._on_flush_fact_cache_action)
+        self.framework.observe(self.on.job_status_action, self._on_job_status_action)
+        self.framework.observe(self.on.job_result_action, self._on_job_result_action)
+        self.framework.observe(self.on.drift_report_action, self._on_drift_report_action)
+        self.framework.observe(self.on.tag_index_action, self._on_tag_index_action)
+        self.framework.observe(self.on.history_action, self._on_history_action)
         self.framework.observe(self.on.data_storage_attached, self._on_data_storage_attached)
         self.framework.observe(self.on.data_storage_detaching, self._on_data_storage_detaching)
         # self._stored.set_default(things=[])
         self._stored.set_default(storages={})
         self._stored.set_default(storage_name="data")
         self._stored.set_default(crontab="")
+        self._stored.set_default(versions={})
+        self._stored.set_default(network={})
 
     def _on_config_changed(self, event):
         self.__update_ansible_playbook()
@@ -77,6 +109,8 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Init Ansible extension failed: {}".format(str(e)))
 
+        config_changed = self.__configure_ansible()
+
         try:
             extra_vars = self.__get_extra_vars()
         except Exception as e:
@@ -86,20 +120,32 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Failed to fetch environment variables: {}".format(str(e)))
 
-        try:
-            ansible_manager.apply_playbook(
-                playbook='playbook.yaml',
-                tags=["config"],
-                extra_vars=extra_vars,
-                env=env,
-            )
-        except Exception as e:
-            logger.error("Ansible playbook failed: {}".format(str(e)))
+        # Runner keeps the config loaded on its start
+        self.__configure_runner(restart=config_changed)
+
+        # Rolled out config tags run once the batch of the unit is due
+        if "config" not in self.__rollout_tags():
+            try:
+                ansible_manager.apply_playbook(
+                    playbook='playbook.yaml',
+                    tags=["config"],
+                    extra_vars=extra_vars,
+                    env=env,
+                    # Edits of the playbook option run only the tasks they changed
+                    incremental=True,
+                )
+            except Exception as e:
+                logger.error("Ansible playbook failed: {}".format(str(e)))
+        self.__rollout(extra_vars, env)
 
         # /etc/cron.d/charm_<app_name>
         try:
             self._stored.crontab = self.model.config['crontab']
             cron_content = self._stored.crontab
+            schedule_lines = self.__schedule_playbook(extra_vars, env)
+            if schedule_lines:
+                cron_content = cron_content.rstrip('\n') + '\n' if cron_content else ''
+                cron_content += "# Scheduled playbook runs (schedule option)\n" + '\n'.join(schedule_lines)
             app_name = self.app.name
             cronfile_path = os.path.join("/etc/cron.d", f"charm_{app_name.replace('-', '_')}")
             file_path = Path(cronfile_path)
@@ -123,12 +169,166 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Failed to configure cron: {}".format(str(e)))
 
-    def __get_extra_vars(self, **kwargs):
+    def __rollout_tags(self):
+        return [tag.strip() for tag in self.model.config['rollout_tags'].split(',') if tag.strip()]
+
+    def _on_rollout_changed(self, event):
+        if not self.__rollout_tags():
+            return
+        try:
+            ansible_manager.init_charm(self)
+        except Exception as e:
+            logger.error("Init Ansible extension failed: {}".format(str(e)))
+        self.__rollout(self.__get_extra_vars(), self.__get_environ())
+
+    def __rollout(self, extra_vars, env):
+        """Run the rollout tags once the batch of the unit is due, the leader plans the batches."""
+        tags = self.__rollout_tags()
+        relation = self.model.get_relation(ROLLOUT_RELATION)
+        if not tags:
+            self.__clear_rollout(relation)
+            return
+        if relation is None:
+            return
+        try:
+            revision = ansible_manager.rollout_revision()
+            if self.unit.is_leader():
+                self.__plan_rollout(relation, revision)
+            planned = json.loads(relation.data[self.app].get('rollout') or '{}')
+        except Exception as e:
+            logger.error("Failed to plan playbook rollout: {}".format(str(e)))
+            return
+        if relation.data[self.unit].get('revision') == revision:
+            return
+        if planned.get('revision') != revision or self.unit.name not in planned.get('batch', []):
+            logger.info(f"Deferring run of {','.join(tags)} until the rollout batch of the unit")
+            self.unit.status = WaitingStatus("Waiting for rollout batch")
+            return
+
+        self.unit.status = MaintenanceStatus("Running rollout batch")
+        returncode = None
+        try:
+            returncode, _ = ansible_manager.apply_playbook(
+                playbook='playbook.yaml',
+                tags=tags,
+                extra_vars=extra_vars,
+                env=env,
+            )
+        except Exception as e:
+            logger.error("Ansible playbook failed: {}".format(str(e)))
+        succeeded = returncode == 0
+        relation.data[self.unit].update({
+            'revision': revision,
+            'status': rollout.SUCCEEDED if succeeded else rollout.FAILED,
+        })
+        if succeeded:
+            self.unit.status = ActiveStatus("Unit is ready")
+        else:
+            self.unit.status = BlockedStatus(f"Rollout run failed: returncode={returncode}")
+        # Changes of its own unit data trigger no hook on the leader
+        if self.unit.is_leader():
+            try:
+                self.__plan_rollout(relation, revision)
+            except Exception as e:
+                logger.error("Failed to plan playbook rollout: {}".format(str(e)))
+
+    def __clear_rollout(self, relation):
+        """Drop the state of a rollout stopped by clearing rollout_tags."""
+        try:
+            if self.unit.is_leader():
+                if relation is not None and 'rollout' in relation.data[self.app]:
+                    del relation.data[self.app]['rollout']
+                if self.app.status.message.startswith(("Rollout", "Rolling out")):
+                    self.app.status = ActiveStatus()
+            if isinstance(self.unit.status, WaitingStatus) and self.unit.status.message == "Waiting for rollout batch":
+                self.unit.status = ActiveStatus("Unit is ready")
+        except Exception as e:
+            logger.error("Failed to clear playbook rollout: {}".format(str(e)))
+
+    def __plan_rollout(self, relation, revision):
+        """Publish the next batch of the rollout to the peers and its progress in the application status."""
+        units = [self.unit] + sorted(relation.units, key=lambda unit: unit.name)
+        plan = rollout.plan_rollout(
+            [unit.name for unit in units],
+            {unit.name: dict(relation.data[unit]) for unit in units},
+            revision,
+            batch_size=self.model.config['rollout_batch_size'],
+            canary=self.model.config['rollout_canary'],
+        )
+        planned = json.dumps({'revision': revision, 'batch': plan['batch']}, sort_keys=True)
+        if relation.data[self.app].get('rollout') != planned:
+            logger.info(f"Rollout of {revision}: batch {', '.join(plan['batch']) or 'none'}")
+            relation.data[self.app]['rollout'] = planned
+        message = rollout.rollout_message(plan)
+        if plan['halted']:
+            self.app.status = BlockedStatus(message)
+        elif plan['finished']:
+            self.app.status = ActiveStatus(message)
+        else:
+            self.app.status = MaintenanceStatus(message)
+        return plan
+
+    def __schedule_playbook(self, extra_vars, env):
+        """Store scheduled playbook runs, return their cron lines."""
+        try:
+            schedule = parse_schedule(self.model.config['schedule'])
+        except ValueError as e:
+            logger.error("Invalid schedule config: {}".format(str(e)))
+            return []
+        try:
+            return ansible_manager.schedule_playbook(
+                'playbook.yaml', schedule, extra_vars=extra_vars, env=env, jitter=self.model.config['schedule_jitter'],
+            )
+        except Exception as e:
+            logger.error("Failed to schedule playbook runs: {}".format(str(e)))
+            return []
+
+    def __configure_ansible(self):
+        """Write the Ansible config of the charm, return True if it changed."""
+        try:
+            return ansible_manager.configure(
+                fact_cache_timeout=self.model.config['fact_cache_timeout'],
+                forks=self.model.config['forks'],
+                strategy=self.model.config['strategy'],
+                pipelining=self.model.config['pipelining'],
+                internal_poll_interval=self.model.config['internal_poll_interval'],
+                task_timeout=self.model.config['task_timeout'],
+            )
+        except Exception as e:
+            logger.error("Failed to configure Ansible: {}".format(str(e)))
+            return False
+
+    def __flush_fact_cache(self):
+        try:
+            ansible_manager.flush_fact_cache()
+        except Exception as e:
+            logger.error("Failed to flush Ansible fact cache: {}".format(str(e)))
+
+    def __configure_runner(self, restart=False):
+        try:
+            if restart or not self.model.config['runner_daemon']:
+                ansible_manager.stop_runner()
+            if self.model.config['runner_daemon']:
+                ansible_manager.start_runner()
+        except Exception as e:
+            logger.error("Failed to configure Ansible runner: {}".format(str(e)))
+
+    def __get_extra_vars(self, refresh_apt=False, **kwargs):
         extra_vars = {
             'app_name': self.app.name,
             'leader': self.model.unit.is_leader(),
         }
 
+        try:
+            if refresh_apt:
+                ansible_manager.refresh_apt_cache()
+        except Exception as e:
+            logger.error("Failed to refresh apt lists: {}".format(str(e)))
+        try:
+            extra_vars['apt_cache_fresh'] = ansible_manager.apt_cache.is_fresh()
+        except Exception as e:
+            logger.error("Failed to check apt lists freshness: {}".format(str(e)))
+
         try:
             extra_vars['ingress_address'] = self.ingress_address
         except Exception as e:
@@ -170,6 +370,21 @@ class AnsibleCharm(CharmBase):
         playbook = self.config.get('playbook')
         with open('playbook.yaml', 'w') as f:
             f.write(playbook)
+        try:
+            ansible_manager.index_tags('playbook.yaml')
+        except Exception as e:
+            logger.error("Failed to index playbook tags: {}".format(str(e)))
+
+    def __has_tasks(self, tag):
+        """False if no task of the playbook runs with the tag, True if some does or it is not known."""
+        try:
+            count = ansible_manager.count_tasks('playbook.yaml', [tag])
+        except Exception as e:
+            logger.error("Failed to read playbook tag index: {}".format(str(e)))
+            return True
+        if count == 0:
+            logger.info(f"No tasks tagged {tag} in the playbook")
+        return count != 0
 
     def _on_install(self, event):
         self.unit.status = MaintenanceStatus("Installing")
@@ -180,13 +395,11 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Installing Ansible support failed: {}".format(str(e)))
 
-        try:
-            import ansible
-            logger.info(f"Ansible core version: {ansible.__version__}")
-            from ansible_collections import ansible_release
-            logger.info(f"Ansible collections version: {ansible_release.ansible_version}")
-        except Exception as e:
-            logger.error("Failed to read the ansible version: {}".format(str(e)))
+        # Installed packages may have changed with the charm
+        self._stored.versions = {}
+        versions = self.versions
+        logger.info(f"Ansible core version: {versions.get('ansible_core')}")
+        logger.info(f"Ansible collections version: {versions.get('ansible')}")
 
         try:
             if self.model.unit.is_leader():
@@ -203,26 +416,62 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Init Ansible extension failed: {}".format(str(e)))
 
-        extra_vars = self.__get_extra_vars()
-        env = self.__get_environ()
+        try:
+            # Charm or series upgrade may change Ansible itself - rerun everything
+            ansible_manager.flush_fingerprints()
+        except Exception as e:
+            logger.error("Failed to flush playbook fingerprints: {}".format(str(e)))
 
         try:
-            ansible_manager.apply_playbook(
-                playbook='playbook.yaml',
-                tags=["install"],
-                extra_vars=extra_vars,
-                env=env,
-            )
+            # Memoized metadata of the previous revision is not reused
+            memoize.clear_store()
         except Exception as e:
-            logger.error("Ansible playbook failed: {}".format(str(e)))
-        else:
-            self.unit.status = ActiveStatus("Unit is ready")
+            logger.error("Failed to clear memoized values: {}".format(str(e)))
 
         try:
-            self.__bind_mount_storage()
+            # Payloads built by the previous revision are not reused
+            ansible_manager.flush_payload_cache()
         except Exception as e:
-            logger.error(e)
-            logger.error("Error during storage bind mount: {}".format(str(e)))
+            logger.error("Failed to flush AnsiballZ payload cache: {}".format(str(e)))
+
+        # Upgraded packages, series or mounts change the facts
+        self.__flush_fact_cache()
+        self.__configure_ansible()
+
+        # Runner must not keep the code of the previous charm revision loaded
+        self.__configure_runner(restart=True)
+
+        extra_vars = self.__get_extra_vars(refresh_apt=self.__has_tasks("install"))
+        env = self.__get_environ()
+
+        runs = [dict(
+            playbook='playbook.yaml',
+            tags=["install"],
+            extra_vars=extra_vars,
+            env=env,
+        )]
+        if dict(self._stored.storages):
+            runs.append(dict(
+                playbook='playbooks/storage.yaml',
+                tags=['mount'],
+                extra_vars=extra_vars,
+                env=env,
+                diff=True,
+                check=False,
+            ))
+        else:
+            logger.info("No storage added yet")
+
+        # Install and storage playbooks run in one executor pass
+        with ansible_manager.session():
+            try:
+                outcomes = ansible_manager.apply_playbooks(runs)
+            except Exception as e:
+                logger.error("Ansible playbook failed: {}".format(str(e)))
+            else:
+                self.unit.status = ActiveStatus("Unit is ready")
+                if len(outcomes) > 1 and outcomes[1][0] != 0:
+                    logger.warning("Error during storage bind mount: returncode={}".format(outcomes[1][0]))
 
     def _on_start(self, event):
         self.unit.status = MaintenanceStatus("Starting")
@@ -231,7 +480,14 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Init Ansible extension failed: {}".format(str(e)))
 
-        extra_vars = self.__get_extra_vars()
+        # Socket of the runner is gone after a reboot
+        self.__configure_runner()
+
+        if not self.__has_tasks("start"):
+            self.unit.status = ActiveStatus("Unit is ready")
+            return
+
+        extra_vars = self.__get_extra_vars(refresh_apt=True)
         env = self.__get_environ()
 
         try:
@@ -240,6 +496,8 @@ class AnsibleCharm(CharmBase):
                 tags=["start"],
                 extra_vars=extra_vars,
                 env=env,
+                # Start runs again after a reboot with the same inputs
+                force=True,
             )
         except Exception as e:
             logger.error("Ansible playbook failed: {}".format(str(e)))
@@ -253,36 +511,116 @@ class AnsibleCharm(CharmBase):
         except Exception as e:
             logger.error("Init Ansible extension failed: {}".format(str(e)))
 
-        extra_vars = self.__get_extra_vars()
-        env = self.__get_environ()
+        if self.__has_tasks("stop"):
+            extra_vars = self.__get_extra_vars()
+            env = self.__get_environ()
+
+            try:
+                ansible_manager.apply_playbook(
+                    playbook='playbook.yaml',
+                    tags=["stop"],
+                    extra_vars=extra_vars,
+                    env=env,
+                )
+            except Exception as e:
+                logger.error("Ansible playbook failed: {}".format(str(e)))
 
         try:
-            ansible_manager.apply_playbook(
+            ansible_manager.stop_runner()
+        except Exception as e:
+            logger.error("Failed to stop Ansible runner: {}".format(str(e)))
+
+        try:
+            ansible_manager.remove_metrics()
+        except Exception as e:
+            logger.error("Failed to remove playbook run metrics: {}".format(str(e)))
+
+    def _on_update_status(self, event):
+        if not self.model.config['drift_check']:
+            self.__set_drift_status(None)
+            return
+        try:
+            ansible_manager.init_charm(self)
+        except Exception as e:
+            logger.error("Init Ansible extension failed: {}".format(str(e)))
+
+        tags = [tag.strip() for tag in self.model.config['drift_check_tags'].split(',') if tag.strip()]
+        try:
+            state = ansible_manager.check_drift(
                 playbook='playbook.yaml',
-                tags=["stop"],
-                extra_vars=extra_vars,
-                env=env,
+                tags=tags,
+                extra_vars=self.__get_extra_vars(),
+                env=self.__get_environ(),
+                max_tasks=self.model.config['drift_check_tasks'],
+                seconds=self.model.config['drift_check_seconds'],
             )
         except Exception as e:
-            logger.error("Ansible playbook failed: {}".format(str(e)))
+            logger.error("Drift check failed: {}".format(str(e)))
+            return
+        if state is not None:
+            self.__set_drift_status(state.get('last'))
 
-    @property
-    def charm_version(self):
+    def __set_drift_status(self, last_pass):
+        """Summarize drift of the last complete pass in the status of a ready unit."""
         try:
-            # import ansible
-            # version = ansible.__version__
-            from ansible_collections import ansible_release
-            version = ansible_release.ansible_version
+            if not isinstance(self.unit.status, ActiveStatus):
+                return
+            message = "Unit is ready"
+            if last_pass and last_pass['drift']:
+                message += f", drift in {len(last_pass['drift'])} tasks"
+            if last_pass and last_pass['errors']:
+                message += f", drift check failed in {len(last_pass['errors'])} tasks"
+            if self.unit.status.message != message:
+                self.unit.status = ActiveStatus(message)
         except Exception as e:
-            logger.error("Failed to read the ansible version: {}".format(str(e)))
-            version = '0.0.1'
-        return version
+            logger.error("Failed to set drift status: {}".format(str(e)))
+
+    @property
+    def versions(self):
+        """Ansible package versions, read from package metadata once and stored."""
+        if not self._stored.versions:
+            try:
+                self._stored.versions = ansible_manager.package_versions()
+            except Exception as e:
+                logger.error("Failed to read the ansible version: {}".format(str(e)))
+                return {}
+        return dict(self._stored.versions)
+
+    @property
+    def charm_version(self):
+        return self.versions.get('ansible') or '0.0.1'
+
+    def _on_network_changed(self, event):
+        self._stored.network = {}
+
+    @property
+    def network_info(self):
+        """Addresses of the unit, looked up once and stored until relations or networks change."""
+        if not self._stored.network:
+            network = self.model.get_binding(INTERFACE).network
+            self._stored.network = {
+                'ingress_address': str(network.ingress_address),
+                'private_address': str(network.bind_address),
+                # Not part of the ops model
+                'public_address': str(unit_get('public-address') or network.ingress_address),
+            }
+        return dict(self._stored.network)
+
+    @property
+    def unit_state(self):
+        """Unit name and addresses written to the host vars of playbook runs."""
+        network = self.network_info
+        return {
+            'local_unit': self.unit.name,
+            'unit_private_address': network['private_address'],
+            'unit_public_address': network['public_address'],
+        }
 
     @property
     def ingress_address(self):
         """The ingress-address of the swarm cluster
         """
-        return str(self.model.get_binding(INTERFACE).network.ingress_address)
+        return self.network_info['ingress_address']
 
     def _on_ansible_playbook_action(self, event):
         """
@@ -317,13 +655,9 @@ class AnsibleCharm(CharmBase):
             event.fail(f"Init Ansible extension failed: {str(e)}")
             return
 
-        try:
-            import ansible
-            event.log(f"Ansible core version: {ansible.__version__}")
-            from ansible_collections import ansible_release
-            event.log(f"Ansible collections version: {ansible_release.ansible_version}")
-        except Exception as e:
-            event.log(f"Failed to read the ansible version: {str(e)}")
+        versions = self.versions
+        event.log(f"Ansible core version: {versions.get('ansible_core')}")
+        event.log(f"Ansible collections version: {versions.get('ansible')}")
 
         try:
             if str(event.params.get("diff")).lower() in ['1', 'yes', 'y', 'true']:
@@ -346,6 +680,25 @@ class AnsibleCharm(CharmBase):
             logger.error(e)
             event.log("Failed to set verbosity parameter")
 
+        if str(event.params.get("async")).lower() in ['1', 'yes', 'y', 'true']:
+            try:
+                job_id = ansible_manager.start_job(
+                    playbook='playbook.yaml',
+                    tags=tags,
+                    extra_vars=extra_vars,
+                    env=env,
+                    diff=show_diff,
+                    check=check_mode,
+                    **kwargs
+                )
+            except Exception as e:
+                logger.error(e)
+                event.fail(f"Failed to start playbook job: {str(e)}")
+                return
+            event.log(f"Started playbook job: {job_id}")
+            event.set_results({'job-id': job_id, 'status': 'running'})
+            return
+
         try:
             returncode, results = ansible_manager.apply_playbook(
                 playbook='playbook.yaml',
@@ -355,20 +708,249 @@ class AnsibleCharm(CharmBase):
                 diff=show_diff,
                 check=check_mode,
                 throw=True,
+                force=True,
+                progress=event.log,
                 **kwargs
             )
         except Exception as e:
             logger.error(e)
             event.log(f"Ansible playbook failed: {str(e)}")
+            event.set_results({'slowest-tasks': self.__slowest_tasks(event.params.get("top", 10))})
             event.fail(f"Ansible playbook failed: {str(e)}")
             return
         else:
-            event.set_results(dict(
-                returncode=returncode,
-                results=results,
-            ))
+            event.set_results({
+                'returncode': returncode,
+                'results': results,
+                'slowest-tasks': self.__slowest_tasks(event.params.get("top", 10)),
+                **self.__queue_results(),
+            })
+
+    def __queue_results(self):
+        """Wait of the last run in the machine run queue, for action results."""
+        ticket = ansible_manager.queue_ticket
+        if not ticket:
+            return {}
+        return {'queue-wait': f"{ticket['wait']:.1f}", 'queue-depth': ticket['depth']}
+
+    def __slowest_tasks(self, top):
+        """Slowest tasks of the last playbook run, keyed by rank for action results."""
+        try:
+            return self.__format_tasks(ansible_manager.task_timings('playbook.yaml', top=top))
+        except Exception as e:
+            logger.error("Failed to read task timings: {}".format(str(e)))
+            return {}
+
+    def __format_tasks(self, tasks):
+        slowest = {}
+        for rank, task in enumerate(tasks, start=1):
+            slowest[f"{rank:02d}"] = {
+                'name': task['name'],
+                'path': task['path'],
+                'duration': f"{task['duration']:.3f}",
+                'handler': task['handler'],
+                'changed': task['changed'],
+                'failed': task['failed'],
+                'items': task['items'],
+            }
+        return slowest
+
+    def __job(self, event):
+        job_id = event.params.get("job-id")
+        try:
+            return ansible_manager.jobs.get(job_id)
+        except Exception as e:
+            logger.error(e)
+            event.fail(f"Failed to read playbook job {job_id}: {str(e)}")
+            return None
+
+    def _on_job_status_action(self, event):
+        """
+        Show state and progress of playbook jobs started with async=1.
+
+        juju run ansible/0 job-status job-id=20240101120000-a1b2c3
+
+        """
+        if not event.params.get("job-id"):
+            try:
+                jobs = ansible_manager.jobs.list() if ansible_manager.jobs else []
+            except Exception as e:
+                logger.error(e)
+                event.fail(f"Failed to list playbook jobs: {str(e)}")
+                return
+            event.set_results({'jobs': {
+                job['id']: f"{job['status']} {job['playbook']} (tags={','.join(job['tags'])})" for job in jobs
+            }})
+            return
+        job = self.__job(event)
+        if job is None:
+            return
+        results = {key: str(job[key]) for key in ('status', 'playbook', 'created', 'started', 'finished') if key in job}
+        if 'queue_wait' in job:
+            results['queue-wait'] = f"{job['queue_wait']:.1f}"
+            results['queue-depth'] = job['queue_depth']
+        results['tags'] = ','.join(job['tags'])
+        results['progress'] = ansible_manager.jobs.tail(job['id'], 'progress.log', lines=event.params.get("lines", 20))
+        event.set_results(results)
+
+    def _on_job_result_action(self, event):
+        """
+        Show results of a playbook job started with async=1.
+
+        juju run ansible/0 job-result job-id=20240101120000-a1b2c3
+
+        """
+        job = self.__job(event)
+        if job is None:
+            return
+        results = {
+            'status': job['status'],
+            'output': ansible_manager.jobs.tail(job['id'], 'output.log', lines=event.params.get("lines", 50)),
+        }
+        if 'returncode' in job:
+            results['returncode'] = job['returncode']
+            results['results'] = job['results']
+            results['slowest-tasks'] = self.__format_tasks(job.get('slowest_tasks', []))
+        if job.get('error'):
+            results['error'] = job['error']
+        event.set_results(results)
+
+    def _on_drift_report_action(self, event):
+        """
+        Show drift found by the drift checks of update-status hooks.
+
+        juju run ansible/0 drift-report
+
+        """
+        try:
+            state = ansible_manager.drift_state.load()
+        except Exception as e:
+            logger.error(e)
+            event.fail(f"Failed to read drift state: {str(e)}")
+            return
+        results = {'enabled': self.model.config['drift_check']}
+        last = state.get('last')
+        if last:
+            results['last-pass'] = {
+                'started': str(last['started']),
+                'finished': str(last['finished']),
+                'slices': last['slices'],
+                'tasks': last['tasks'],
+                'drift': self.__format_drift(last['drift']),
+                'errors': self.__format_drift(last['errors']),
+            }
+        current = state.get('current')
+        if current:
+            results['current-pass'] = {
+                'started': str(current['started']),
+                'slices': current['slices'],
+                'position': state['position'],
+                'drift': len(current['drift']),
+                'errors': len(current['errors']),
+            }
+        event.set_results(results)
+
+    def __format_drift(self, tasks):
+        return {f"{rank:02d}": dict(task) for rank, task in enumerate(tasks, start=1)}
+
+    def _on_tag_index_action(self, event):
+        """
+        Show the number of playbook tasks run by hooks and by tags.
+
+        juju run ansible/0 tag-index tags=config,debug
+
+        """
+        try:
+            index = ansible_manager.tag_index('playbook.yaml') or ansible_manager.index_tags('playbook.yaml')
+        except Exception as e:
+            logger.error(e)
+            event.fail(f"Failed to index playbook tags: {str(e)}")
+            return
+        if index is None:
+            event.fail("Playbook can not be indexed, see the unit log")
+            return
+        results = {
+            'tasks': index['unknown'] + sum(tag_set['tasks'] for tag_set in index['tag_sets']),
+            'unknown-tags': index['unknown'],
+            'hooks': {tag: ansible_manager.count_tasks('playbook.yaml', [tag]) for tag in HOOK_TAGS},
+            'tag-sets': {
+                f"{rank:02d}": {'tags': ','.join(tag_set['tags']) or 'untagged', 'tasks': tag_set['tasks']}
+                for rank, tag_set in enumerate(index['tag_sets'], start=1)
+            },
+        }
+        if event.params.get("tags"):
+            results['selected'] = ansible_manager.count_tasks('playbook.yaml', event.params["tags"].split(','))
+        event.set_results(results)
+
+    def _on_history_action(self, event):
+        """
+        Show recent playbook runs and run durations per tag.
+
+        juju run ansible/0 history tag=config hours=24
+
+        """
+        filters = {}
+        if event.params.get("tag"):
+            filters['tag'] = event.params["tag"]
+        if event.params.get("hook"):
+            filters['hook'] = event.params["hook"]
+        if event.params.get("hours"):
+            filters['since'] = time.time() - float(event.params["hours"]) * 3600
+        if event.params.get("failed"):
+            filters['failed'] = True
+        try:
+            runs, durations = ansible_manager.run_history(limit=event.params.get("limit", 20), **filters)
+        except Exception as e:
+            logger.error(e)
+            event.fail(f"Failed to read run history: {str(e)}")
+            return
+        event.set_results({
+            'runs': {
+                f"{rank:02d}": {
+                    'hook': run['hook'] or 'unknown',
+                    'playbook': run['playbook'],
+                    'tags': ','.join(run['tags']),
+                    'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started'])),
+                    'duration': f"{run['duration']:.3f}",
+                    'returncode': run['returncode'],
+                    'changed': run['changed'],
+                    'skipped': run['skipped'],
+                }
+                for rank, run in enumerate(runs, start=1)
+            },
+            # Tags may hold characters not allowed in result keys
+            'durations': {
+                f"{rank:02d}": {
+                    'tag': tag,
+                    'runs': summary['runs'],
+                    'failed': summary['failed'],
+                    'changed': summary['changed'],
+                    'p50': f"{summary['p50']:.3f}",
+                    'p95': f"{summary['p95']:.3f}",
+                    'max': f"{summary['max']:.3f}",
+                }
+                for rank, (tag, summary) in enumerate(durations.items(), start=1)
+            },
+        })
+
+    def _on_flush_fact_cache_action(self, event):
+        """
+        Remove cached Ansible facts, the next playbook run gathers them again.
+
+        juju run ansible/0 flush-fact-cache
+
+        """
+        try:
+            flushed = ansible_manager.flush_fact_cache()
+        except Exception as e:
+            logger.error(e)
+            event.fail(f"Failed to flush fact cache: {str(e)}")
+            return
+        event.set_results(dict(flushed=flushed))
 
     def _on_data_storage_attached(self, event):
+        # Mounts are part of the facts
+        self.__flush_fact_cache()
         try:
             storage_name = self._stored.storage_name
             volumes = self.model.storages[storage_name]
@@ -415,6 +997,8 @@ class AnsibleCharm(CharmBase):
                     diff=True,
                     check=False,
                     throw=True,
+                    # Detaching unmounted the volume, a mount with the same inputs is no cache hit
+                    force=True,
                 )
             except Exception as e:
                 logger.error(e)
@@ -424,6 +1008,7 @@ class AnsibleCharm(CharmBase):
 
     def _on_data_storage_detaching(self, event):
         storage_name = self._stored.storage_name
+        self.__flush_fact_cache()
         try:
             extra_vars = self.__get_extra_vars()
         except Exception as e:
@@ -442,6 +1027,8 @@ class AnsibleCharm(CharmBase):
                 diff=True,
                 check=False,
                 throw=True,
+                # Attaching mounted the volume again since the last unmount
+                force=True,
             )
         except Exception as e:
             logger.error(e)
@@ -3,16 +3,59 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from unittest.mock import Mock
+from unittest.mock import patch
 
 from charm import AnsibleCharm
 from ops.model import ActiveStatus
+from ops.model import BlockedStatus
+from ops.model import MaintenanceStatus
+from ops.model import WaitingStatus
 from ops.testing import Harness
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds for the import of the charm plus a config-changed hook which has nothing to run,
+# generous for slow machines (about 0.2s here)
+NO_OP_HOOK_BUDGET = float(os.environ.get('NO_OP_HOOK_BUDGET', 2.0))
+
+NO_OP_HOOK_SCRIPT = """
+import json, sys, tempfile, time
+from unittest.mock import patch
+start = time.perf_counter()
+from ops.testing import Harness
+from charm import AnsibleCharm
+from extensions import ansible_manager, ansible_playbook
+import_time = time.perf_counter() - start
+ansible_manager.state_dir = tempfile.mkdtemp()
+harness = Harness(AnsibleCharm)
+harness.begin()
+with patch.object(ansible_playbook, 'run_request', return_value=(0, {})) as run_request:
+    harness.update_config({'playbook': '- hosts: localhost\\n  tasks:\\n    - ping:\\n      tags: [config]\\n'})
+    start = time.perf_counter()
+    harness.update_config({'crontab': '0 0 * * * root /usr/bin/true'})
+    hook_time = time.perf_counter() - start
+print(json.dumps({
+    'elapsed': import_time + hook_time,
+    'runs': run_request.call_count,
+    'ansible': sorted(m for m in sys.modules if m.split('.')[0] in ('ansible', 'ansible_collections')),
+}))
+"""
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
+        # The charm writes the playbook and its tag index to the working directory
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
         self.harness = Harness(AnsibleCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
@@ -22,6 +65,158 @@ class TestCharm(unittest.TestCase):
         self.harness.update_config({"crontab": "* * * * * root /usr/bin/true"})
         self.assertEqual(str(self.harness.charm._stored.crontab), "* * * * * root /usr/bin/true")
 
+    def test_versions_stored(self):
+        self.harness.charm._stored.versions = {'ansible_core': '2.14.0', 'ansible': '7.0.0'}
+        self.assertEqual(self.harness.charm.charm_version, '7.0.0')
+
+    def test_no_op_hook_skips_ansible(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([
+            os.path.join(ROOT, 'lib'), os.path.join(ROOT, 'src'), os.environ.get('PYTHONPATH', ''),
+        ]))
+        output = subprocess.check_output([sys.executable, '-c', NO_OP_HOOK_SCRIPT], env=env)
+        measured = json.loads(output.decode('utf-8').splitlines()[-1])
+        self.assertEqual(measured['runs'], 1)
+        self.assertEqual(measured['ansible'], [])
+        self.assertLess(measured['elapsed'], NO_OP_HOOK_BUDGET)
+
+    def test_hook_tool_calls(self):
+        from extensions import ansible_playbook
+
+        self.harness.add_network('10.0.0.10', endpoint='juju-info')
+        relation_id = self.harness.add_relation('juju-info', 'ubuntu')
+        network_get = self.harness._backend.network_get
+        calls = []
+
+        def check_output(args):
+            calls.append(args[0])
+            return b'"192.0.2.10"'
+
+        def counted_network_get(*args, **kwargs):
+            calls.append('network-get')
+            return network_get(*args, **kwargs)
+
+        def hook(emit):
+            """Emit an event as if in a new hook process, return its hook tool calls."""
+            calls.clear()
+            ansible_playbook.unit_get.flush()
+            self.harness.model._bindings._data.clear()
+            emit()
+            return list(calls)
+
+        with patch.object(ansible_playbook.subprocess, 'check_output', side_effect=check_output), \
+                patch.object(self.harness._backend, 'network_get', side_effect=counted_network_get), \
+                patch.object(ansible_playbook, 'run_request', return_value=(0, {})):
+            self.assertEqual(sorted(hook(self.harness.charm.on.config_changed.emit)), ['network-get', 'unit-get'])
+            self.assertEqual(self.harness.charm.unit_state['unit_public_address'], '192.0.2.10')
+            self.assertEqual(hook(self.harness.charm.on.update_status.emit), [])
+            self.assertEqual(hook(lambda: self.harness.charm.unit_state), [])
+            # Juju reports changed unit addresses with config-changed
+            config_changed = hook(lambda: self.harness.update_config({'crontab': '0 0 * * * root true'}))
+            self.assertEqual(sorted(config_changed), ['network-get', 'unit-get'])
+            # Relation changes may come with new addresses
+            self.harness.add_relation_unit(relation_id, 'ubuntu/0')
+            self.assertEqual(sorted(hook(lambda: self.harness.charm.unit_state)), ['network-get', 'unit-get'])
+
+    def test_rollout_batches(self):
+        from extensions import ansible_manager
+
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation('rollout', 'ansible')
+        for unit in ('ansible/1', 'ansible/2', 'ansible/3'):
+            self.harness.add_relation_unit(relation_id, unit)
+        with patch.object(ansible_manager, 'apply_playbook', return_value=(0, {})) as apply_playbook:
+            self.harness.update_config({'rollout_tags': 'config', 'rollout_batch_size': 2})
+        # The leader is the canary unit, its success starts the first batch
+        self.assertEqual([call.kwargs['tags'] for call in apply_playbook.call_args_list], [['config']])
+        revision = ansible_manager.rollout_revision()
+        self.assertEqual(self.harness.get_relation_data(relation_id, 'ansible/0'), {
+            'revision': revision, 'status': 'succeeded',
+        })
+        planned = json.loads(self.harness.get_relation_data(relation_id, 'ansible')['rollout'])
+        self.assertEqual(planned, {'revision': revision, 'batch': ['ansible/1', 'ansible/2']})
+        self.assertIsInstance(self.harness.charm.app.status, MaintenanceStatus)
+        self.assertIn('1/4 units done', self.harness.charm.app.status.message)
+
+        self.harness.update_relation_data(relation_id, 'ansible/1', {'revision': revision, 'status': 'succeeded'})
+        self.harness.update_relation_data(relation_id, 'ansible/2', {'revision': revision, 'status': 'failed'})
+        planned = json.loads(self.harness.get_relation_data(relation_id, 'ansible')['rollout'])
+        self.assertEqual(planned['batch'], [])
+        self.assertIsInstance(self.harness.charm.app.status, BlockedStatus)
+        self.assertIn('failed on ansible/2', self.harness.charm.app.status.message)
+
+        # Clearing rollout_tags ends the rollout
+        with patch.object(ansible_manager, 'apply_playbook', return_value=(0, {})):
+            self.harness.update_config({'rollout_tags': ''})
+        self.assertNotIn('rollout', self.harness.get_relation_data(relation_id, 'ansible'))
+        self.assertEqual(self.harness.charm.app.status, ActiveStatus())
+
+    def test_rollout_deferred(self):
+        from extensions import ansible_manager
+
+        relation_id = self.harness.add_relation('rollout', 'ansible')
+        self.harness.add_relation_unit(relation_id, 'ansible/1')
+        with patch.object(ansible_manager, 'apply_playbook', return_value=(0, {})) as apply_playbook:
+            self.harness.update_config({'rollout_tags': 'config'})
+            self.assertFalse(apply_playbook.called)
+            self.assertIsInstance(self.harness.charm.unit.status, WaitingStatus)
+            planned = {'revision': ansible_manager.rollout_revision(), 'batch': ['ansible/0']}
+            self.harness.update_relation_data(relation_id, 'ansible', {'rollout': json.dumps(planned)})
+        self.assertEqual(apply_playbook.call_count, 1)
+        self.assertEqual(self.harness.get_relation_data(relation_id, 'ansible/0')['status'], 'succeeded')
+        self.assertIsInstance(self.harness.charm.unit.status, ActiveStatus)
+
+    def test_rollout_cleared(self):
+        from extensions import ansible_manager
+
+        relation_id = self.harness.add_relation('rollout', 'ansible')
+        self.harness.add_relation_unit(relation_id, 'ansible/1')
+        with patch.object(ansible_manager, 'apply_playbook', return_value=(0, {})):
+            self.harness.update_config({'rollout_tags': 'config'})
+            self.assertIsInstance(self.harness.charm.unit.status, WaitingStatus)
+            self.harness.update_config({'rollout_tags': ''})
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus("Unit is ready"))
+
+    def test_history_action(self):
+        from extensions import ansible_manager
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        with patch.object(ansible_manager, 'state_dir', tmpdir.name), \
+                patch.dict(os.environ, {'JUJU_DISPATCH_PATH': 'hooks/config-changed'}), \
+                patch('extensions.ansible_playbook.run_request', return_value=(0, {'localhost': {'changed': 1}})):
+            playbook = '- hosts: localhost\n  tasks:\n    - ping:\n      tags: [config]\n'
+            self.harness.update_config({'playbook': playbook})
+            action_event = Mock(params={"tag": "config", "hours": 1, "limit": 5})
+            self.harness.charm._on_history_action(action_event)
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['runs']['01']['hook'], 'config-changed')
+        self.assertEqual(results['runs']['01']['changed'], 1)
+        self.assertEqual((results['durations']['01']['tag'], results['durations']['01']['runs']), ('config', 1))
+
+    def test_start_restarts_runner_without_start_tasks(self):
+        from extensions import ansible_manager
+
+        with patch.object(ansible_manager, 'start_runner') as start_runner, \
+                patch.object(ansible_manager, 'stop_runner'), \
+                patch.object(ansible_manager, 'apply_playbook') as apply_playbook:
+            self.harness.update_config({'runner_daemon': True})
+            start_runner.reset_mock()
+            apply_playbook.reset_mock()
+            self.harness.charm.on.start.emit()
+        self.assertEqual(start_runner.call_count, 1)
+        self.assertFalse(apply_playbook.called)
+        self.assertIsInstance(self.harness.charm.unit.status, ActiveStatus)
+
+    def test_start_forced(self):
+        from extensions import ansible_manager
+
+        with patch.object(ansible_manager, 'apply_playbook') as apply_playbook:
+            self.harness.update_config({'playbook': '- hosts: localhost\n  tasks:\n    - ping:\n      tags: [start]\n'})
+            apply_playbook.reset_mock()
+            self.harness.charm.on.start.emit()
+        self.assertEqual(apply_playbook.call_args.kwargs['tags'], ['start'])
+        self.assertTrue(apply_playbook.call_args.kwargs['force'])
+
     def test_action(self):
         # the harness doesn't (yet!) help much with actions themselves
         action_event = Mock(params={"tags": ""})
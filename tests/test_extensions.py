@@ -0,0 +1,1141 @@
+# Copyright 2022 vagrant
+# See LICENSE file for licensing details.
+
+import configparser
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from extensions import accelerate
+from extensions import ansible_playbook
+from extensions import apt_cache
+from extensions import memoize
+from extensions import module_server
+from extensions import payload_cache
+from extensions import runner
+from extensions import yaml_io
+from extensions.callbacks import ProgressCallback
+from extensions.drift import DriftSlice
+from extensions.callbacks import TaskTimingCallback
+from extensions.fingerprint import fingerprint
+from extensions.fingerprint import fingerprint_env
+from extensions.fingerprint import fingerprint_extra_vars
+from extensions.fingerprint import referenced_files
+from extensions.history import RunHistory
+from extensions.metrics import RunMetrics
+from extensions.jobs import JobNotFound
+from extensions.jobs import JobStore
+from extensions.planner import TaskPlanner
+from extensions.planner import playbook_uses
+from extensions.playbook_cache import ParsedPlaybookCache
+from extensions.rollout import config_revision
+from extensions.rollout import plan_rollout
+from extensions.run_queue import RunQueue
+from extensions.schedule import Schedule
+from extensions.schedule import parse_schedule
+from extensions.schedule import unit_jitter
+from extensions.tag_index import TagIndex
+
+
+PLAYBOOK = """
+- hosts: localhost
+  tasks:
+    - name: Include tasks
+      ansible.builtin.include_tasks: extra.yaml
+"""
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        self.extra = os.path.join(self.tmpdir.name, 'extra.yaml')
+        with open(self.playbook, 'w') as f:
+            f.write(PLAYBOOK)
+        with open(self.extra, 'w') as f:
+            f.write("- name: Noop\n  ansible.builtin.debug: {}\n")
+        queue_dir = os.path.join(self.tmpdir.name, 'queue')
+        patcher = patch.object(ansible_playbook, 'RunQueue', lambda: RunQueue(path=queue_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_referenced_files(self):
+        self.assertEqual(referenced_files(self.playbook), [self.extra])
+
+    def test_fingerprint_follows_references(self):
+        digest = fingerprint(self.playbook, tags=['config'])
+        self.assertEqual(digest, fingerprint(self.playbook, tags=['config']))
+        self.assertNotEqual(digest, fingerprint(self.playbook, tags=['install']))
+        with open(self.extra, 'a') as f:
+            f.write("- name: Other\n  ansible.builtin.debug: {}\n")
+        self.assertNotEqual(digest, fingerprint(self.playbook, tags=['config']))
+
+    def test_fingerprint_env_ignores_hook_context(self):
+        env = {'JUJU_CONTEXT_ID': 'ansible/0-config-changed-1', 'PATH': '/usr/bin'}
+        self.assertEqual(fingerprint_env(env), {'PATH': '/usr/bin'})
+
+    def test_fingerprint_ignores_machine_state(self):
+        self.assertEqual(fingerprint_extra_vars({'leader': True, 'apt_cache_fresh': False}), {'leader': True})
+
+    def test_apply_playbook_skips_unchanged(self):
+        manager = ansible_playbook.Ansible()
+        manager.state_dir = self.tmpdir.name
+        with patch.object(ansible_playbook, 'AnsiblePlaybook') as pb:
+            pb.return_value.run.return_value = (0, {'localhost': {'changed': 1}})
+            self.assertEqual(manager.apply_playbook(self.playbook, tags=['config']), (0, {'localhost': {'changed': 1}}))
+            self.assertEqual(manager.apply_playbook(self.playbook, tags=['config']), (0, {'localhost': {'changed': 1}}))
+            self.assertEqual(pb.return_value.run.call_count, 1)
+            manager.apply_playbook(self.playbook, tags=['config'], force=True)
+            self.assertEqual(pb.return_value.run.call_count, 2)
+            manager.apply_playbook(self.playbook, tags=['config'], extra_vars={'leader': True})
+            self.assertEqual(pb.return_value.run.call_count, 3)
+
+    def test_runner_fallback_in_process(self):
+        manager = ansible_playbook.Ansible()
+        manager.unit_name = 'ansible/0'
+        with patch.object(runner, 'RUNNER_DIR', self.tmpdir.name), \
+                patch.object(ansible_playbook, 'run_request', return_value=(0, {})) as run_request:
+            self.assertFalse(runner.is_running(manager.runner_socket))
+            self.assertEqual(manager.apply_playbook(self.playbook, tags=['config']), (0, {}))
+            self.assertEqual(run_request.call_args[0][0]['options']['tags'], ['config'])
+
+    def test_session_shared_by_runs(self):
+        manager = ansible_playbook.Ansible()
+        with patch.object(ansible_playbook, 'AnsibleSession') as session, \
+                patch.object(ansible_playbook, 'run_request', return_value=(0, {})) as run_request:
+            with manager.session():
+                manager.apply_playbook(self.playbook, tags=['install'])
+                manager.apply_playbook(self.playbook, tags=['mount'])
+            manager.apply_playbook(self.playbook, tags=['config'])
+        self.assertEqual(session.call_count, 1)
+        sessions = [call.kwargs['session'] for call in run_request.call_args_list]
+        self.assertEqual(sessions, [session.return_value, session.return_value, None])
+
+    def test_apply_playbooks_in_one_request(self):
+        manager = ansible_playbook.Ansible()
+        manager.state_dir = self.tmpdir.name
+        runs = [
+            dict(playbook=self.playbook, tags=['install']),
+            dict(playbook=self.playbook, tags=['mount'], diff=True),
+        ]
+        outcomes = [(0, {'localhost': {'ok': 1}}), (2, {'localhost': {'failures': 1}})]
+        with patch.object(ansible_playbook, 'run_request', return_value=(2, outcomes)) as run_request:
+            self.assertEqual(manager.apply_playbooks(runs), outcomes)
+            request = run_request.call_args[0][0]
+            self.assertEqual([run['options']['tags'] for run in request['runs']], [['install'], ['mount']])
+            self.assertEqual([run['options']['diff'] for run in request['runs']], [False, True])
+            # Only the failed run is executed again
+            run_request.return_value = outcomes[1]
+            with self.assertRaises(ansible_playbook.AnsiblePlaybookError):
+                manager.apply_playbooks([runs[0], dict(runs[1], throw=True)])
+            self.assertEqual(run_request.call_args[0][0]['options']['tags'], ['mount'])
+
+
+class TestRunner(unittest.TestCase):
+    playbook_text = """
+- hosts: localhost
+  connection: local
+  gather_facts: false
+  tasks:
+    - ansible.builtin.set_fact:
+        answer: 42
+      tags: [config]
+    - ansible.builtin.command: /bin/false
+      tags: [config]
+"""
+
+    def setUp(self):
+        import logging
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        hosts_path = os.path.join(self.tmpdir.name, 'hosts')
+        with open(hosts_path, 'w') as f:
+            f.write('[all]\nlocalhost ansible_connection=local\n')
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        with open(self.playbook, 'w') as f:
+            f.write(self.playbook_text)
+        for name, value in (
+            ('ANSIBLE_HOSTS_PATH', hosts_path),
+            ('ANSIBLE_VARS_PATH', os.path.join(self.tmpdir.name, 'host_vars', 'localhost')),
+        ):
+            patcher = patch.object(ansible_playbook, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Records of the child are collected at the level of the hook
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(logging.DEBUG)
+        self.socket = os.path.join(self.tmpdir.name, 'ansible-0.sock')
+
+    def start_daemon(self):
+        # Forked, so the daemon runs with the paths patched by the test
+        daemon = multiprocessing.get_context('fork').Process(target=runner.serve, args=(self.socket,))
+        daemon.start()
+        self.addCleanup(daemon.join, 10)
+        self.addCleanup(runner.stop, self.socket)
+        for _ in range(100):
+            if runner.is_running(self.socket):
+                return
+            time.sleep(0.1)
+        self.fail('Runner did not start')
+
+    def request(self):
+        manager = ansible_playbook.Ansible()
+        manager.app_name = 'ansible'
+        manager.unit_state = {
+            'local_unit': 'ansible/0', 'unit_private_address': '127.0.0.1', 'unit_public_address': '127.0.0.1',
+        }
+        return manager._plan_run(self.playbook, tags=['config'], become=False)['request']
+
+    def test_daemon_matches_in_process(self):
+        request = self.request()
+        with self.assertLogs('extensions', level='DEBUG') as logs:
+            local = ansible_playbook.run_request(request)
+        self.start_daemon()
+        with self.assertLogs('extensions', level='DEBUG') as daemon_logs:
+            remote = runner.request_run(self.socket, request)
+        self.assertEqual(local[0], 2)
+        self.assertEqual(remote, local)
+        # Log records of the child are emitted by the hook, with their logger and level
+        self.assertEqual(
+            [(record.name, record.levelno) for record in daemon_logs.records],
+            [(record.name, record.levelno) for record in logs.records],
+        )
+        self.assertIn('Parsed playbook cache miss', ' '.join(daemon_logs.output))
+
+    def test_lost_run_fails(self):
+        def lost(*args, **kwargs):
+            os._exit(1)
+
+        with patch.object(ansible_playbook, 'run_request', lost):
+            self.start_daemon()
+        with self.assertRaises(runner.RunnerLost):
+            runner.request_run(self.socket, self.request())
+        manager = ansible_playbook.Ansible()
+        manager.unit_name = 'ansible/0'
+        with patch.object(runner, 'RUNNER_DIR', self.tmpdir.name), \
+                patch.object(ansible_playbook, 'run_request') as run_request:
+            self.assertEqual(manager.apply_playbook(self.playbook, tags=['config']), (runner.RUN_LOST_RETURNCODE, {}))
+        # Not repeated in-process, tasks may have run
+        self.assertFalse(run_request.called)
+
+
+class TestAnsibleConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.manager = ansible_playbook.Ansible()
+        self.manager.state_dir = self.tmpdir.name
+        search = (os.path.join(self.tmpdir.name, 'missing.cfg'),)
+        patcher = patch.object(ansible_playbook, 'ANSIBLE_CONFIG_SEARCH', search)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(os.environ.pop, 'ANSIBLE_CONFIG', None)
+
+    def test_fact_cache_config(self):
+        self.assertTrue(self.manager.configure(fact_cache_timeout=600))
+        self.assertFalse(self.manager.configure(fact_cache_timeout=600))
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(self.manager.config_path)
+        self.assertEqual(config['defaults']['gathering'], 'smart')
+        self.assertEqual(config['defaults']['fact_caching_connection'], self.manager.fact_cache_dir)
+        self.assertEqual(config['defaults']['fact_caching_timeout'], '600')
+        self.manager._export_config()
+        self.assertEqual(os.environ['ANSIBLE_CONFIG'], self.manager.config_path)
+
+        os.makedirs(self.manager.fact_cache_dir)
+        self.assertTrue(self.manager.configure(fact_cache_timeout=0))
+        self.assertFalse(os.path.exists(self.manager.config_path))
+        self.assertFalse(os.path.exists(self.manager.fact_cache_dir))
+        self.assertNotIn('ANSIBLE_CONFIG', os.environ)
+
+    def test_execution_settings(self):
+        self.assertTrue(self.manager.configure(
+            forks=4, strategy='free', pipelining=True, internal_poll_interval=0.01, task_timeout=60,
+        ))
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(self.manager.config_path)
+        self.assertEqual(dict(config['defaults']), {
+            'forks': '4', 'strategy': 'free', 'internal_poll_interval': '0.01', 'task_timeout': '60',
+        })
+        self.assertEqual(config['connection']['pipelining'], 'True')
+        self.assertFalse(self.manager.configure(
+            forks=4, strategy='free', pipelining=True, internal_poll_interval=0.01, task_timeout=60,
+        ))
+        with self.assertRaises(ansible_playbook.AnsiblePlaybookError):
+            self.manager.configure(strategy='parallel')
+
+    def test_flush_fact_cache(self):
+        self.assertFalse(self.manager.flush_fact_cache())
+        os.makedirs(self.manager.fact_cache_dir)
+        with open(os.path.join(self.manager.fact_cache_dir, 'localhost'), 'w') as f:
+            f.write('{}')
+        self.assertTrue(self.manager.flush_fact_cache())
+        self.assertFalse(os.path.exists(self.manager.fact_cache_dir))
+
+
+class TestTaskTiming(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        with open(self.playbook, 'w') as f:
+            f.write(PLAYBOOK)
+
+    def _task(self, name):
+        task = Mock(_uuid=name, action='ansible.builtin.debug')
+        task.get_name.return_value = name
+        task.get_path.return_value = f"{self.playbook}:1"
+        return task
+
+    def test_timing_table(self):
+        timing = TaskTimingCallback(path=ansible_playbook.timing_path)
+        timing.v2_playbook_on_start(Mock(_file_name=self.playbook))
+        loop, handler = self._task('Loop'), self._task('Handler')
+        timing.v2_playbook_on_task_start(loop, False)
+        for _ in range(3):
+            timing.v2_runner_item_on_ok(Mock(_task=loop))
+        timing.v2_runner_on_ok(Mock(_task=loop, _result={'changed': True}))
+        timing.v2_playbook_on_handler_task_start(handler)
+        timing.v2_runner_on_failed(Mock(_task=handler, _result={}), ignore_errors=True)
+        timing.v2_playbook_on_stats(Mock())
+
+        with open(os.path.join(self.tmpdir.name, 'playbook.timing.json'), 'r') as f:
+            table = json.load(f)
+        self.assertEqual(table, timing.tables[0])
+        self.assertEqual([(t['name'], t['handler']) for t in table['tasks']], [('Loop', False), ('Handler', True)])
+        self.assertEqual((table['tasks'][0]['ok'], table['tasks'][0]['changed'], table['tasks'][0]['items']), (1, 1, 3))
+        self.assertEqual(table['tasks'][1]['ignored'], 1)
+
+        table['tasks'][1]['duration'] = 99.0
+        with open(ansible_playbook.timing_path(self.playbook), 'w') as f:
+            json.dump(table, f)
+        manager = ansible_playbook.Ansible()
+        self.assertEqual([t['name'] for t in manager.task_timings(self.playbook, top=1)], ['Handler'])
+
+
+class TestProgressCallback(unittest.TestCase):
+    def test_batched_progress(self):
+        sink = Mock()
+        progress = ProgressCallback(sink, interval=60, max_lines=5)
+        self.addCleanup(progress.flush)
+        for i in range(10):
+            task = Mock(_uuid=str(i))
+            task.get_name.return_value = f"Task {i}"
+            progress.v2_playbook_on_task_start(task, False)
+            progress.v2_runner_on_ok(Mock(_task=task, _result={'changed': i == 0}))
+        # First line is sent at once, the rest waits for the interval
+        self.assertEqual(sink.call_args_list[0][0][0], 'TASK [Task 0]')
+        self.assertEqual(sink.call_count, 1)
+
+        stats = Mock(processed={'localhost': 1})
+        stats.summarize.return_value = {'ok': 10}
+        progress.v2_playbook_on_stats(stats)
+        self.assertEqual(sink.call_count, 2)
+        lines = sink.call_args[0][0].splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0], '... 16 earlier lines')
+        self.assertEqual(lines[-1], "RECAP [localhost] ok=10")
+
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = JobStore(os.path.join(self.tmpdir.name, 'jobs'), retention=2)
+        self.run = {'request': {'playbook': 'playbook.yaml', 'options': {'tags': ['config']}}}
+
+    def test_job_state(self):
+        job_id = self.store.create(self.run)
+        job = self.store.get(job_id)
+        self.assertEqual((job['status'], job['playbook'], job['tags']), ('pending', 'playbook.yaml', ['config']))
+        self.assertEqual(self.store.load_run(job_id), self.run)
+        self.store.update(job_id, status='running', pid=os.getpid())
+        self.assertEqual(self.store.get(job_id)['status'], 'running')
+        for i in range(3):
+            self.store.append_progress(job_id, f"TASK [{i}]")
+        self.assertEqual(self.store.tail(job_id, 'progress.log', lines=2), "TASK [1]\nTASK [2]")
+        with patch('extensions.jobs._pid_alive', return_value=False):
+            self.assertEqual(self.store.get(job_id)['status'], 'lost')
+        for job_id in ('', '../jobs', '.hidden', 'missing'):
+            with self.assertRaises(JobNotFound):
+                self.store.get(job_id)
+
+    def test_prune_finished_jobs(self):
+        running = self.store.create(self.run)
+        self.store.update(running, status='running', pid=os.getpid())
+        finished = []
+        for _ in range(3):
+            finished.append(self.store.create(self.run))
+            self.store.update(finished[-1], status='succeeded')
+        self.store.prune()
+        kept = [job['id'] for job in self.store.list()]
+        self.assertIn(running, kept)
+        self.assertEqual(len(kept), 3)
+        self.assertNotIn(finished[0], kept)
+
+
+def _queue_worker(queue_dir, owner, runs, barrier, log_path):
+    queue = RunQueue(path=queue_dir, poll_interval=0.01)
+    barrier.wait()
+    for _ in range(runs):
+        with queue.slot(owner) as ticket:
+            # Fails if another run holds the slot too
+            fd = os.open(os.path.join(queue_dir, 'holder'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with open(log_path, 'a') as f:
+                f.write(f"{ticket['id']} {owner}\n")
+            time.sleep(0.005)
+            os.close(fd)
+            os.unlink(os.path.join(queue_dir, 'holder'))
+
+
+class TestRunHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.history = RunHistory(os.path.join(self.tmpdir.name, 'state', 'history.sqlite'), max_runs=50)
+
+    def record(self, tags, started, duration, returncode=0, changed=0, hook='config-changed', skipped=False):
+        stats = {'localhost': {'ok': 3, 'changed': changed, 'failures': int(returncode != 0), 'unreachable': 0}}
+        return self.history.record(
+            'playbook.yaml', tags, started, started + duration, returncode, stats, hook=hook, skipped=skipped,
+        )
+
+    def test_query(self):
+        self.assertEqual(self.history.query(), [])
+        self.record(['install'], 100, 5, hook='install', changed=2)
+        self.record(['config'], 200, 1, returncode=2)
+        self.record([], 300, 0, hook='action:ansible-playbook', skipped=True)
+        runs = self.history.query()
+        self.assertEqual([run['tags'] for run in runs], [['all'], ['config'], ['install']])
+        self.assertEqual((runs[2]['changed'], runs[2]['duration']), (2, 5))
+        self.assertEqual(runs[1]['stats']['localhost']['failures'], 1)
+        self.assertEqual([run['started'] for run in self.history.query(tag='config')], [200])
+        self.assertEqual([run['hook'] for run in self.history.query(failed=True)], ['config-changed'])
+        self.assertEqual([run['started'] for run in self.history.query(since=150, hook='config-changed')], [200])
+        self.assertEqual(len(self.history.query(limit=1)), 1)
+
+    def test_durations_and_retention(self):
+        for i in range(60):
+            self.record(['config', 'debug'] if i % 2 else ['config'], 1000 + i, float(i))
+        self.record(['config'], 2000, 999, skipped=True)
+        runs = self.history.query(limit=0)
+        self.assertEqual(len(runs), 50)
+        durations = self.history.durations()
+        self.assertEqual(durations['config']['runs'], 49)
+        self.assertEqual(durations['config']['p50'], 35)
+        self.assertEqual(durations['config']['p95'], 57)
+        self.assertEqual(durations['config']['max'], 59)
+        self.assertEqual(durations['debug']['runs'], 25)
+        self.assertEqual(list(self.history.durations(tag='debug')), ['debug'])
+
+
+class TestRunMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.metrics = RunMetrics(os.path.join(self.tmpdir.name, 'state', 'metrics.json'))
+        self.stats = {'localhost': {'ok': 4, 'changed': 2, 'failures': 0, 'unreachable': 0, 'skipped': 1}}
+
+    def test_render(self):
+        self.metrics.observe(['config'], duration=3.5, returncode=0, results=self.stats, queue_wait=0.5, finished=100)
+        self.metrics.observe(['config'], duration=0, returncode=0, results=self.stats, skipped=True, finished=200)
+        self.metrics.observe(['install', 'debug'], duration=400, returncode=2, results=self.stats, queue_wait=1.5)
+        text = self.metrics.render(labels={'unit': 'ansible/0'}, caches={'payload': {'hits': 3, 'misses': 1}})
+        lines = set(text.splitlines())
+        for line in (
+            '# TYPE charm_ansible_run_duration_seconds histogram',
+            'charm_ansible_run_duration_seconds_bucket{unit="ansible/0",tags="config",le="1"} 0',
+            'charm_ansible_run_duration_seconds_bucket{unit="ansible/0",tags="config",le="5"} 1',
+            'charm_ansible_run_duration_seconds_bucket{unit="ansible/0",tags="debug,install",le="300"} 0',
+            'charm_ansible_run_duration_seconds_bucket{unit="ansible/0",tags="debug,install",le="+Inf"} 1',
+            'charm_ansible_run_duration_seconds_sum{unit="ansible/0",tags="config"} 3.5',
+            'charm_ansible_runs_total{unit="ansible/0",tags="config",result="skipped"} 1',
+            'charm_ansible_runs_total{unit="ansible/0",tags="debug,install",result="failed"} 1',
+            'charm_ansible_tasks_total{unit="ansible/0",tags="config",status="changed"} 2',
+            'charm_ansible_last_success_timestamp_seconds{unit="ansible/0",tags="config"} 200',
+            'charm_ansible_last_success_timestamp_seconds{unit="ansible/0",tags="debug,install"} 0',
+            'charm_ansible_queue_wait_seconds_sum{unit="ansible/0"} 2.0',
+            'charm_ansible_last_queue_wait_seconds{unit="ansible/0"} 1.5',
+            'charm_ansible_cache_requests_total{unit="ansible/0",cache="run",result="hit"} 1',
+            'charm_ansible_cache_hit_ratio{unit="ansible/0",cache="payload"} 0.75',
+        ):
+            self.assertIn(line, lines)
+
+    def test_locked_update(self):
+        import fcntl
+        import threading
+
+        self.metrics.observe(['config'], duration=1, returncode=0, results=self.stats)
+        with open(f"{self.metrics.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with patch('extensions.metrics.LOCK_TIMEOUT', 0.1):
+                self.assertFalse(self.metrics.observe(['config'], duration=1, returncode=0, results=self.stats))
+            # Waits for a short update of another run
+            threading.Timer(0.2, fcntl.flock, (lock, fcntl.LOCK_UN)).start()
+            self.assertTrue(self.metrics.observe(['config'], duration=1, returncode=0, results=self.stats))
+        self.assertEqual(self.metrics.load()['runs']['config']['count'], 2)
+
+    def test_written_after_runs(self):
+        manager = ansible_playbook.Ansible()
+        manager.state_dir = os.path.join(self.tmpdir.name, 'state')
+        manager.metrics_dir = os.path.join(self.tmpdir.name, 'textfile')
+        manager.unit_name = 'ansible/0'
+        os.makedirs(manager.metrics_dir)
+        playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        with open(playbook, 'w') as f:
+            f.write('- hosts: localhost\n  tasks: [{ping: {}, tags: [config]}]\n')
+        with patch.object(ansible_playbook, 'run_request', return_value=(0, self.stats)):
+            manager.apply_playbook(playbook, tags=['config'])
+        self.assertEqual(os.listdir(manager.metrics_dir), ['charm_ansible_ansible_0.prom'])
+        with open(os.path.join(manager.metrics_dir, 'charm_ansible_ansible_0.prom')) as f:
+            self.assertIn('charm_ansible_runs_total{unit="ansible/0",tags="config",result="succeeded"} 1', f.read())
+        manager.remove_metrics()
+        self.assertEqual(os.listdir(manager.metrics_dir), [])
+        # An unwritable directory never fails the run
+        manager.metrics_dir = os.path.join(self.tmpdir.name, 'missing')
+        with patch.object(ansible_playbook, 'run_request', return_value=(0, self.stats)):
+            self.assertEqual(manager.apply_playbook(playbook, tags=['config'], force=True), (0, self.stats))
+
+
+class TestRunQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.queue = RunQueue(path=self.tmpdir.name, max_hold=60, poll_interval=0.01)
+
+    def test_many_applications(self):
+        context = multiprocessing.get_context('fork')
+        apps, runs = 8, 5
+        barrier = context.Barrier(apps)
+        log_path = os.path.join(self.tmpdir.name, 'runs.log')
+        workers = [
+            context.Process(target=_queue_worker, args=(self.tmpdir.name, f"app{i}/0", runs, barrier, log_path))
+            for i in range(apps)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        self.assertEqual([worker.exitcode for worker in workers], [0] * apps)
+        with open(log_path, 'r') as f:
+            tickets = [int(line.split()[0]) for line in f]
+        # Every run got the slot once, in the order it was enqueued
+        self.assertEqual(len(tickets), apps * runs)
+        self.assertEqual(tickets, sorted(tickets))
+        self.assertEqual(self.queue.status(), [])
+
+    def test_dead_and_expired_holders(self):
+        dead = multiprocessing.get_context('fork').Process(target=os._exit, args=(0,))
+        dead.start()
+        dead.join()
+        with self.queue._locked() as state:
+            state['entries'].append(dict(id=0, owner='dead/0', pid=dead.pid, enqueued=0, acquired=1, max_hold=60))
+            state['entries'].append(dict(id=1, owner='slow/0', pid=os.getpid(), enqueued=0, acquired=1, max_hold=60))
+            state['next'] = 2
+        with self.assertLogs('extensions.run_queue', level='WARNING') as logs:
+            with self.queue.slot('ansible/0') as ticket:
+                self.assertEqual((ticket['id'], ticket['depth']), (2, 0))
+                self.assertEqual([entry['owner'] for entry in self.queue.status()], ['ansible/0'])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_waiting_run(self):
+        with self.queue._locked() as state:
+            state['entries'].append(dict(id=0, owner='other/0', pid=os.getpid(), enqueued=0, max_hold=60))
+            state['next'] = 1
+        progress = []
+
+        def release_other(message):
+            progress.append(message)
+            with self.queue._locked() as state:
+                state['entries'].pop(0)
+
+        ticket = self.queue.acquire('ansible/0', progress=release_other)
+        self.assertEqual(progress, ['Waiting for 1 playbook runs ahead in the machine run queue'])
+        self.assertEqual(ticket['depth'], 1)
+        self.queue.release(ticket)
+        self.assertEqual(self.queue.status(), [])
+
+
+def _apt_worker(state_dir, lists_dir, barrier, results):
+    cache = apt_cache.AptCache(window=3600, state_dir=state_dir, lists_dir=lists_dir)
+    barrier.wait()
+    results.put(cache.refresh())
+
+
+class TestAptCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.lists_dir = os.path.join(self.tmpdir.name, 'lists')
+        os.makedirs(self.lists_dir)
+        old = time.time() - 7200
+        os.utime(self.lists_dir, (old, old))
+        self.updates = os.path.join(self.tmpdir.name, 'updates')
+        # Slow update recording its runs, instead of apt-get
+        command = ('sh', '-c', f"sleep 0.2; echo run >> {self.updates}")
+        for name, value in (('APT_UPDATE_COMMAND', command), ('APT_PERIODIC_STAMP', self.updates)):
+            patcher = patch.object(apt_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = apt_cache.AptCache(window=3600, state_dir=self.tmpdir.name, lists_dir=self.lists_dir)
+
+    def test_refresh_once_per_window(self):
+        self.assertFalse(self.cache.is_fresh())
+        self.assertTrue(self.cache.refresh())
+        self.assertTrue(self.cache.is_fresh())
+        self.assertFalse(self.cache.refresh())
+        self.assertTrue(self.cache.refresh(force=True))
+        self.cache.window = 0
+        self.assertFalse(self.cache.is_fresh())
+        self.assertFalse(self.cache.refresh())
+
+    def test_failed_refresh_logged(self):
+        import subprocess
+
+        command = ('sh', '-c', 'echo "E: The repository is not signed." >&2; exit 100')
+        with patch.object(apt_cache, 'APT_UPDATE_COMMAND', command), \
+                self.assertLogs('extensions.apt_cache', level='ERROR') as logs, \
+                self.assertRaises(subprocess.CalledProcessError):
+            self.cache.refresh()
+        self.assertIn('E: The repository is not signed.', logs.output[0])
+        self.assertFalse(self.cache.is_fresh())
+
+    def test_concurrent_refresh(self):
+        context = multiprocessing.get_context('fork')
+        units = 5
+        barrier, results = context.Barrier(units), context.Queue()
+        workers = [
+            context.Process(target=_apt_worker, args=(self.tmpdir.name, self.lists_dir, barrier, results))
+            for _ in range(units)
+        ]
+        for worker in workers:
+            worker.start()
+        refreshed = [results.get(timeout=30) for _ in workers]
+        for worker in workers:
+            worker.join(30)
+        self.assertEqual(sorted(refreshed), [False] * (units - 1) + [True])
+        with open(self.updates, 'r') as f:
+            self.assertEqual(f.read().splitlines(), ['run'])
+
+
+WRAPPER = b"""#!/usr/bin/python3
+_ANSIBALLZ_WRAPPER = True
+import os, sys
+# runpy.run_module(mod_name='ansible.modules.%s'
+print('{"cwd": "%%s", "marker": "%%s"}' %% (os.getcwd(), os.environ.get('MARKER')))
+sys.exit(3)
+"""
+
+
+class TestAccelerate(unittest.TestCase):
+    def test_parse_module_command(self):
+        python = sys.executable
+        self.assertEqual(
+            accelerate.parse_module_command(f"/bin/sh -c 'LANG=C.UTF-8 LC_ALL=C.UTF-8 {python} && sleep 0'"),
+            ({'LANG': 'C.UTF-8', 'LC_ALL': 'C.UTF-8'}, python, False),
+        )
+        become = (
+            "/bin/sh -c 'sudo -H -S -n  -u root /bin/sh -c '\"'\"'echo BECOME-SUCCESS-abc ; "
+            f"LANG=C {python}'\"'\"' && sleep 0'"
+        )
+        self.assertEqual(accelerate.parse_module_command(become), ({'LANG': 'C'}, python, True))
+        self.assertIsNone(accelerate.parse_module_command(f"/bin/sh -c '{python} /tmp/AnsiballZ_file.py'"))
+        self.assertIsNone(accelerate.parse_module_command(f"/bin/sh -c 'su root -c {python}'"))
+
+    def test_module_request(self):
+        cmd = f"/bin/sh -c 'MARKER=set {sys.executable} && sleep 0'"
+        request = accelerate.module_request(cmd, WRAPPER % b'file', cwd=b'/tmp')
+        self.assertEqual(
+            (request['module'], request['cwd'], request['env']['MARKER']), ('ansible.modules.file', '/tmp', 'set'),
+        )
+        # Modules starting their own interpreter and other interpreters run the usual way
+        self.assertIsNone(accelerate.module_request(cmd, WRAPPER % b'apt'))
+        self.assertIsNone(accelerate.module_request("/bin/sh -c '/usr/bin/python2 && sleep 0'", WRAPPER % b'file'))
+        self.assertIsNone(accelerate.module_request(cmd, b'print(1)'))
+
+    def test_module_server(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'modules.sock')
+        with self.assertRaises(module_server.ModuleServerUnavailable):
+            module_server.run_module(path, {})
+        pid = module_server.start(path, cwd=os.getcwd())
+        self.addCleanup(os.waitpid, pid, 0)
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        request = dict(payload=(WRAPPER % b'file').decode(), env={'MARKER': 'set'}, cwd=tmpdir.name)
+        for _ in range(2):
+            rc, stdout, stderr = module_server.run_module(path, request)
+            self.assertEqual(rc, 3)
+            self.assertEqual(json.loads(stdout), {'cwd': tmpdir.name, 'marker': 'set'})
+        self.assertEqual(module_server.stop(path), {'modules': 2})
+
+
+class TestPayloadCache(unittest.TestCase):
+    def setUp(self):
+        from ansible import constants as C
+        from ansible.executor import module_common
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache_dir = os.path.join(self.tmpdir.name, 'payloads')
+        self.local_tmp = os.path.join(self.tmpdir.name, 'local')
+        patcher = patch.object(C, 'DEFAULT_LOCAL_TMP', self.local_tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.builds = []
+
+        def build(module_name, b_module_data, module_path, *args, **kwargs):
+            # Stands in for Ansible, which builds the payload unless its process already did
+            path = os.path.join(self.local_tmp, 'ansiballz_cache', f"ansible.modules.{module_name}-ZIP_DEFLATED")
+            if not os.path.exists(path):
+                self.builds.append(module_name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(b'zip:' + b_module_data)
+            return b'wrapper', 'new', '#!python'
+
+        patcher = patch.object(module_common, '_find_module_utils', build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, modules):
+        """Build payloads of modules like one run in a new process."""
+        from ansible.executor import module_common
+
+        shutil.rmtree(self.local_tmp, ignore_errors=True)
+        cache = payload_cache.PayloadCache(self.cache_dir)
+        cache.install()
+        try:
+            for name, source in modules:
+                module_common._find_module_utils(
+                    name, source, f"/roles/x/library/{name}.py", {}, {}, None, 'ZIP_DEFLATED',
+                )
+        finally:
+            cache.uninstall()
+        return cache.stats()
+
+    def test_payloads_reused_across_runs(self):
+        modules = [('ping', b'ping source'), ('stat', b'stat source'), ('ping', b'ping source')]
+        self.assertEqual(self._run(modules), {'hits': 0, 'misses': 2, 'bytes_saved': 0})
+        self.assertEqual(self.builds, ['ping', 'stat'])
+        self.assertEqual(self._run(modules), {'hits': 2, 'misses': 0, 'bytes_saved': 30})
+        self.assertEqual(self.builds, ['ping', 'stat'])
+        with open(os.path.join(self.local_tmp, 'ansiballz_cache', 'ansible.modules.stat-ZIP_DEFLATED'), 'rb') as f:
+            self.assertEqual(f.read(), b'zip:stat source')
+        cache = payload_cache.PayloadCache(self.cache_dir)
+        cache.add_totals({'hits': 0, 'misses': 2, 'bytes_saved': 0})
+        cache.add_totals({'hits': 2, 'misses': 0, 'bytes_saved': 30})
+        self.assertEqual(cache.totals(), {'hits': 2, 'misses': 2, 'bytes_saved': 30})
+
+    def test_invalidated_by_inputs(self):
+        self._run([('ping', b'ping source')])
+        self.assertEqual(self._run([('ping', b'ping source v2')])['misses'], 1)
+        with patch.object(payload_cache, '_package_versions', return_value=['ansible-core==99']):
+            self.assertEqual(self._run([('ping', b'ping source')])['misses'], 1)
+        self.assertEqual(len(self.builds), 3)
+        # Modules of the same source have their own payloads
+        self.assertEqual(self._run([('copy', b'ping source')])['misses'], 1)
+        with open(os.path.join(self.local_tmp, 'ansiballz_cache', 'ansible.modules.copy-ZIP_DEFLATED'), 'rb') as f:
+            self.assertEqual(f.read(), b'zip:ping source')
+        self.assertEqual(len(self.builds), 4)
+        cache = payload_cache.PayloadCache(self.cache_dir)
+        cache.clear()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TestDriftSlice(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.state_path = os.path.join(self.tmpdir.name, 'drift.json')
+
+    def _slice(self, actions, digest='a', max_tasks=2, changed=(), registers={}, uses=None, seconds=0):
+        """Run a slice over tasks with actions, return the actions which ran and the state."""
+        from ansible.plugins.strategy import StrategyBase
+
+        drift_slice = DriftSlice(self.state_path, digest=digest, max_tasks=max_tasks, seconds=seconds, uses=uses)
+        drift_slice.install()
+        strategy = Mock()
+        ran = []
+        try:
+            for action in actions:
+                if strategy._tqm.terminate.called:
+                    break
+                if StrategyBase._take_step(strategy, Mock(action=action, register=registers.get(action))):
+                    ran.append(action)
+                    if action in changed:
+                        drift_slice.callback.changed.append(dict(name=action, path=f"pb.yaml:{action}", host='h'))
+        finally:
+            drift_slice.uninstall()
+        return ran, drift_slice.finish()
+
+    def test_slices_resume_where_stopped(self):
+        actions = ['set_fact', 'file', 'include_tasks', 'copy', 'file', 'command']
+        ran, state = self._slice(actions, changed=('file',))
+        self.assertEqual(ran, ['set_fact', 'file'])
+        self.assertEqual(state['position'], 2)
+        self.assertIsNone(state['last'])
+        # Facts and includes before the position run again, other tasks are skipped
+        ran, state = self._slice(actions, changed=('copy',))
+        self.assertEqual(ran, ['set_fact', 'include_tasks', 'copy'])
+        self.assertEqual(state['position'], 4)
+        ran, state = self._slice(actions, changed=('file',))
+        self.assertEqual(ran, ['set_fact', 'include_tasks', 'file', 'command'])
+        self.assertEqual(state['position'], 0)
+        self.assertEqual(state['last']['tasks'], 6)
+        self.assertEqual(state['last']['slices'], 3)
+        self.assertEqual([task['name'] for task in state['last']['drift']], ['file', 'copy'])
+
+    def test_registered_results_available(self):
+        actions = ['stat', 'command', 'file', 'copy']
+        registers = {'stat': 'conf', 'command': 'unused'}
+        self._slice(actions, registers=registers, uses=['conf'])
+        # Results later tasks use are registered again before the position
+        ran, state = self._slice(actions, registers=registers, uses=['conf'])
+        self.assertEqual(ran, ['stat', 'file', 'copy'])
+        self.assertEqual(state['last']['checked'], 4)
+        # Without known uses every registering task runs
+        self._slice(actions, registers=registers)
+        ran, state = self._slice(actions, registers=registers)
+        self.assertEqual(ran, ['stat', 'command', 'file', 'copy'])
+
+    def test_replay_within_budget(self):
+        import itertools
+
+        actions = ['set_fact'] * 4 + ['file', 'copy']
+        self._slice(actions, max_tasks=4)
+        # Every step takes a second of the three of the slice
+        with patch('extensions.drift.time.monotonic', side_effect=itertools.count()):
+            ran, state = self._slice(actions, max_tasks=4, seconds=3)
+        self.assertEqual(ran, ['set_fact', 'set_fact', 'file'])
+        self.assertEqual(state['position'], 5)
+
+    def test_changed_playbook_starts_new_pass(self):
+        actions = ['file', 'copy', 'command']
+        self._slice(actions, max_tasks=1)
+        ran, state = self._slice(actions, digest='b', max_tasks=1)
+        self.assertEqual(ran, ['file'])
+        self.assertEqual(state['position'], 1)
+        self.assertEqual(state['current']['slices'], 1)
+
+
+class TestParsedPlaybookCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        with open(self.playbook, 'w') as f:
+            f.write(PLAYBOOK)
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+
+    def test_load_stored_entry(self):
+        cache = ParsedPlaybookCache(self.cache_dir, '2.14.0')
+        self.assertIsNone(cache.load(self.playbook))
+        cache.store(self.playbook, {self.playbook: [{'hosts': 'localhost'}]}, {'localhost'})
+        entry = cache.load(self.playbook)
+        self.assertEqual(entry['files'], {self.playbook: [{'hosts': 'localhost'}]})
+        self.assertEqual(entry['patterns'], ['localhost'])
+
+    def test_invalidated_by_inputs(self):
+        cache = ParsedPlaybookCache(self.cache_dir, '2.14.0')
+        cache.store(self.playbook, {self.playbook: []}, {'localhost'})
+        self.assertIsNone(ParsedPlaybookCache(self.cache_dir, '2.15.0').load(self.playbook))
+        with open(self.playbook, 'a') as f:
+            f.write("\n# changed\n")
+        self.assertIsNone(cache.load(self.playbook))
+
+
+PLANNED_PLAYBOOK = """
+- hosts: localhost
+  vars:
+    motd: Hello
+  handlers:
+    - name: Restart ssh
+      ansible.builtin.service: name=ssh state=restarted
+  tasks:
+    - name: Check version
+      ansible.builtin.command: uname -r
+      register: kernel
+    - name: Write motd
+      ansible.builtin.copy:
+        content: "{{ motd }} {{ kernel.stdout }}"
+        dest: /etc/motd
+    - name: Configure ssh
+      ansible.builtin.lineinfile:
+        path: /etc/ssh/sshd_config
+        line: PermitRootLogin no
+      notify: Restart ssh
+"""
+
+
+class TestTaskPlanner(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        self.planner = TaskPlanner(os.path.join(self.tmpdir.name, 'applied'))
+        self._write(PLANNED_PLAYBOOK)
+        self.planner.record('config', self.playbook, 'context')
+
+    def _write(self, content):
+        with open(self.playbook, 'w') as f:
+            f.write(content)
+
+    def _lines(self, paths):
+        return [int(path.rpartition(':')[2]) for path in paths]
+
+    def test_changed_tasks(self):
+        self.assertIsNone(self.planner.plan('tags', self.playbook, 'context'))
+        self.assertEqual(self.planner.plan('config', self.playbook, 'context'), [])
+        self._write(PLANNED_PLAYBOOK.replace('PermitRootLogin no', 'PermitRootLogin yes'))
+        self.assertEqual(self._lines(self.planner.plan('config', self.playbook, 'context')), [16])
+        # Tasks registering variables of a changed task run with it
+        self._write(PLANNED_PLAYBOOK.replace('dest: /etc/motd', 'dest: /etc/issue'))
+        self.assertEqual(self._lines(self.planner.plan('config', self.playbook, 'context')), [9, 12])
+
+    def test_playbook_uses(self):
+        self.assertEqual(playbook_uses(self.playbook), {'motd', 'kernel'})
+        self._write(PLANNED_PLAYBOOK + "    - include_tasks: extra.yaml\n")
+        self.assertIsNone(playbook_uses(self.playbook))
+
+    def test_changed_vars(self):
+        self._write(PLANNED_PLAYBOOK.replace('motd: Hello', 'motd: Welcome'))
+        self.assertEqual(self._lines(self.planner.plan('config', self.playbook, 'context')), [9, 12])
+
+    def test_full_run_when_ambiguous(self):
+        self.assertIsNone(self.planner.plan('config', self.playbook, 'other context'))
+        self._write(PLANNED_PLAYBOOK.replace('state=restarted', 'state=reloaded'))
+        self.assertIsNone(self.planner.plan('config', self.playbook, 'context'))
+        self._write(PLANNED_PLAYBOOK.replace(
+            'register: kernel', 'register: kernel\n    - ansible.builtin.include_tasks: extra.yaml',
+        ))
+        self.assertIsNone(self.planner.plan('config', self.playbook, 'context'))
+
+
+TAGGED_PLAYBOOK = """
+- hosts: localhost
+  tags: [config]
+  tasks:
+    - name: Configure
+      ansible.builtin.ping:
+    - name: Debug
+      ansible.builtin.ping:
+      tags: [never, debug]
+    - block:
+        - name: Always
+          ansible.builtin.ping:
+      tags: always
+- hosts: localhost
+  tasks:
+    - name: Install
+      ansible.builtin.ping:
+      tags: install
+"""
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.playbook = os.path.join(self.tmpdir.name, 'playbook.yaml')
+        self.tag_index = TagIndex(os.path.join(self.tmpdir.name, 'playbook.tags.json'))
+        with open(self.playbook, 'w') as f:
+            f.write(TAGGED_PLAYBOOK)
+
+    def test_count_tasks(self):
+        self.assertIsNone(self.tag_index.count(self.playbook, ['stop']))
+        self.tag_index.build(self.playbook)
+        self.assertEqual(self.tag_index.count(self.playbook, ['stop']), 1)
+        # Tags of the play select its never tasks too
+        self.assertEqual(self.tag_index.count(self.playbook, ['config']), 3)
+        self.assertEqual(self.tag_index.count(self.playbook, ['debug']), 2)
+        self.assertEqual(self.tag_index.count(self.playbook), 3)
+        # Index of another version of the playbook is not used
+        with open(self.playbook, 'w') as f:
+            f.write("- hosts: localhost\n  tasks: []\n")
+        self.assertIsNone(self.tag_index.count(self.playbook, ['stop']))
+        self.tag_index.build(self.playbook)
+        self.assertEqual(self.tag_index.count(self.playbook, ['config']), 0)
+
+    def test_unknown_tags(self):
+        with open(self.playbook, 'a') as f:
+            f.write("    - ansible.builtin.import_tasks: extra.yaml\n")
+        self.tag_index.build(self.playbook)
+        self.assertEqual(self.tag_index.count(self.playbook, ['stop']), 2)
+
+
+class TestYamlIO(unittest.TestCase):
+    def test_round_trip(self):
+        import yaml
+
+        representers = dict(yaml.Dumper.yaml_representers)
+        text = yaml_io.safe_dump({'playbook': '- hosts: all\n', 'tags': ('config', 'install')})
+        self.assertEqual(yaml_io.safe_load(text), {'playbook': '- hosts: all\n', 'tags': ['config', 'install']})
+        self.assertNotIn('!!python', text)
+        # Global dumpers of PyYAML are left alone
+        self.assertEqual(yaml.Dumper.yaml_representers, representers)
+
+
+class TestMemoize(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(memoize.set_store, memoize.STORE_PATH)
+        memoize.set_store(os.path.join(self.tmpdir.name, 'memoize.json'))
+        self.calls = []
+
+    def _memoized(self, **kwargs):
+        """Return a new memoized function, as defined by a new hook process."""
+        @memoize.memoize(**kwargs)
+        def double(value):
+            self.calls.append(value)
+            return value * 2
+        self.addCleanup(double.flush)
+        return double
+
+    def test_lru_and_ttl(self):
+        double = self._memoized(maxsize=2, ttl=60)
+        self.assertEqual([double(1), double(2), double(1), double(3), double(2)], [2, 4, 2, 6, 4])
+        # 2 was the least recently used value when 3 was added
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(double.stats(), {'hits': 1, 'misses': 4, 'size': 2})
+        with patch.object(memoize.time, 'time', return_value=time.time() + 61):
+            double(2)
+        self.assertEqual(self.calls, [1, 2, 3, 2, 2])
+        double.flush()
+        double(2)
+        self.assertEqual(len(self.calls), 6)
+
+    def test_persisted_values(self):
+        self.assertEqual(self._memoized(persist=True)(21), 42)
+        self.assertEqual(self._memoized(persist=True)(21), 42)
+        self.assertEqual(self.calls, [21])
+        memoize.clear_store()
+        self._memoized(persist=True)(21)
+        self.assertEqual(self.calls, [21, 21])
+
+
+class TestSchedule(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.schedule = Schedule(os.path.join(self.tmpdir.name, 'schedule'))
+        self.run = dict(
+            request=dict(playbook='playbook.yaml', options=dict(tags=['config'])),
+            state_dir=self.tmpdir.name,
+        )
+
+    def test_parse_schedule(self):
+        self.assertEqual(parse_schedule(''), {})
+        self.assertEqual(
+            parse_schedule('config: "0 * * * *"\n"audit, report": "@daily"\n'),
+            {'config': '0 * * * *', 'audit,report': '@daily'},
+        )
+        for text in ('config: "0 * * *"', 'config: "0 * * * * ; rm"', '- config'):
+            with self.assertRaises(ValueError):
+                parse_schedule(text)
+
+    def test_jitter(self):
+        delays = {unit_jitter(f"ansible/{unit}", 600) for unit in range(400)}
+        self.assertEqual(unit_jitter('ansible/0', 600), unit_jitter('ansible/0', 600))
+        self.assertTrue(all(0 <= delay < 600 for delay in delays))
+        self.assertGreater(len(delays), 200)
+        self.assertEqual(unit_jitter('ansible/0', 0), 0)
+
+    def test_cron_line(self):
+        name = self.schedule.store('audit,report', self.run)
+        line = self.schedule.cron_line(name, '@daily', delay=42, cwd='/charm', env={'ANSIBLE_CONFIG': '/a.cfg'})
+        self.assertTrue(line.startswith('@daily root cd /charm && ANSIBLE_CONFIG=/a.cfg PYTHONPATH='))
+        self.assertIn('--name audit+report --delay 42', line)
+        self.schedule.store('config', self.run)
+        for suffix in ('log', 'log.1', 'lock', 'json.tmp'):
+            for entry in (name, 'config'):
+                open(os.path.join(self.schedule.path, f"{entry}.{suffix}"), 'w').close()
+        self.schedule.prune(['config'])
+        with self.assertRaises(FileNotFoundError):
+            self.schedule.load(name)
+        self.assertEqual(
+            sorted(os.listdir(self.schedule.path)),
+            ['config.json', 'config.json.tmp', 'config.lock', 'config.log', 'config.log.1'],
+        )
+
+    def test_log_rotated(self):
+        name = self.schedule.store('config', self.run)
+        log_path = os.path.join(self.schedule.path, 'config.log')
+        with open(log_path, 'w') as f:
+            f.write('x' * 20)
+        self.assertFalse(self.schedule.rotate_log(name, max_bytes=20))
+        with open(log_path, 'a') as output:
+            output.write('y')
+            output.flush()
+            self.assertTrue(self.schedule.rotate_log(name, max_bytes=20))
+            output.write('z')
+        with open(log_path) as f:
+            self.assertEqual(f.read(), 'z')
+        with open(f"{log_path}.1") as f:
+            self.assertEqual(f.read(), 'x' * 20 + 'y')
+
+    def test_overlapping_runs_skipped(self):
+        import fcntl
+
+        name = self.schedule.store('config', self.run)
+        jobs = JobStore(os.path.join(self.tmpdir.name, 'jobs'))
+        with patch('extensions.jobs.run_job', return_value='succeeded') as run_job:
+            self.assertEqual(self.schedule.run(name), 'succeeded')
+            with open(os.path.join(self.schedule.path, 'config.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.assertEqual(self.schedule.run(name), 'skipped')
+        self.assertEqual(run_job.call_count, 1)
+        statuses = [job['status'] for job in jobs.list()]
+        self.assertIn('skipped', statuses)
+        self.assertEqual(len(statuses), 2)
+        self.assertTrue(all(job['scheduled'] == 'config' for job in jobs.list()))
+
+
+class TestRollout(unittest.TestCase):
+    units = [f"ansible/{unit}" for unit in (10, 2, 0, 1)]
+
+    def test_canary_then_batches(self):
+        plan = plan_rollout(self.units, {}, 'r1', batch_size=2)
+        self.assertEqual(plan['batch'], ['ansible/0'])
+        states = {'ansible/0': {'revision': 'r1', 'status': 'succeeded'}}
+        plan = plan_rollout(self.units, states, 'r1', batch_size=2)
+        self.assertEqual(plan['batch'], ['ansible/1', 'ansible/2'])
+        # The batch waits for all of its units
+        states['ansible/1'] = {'revision': 'r1', 'status': 'succeeded'}
+        self.assertEqual(plan_rollout(self.units, states, 'r1', batch_size=2)['batch'], ['ansible/2', 'ansible/10'])
+        plan = plan_rollout(self.units, {}, 'r1', batch_size=2, canary=False)
+        self.assertEqual(plan['batch'], ['ansible/0', 'ansible/1'])
+
+    def test_failure_halts(self):
+        states = {
+            'ansible/0': {'revision': 'r1', 'status': 'succeeded'},
+            'ansible/1': {'revision': 'r1', 'status': 'failed'},
+        }
+        plan = plan_rollout(self.units, states, 'r1', batch_size=2)
+        self.assertTrue(plan['halted'])
+        self.assertEqual(plan['batch'], [])
+        # A new revision starts over with a canary
+        plan = plan_rollout(self.units, states, 'r2', batch_size=2)
+        self.assertFalse(plan['halted'])
+        self.assertEqual(plan['batch'], ['ansible/0'])
+
+    def test_finished(self):
+        states = {unit: {'revision': 'r1', 'status': 'succeeded'} for unit in self.units}
+        plan = plan_rollout(self.units, states, 'r1')
+        self.assertTrue(plan['finished'])
+        self.assertEqual(plan['batch'], [])
+        self.assertEqual(config_revision({'a': 1, 'b': 2}), config_revision({'b': 2, 'a': 1}))